@@ -1,6 +1,23 @@
 from mgmt_api import APIClient
 from mgmt_api import APIClientArgs
+from async_api import AsyncAPIClient
+from async_transport import AsyncTransport
+from api_future import APIFuture
+from fan_out import FanOutExecutor
+from fan_out import FanOutTarget
+from debug_log import DebugLog
 from api_exceptions import APIException
 from api_exceptions import APIClientException
 from pinger import Pinger
+from ping_stats import PingStats
+from address_space import AddressSpace
+from address_index import AddressIndex
+from address_index import ObjectIndex
+from result_writer import open_result_writer
+from pipeline import Pipeline
+from ptr_engine import PTREngine
+from ptr_cache import PTRCache
+from nameserver_stats import NameserverStats
 from reversenamelookup import ReverseLookups
+from object_snapshot import ObjectSnapshot
+from object_snapshot import sync_snapshot
@@ -0,0 +1,167 @@
+from array import array
+import socket
+
+from address_space import ip_to_int, int_to_ip, address_family
+
+# IPv4 addresses are kept as IPv4-mapped IPv6 addresses (::ffff:0:0/96)
+IPV4_MAPPED = 0xFFFF << 32
+
+
+def key_to_address(key):
+    """
+    :param key: integer key of an address (see AddressIndex.key)
+    :return: the address (string)
+    """
+    if key >> 32 == 0xFFFF:
+        return int_to_ip(key & 0xFFFFFFFF)
+    return int_to_ip(key, socket.AF_INET6)
+
+
+def address_sort_key(address):
+    """
+    :param address: IPv4 or IPv6 address (string)
+    :return: a key that sorts the IPv4 addresses numerically, followed by the IPv6 addresses (and anything that is not
+             an IP address)
+    """
+    try:
+        key = AddressIndex.key(address)
+    except (socket.error, TypeError):
+        return True, -1, address
+    return key >> 32 != 0xFFFF, key, None
+
+
+class AddressIndex:
+    """
+    An index of IPv4 and IPv6 addresses. Every address gets an id (its position in the index), and is kept as a single
+    integer (IPv4 addresses are mapped into the IPv6 space), so both families share one index and no address strings
+    are kept.
+    """
+
+    def __init__(self):
+        # integer key -> id
+        self.__ids = {}
+        # id -> integer key
+        self.__keys = []
+
+    @staticmethod
+    def key(address):
+        """
+        :param address: IPv4 or IPv6 address (string)
+        :return: the integer key of the address
+        :raises socket.error: if it is not an IP address
+        """
+        value = ip_to_int(address)
+        return value | IPV4_MAPPED if address_family(address) == socket.AF_INET else value
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def __iter__(self):
+        """
+        :yields: the addresses (strings) in the index when the iteration starts, by id
+        """
+        return (self.address(address_id) for address_id in xrange(len(self.__keys)))
+
+    def add(self, address):
+        """
+        :param address: IPv4 or IPv6 address (string)
+        :return: the id of the address, a new one if it is not in the index yet
+        :raises socket.error: if it is not an IP address
+        """
+        key = self.key(address)
+        address_id = self.__ids.get(key)
+        if address_id is None:
+            address_id = self.__ids[key] = len(self.__keys)
+            self.__keys.append(key)
+        return address_id
+
+    def get(self, address, default=None):
+        """
+        :return: the id of the address, or default if it is not in the index (or not an IP address)
+        """
+        try:
+            return self.__ids.get(self.key(address), default)
+        except socket.error:
+            return default
+
+    def family(self, address_id):
+        """returns the family of the address with the id (socket.AF_INET or socket.AF_INET6)"""
+        return socket.AF_INET if self.__keys[address_id] >> 32 == 0xFFFF else socket.AF_INET6
+
+    def address(self, address_id):
+        """returns the address (string) with the id"""
+        return key_to_address(self.__keys[address_id])
+
+    def sort_key(self, address_id):
+        """returns a key that sorts the IPv4 addresses numerically, followed by the IPv6 addresses"""
+        key = self.__keys[address_id]
+        return key >> 32 != 0xFFFF, key, None
+
+
+class ObjectIndex:
+    """
+    The objects (uid, name, domain) that use every IP address. Addresses are kept in an AddressIndex, and the objects of
+    an address are chained through arrays of object ids, so no list is allocated per address.
+    """
+
+    def __init__(self):
+        self.addresses = AddressIndex()
+        # object id -> uid, name, and index of the domain in domain_names
+        self.uids = []
+        self.names = []
+        self.domains = array("H")
+        self.domain_names = [None]
+        # address id -> first and last object ids of the address, object id -> next object id of its address (-1 - no
+        # more objects)
+        self.__first = array("i")
+        self.__last = array("i")
+        self.__next = array("i")
+
+    def __len__(self):
+        """returns the number of objects"""
+        return len(self.uids)
+
+    def add(self, address, uid, name, domain=None):
+        """
+        Adds an object that uses an address. An object with several addresses is added once for each address.
+
+        :param address: IPv4 or IPv6 address (string)
+        :param uid: uid of the object
+        :param name: name of the object
+        :param domain: [optional] name of the domain of the object
+        :return: the id of the address
+        :raises socket.error: if it is not an IP address
+        """
+        address_id = self.addresses.add(address)
+        while len(self.__first) <= address_id:
+            self.__first.append(-1)
+            self.__last.append(-1)
+        object_id = len(self.uids)
+        self.uids.append(uid)
+        self.names.append(name)
+        if domain not in self.domain_names:
+            self.domain_names.append(domain)
+        self.domains.append(self.domain_names.index(domain))
+        self.__next.append(-1)
+        if self.__first[address_id] == -1:
+            self.__first[address_id] = object_id
+        else:
+            self.__next[self.__last[address_id]] = object_id
+        self.__last[address_id] = object_id
+        return address_id
+
+    def objects(self, address_id):
+        """
+        :param address_id: id of the address
+        :return: list of (uid, name, domain) of the objects that use the address, in the order they were added
+        """
+        objects = []
+        object_id = self.__first[address_id] if address_id < len(self.__first) else -1
+        while object_id != -1:
+            objects.append((self.uids[object_id], self.names[object_id],
+                            self.domain_names[self.domains[object_id]]))
+            object_id = self.__next[object_id]
+        return objects
@@ -0,0 +1,205 @@
+import random
+import socket
+import struct
+from collections import deque
+from fractions import gcd
+from threading import Lock
+
+
+def address_family(address):
+    """
+    :param address: IP address (string)
+    :return: socket.AF_INET6 for IPv6 addresses, socket.AF_INET otherwise
+    """
+    return socket.AF_INET6 if ":" in address else socket.AF_INET
+
+
+def address_bits(family):
+    """returns the number of bits of the addresses of the family"""
+    return 128 if family == socket.AF_INET6 else 32
+
+
+def pack_address(address):
+    """
+    :param address: IPv4 or IPv6 address (string)
+    :return: the address in network byte order (4 or 16 bytes)
+    :raises socket.error: if it is not an IP address
+    """
+    if address_family(address) == socket.AF_INET:
+        return socket.inet_aton(address)
+    if not hasattr(socket, "inet_pton"):
+        raise socket.error("IPv6 addresses are not supported on this platform")
+    return socket.inet_pton(socket.AF_INET6, address)
+
+
+def ip_to_int(address):
+    """
+    :param address: IPv4 or IPv6 address (string)
+    :return: the address as an integer
+    """
+    packed = pack_address(address)
+    if len(packed) == 4:
+        return struct.unpack("!I", packed)[0]
+    high, low = struct.unpack("!QQ", packed)
+    return high << 64 | low
+
+
+def int_to_ip(value, family=socket.AF_INET):
+    """
+    :param value: IP address as an integer
+    :param family: socket.AF_INET or socket.AF_INET6
+    :return: the address (string)
+    """
+    if family == socket.AF_INET:
+        return socket.inet_ntoa(struct.pack("!I", value))
+    return socket.inet_ntop(socket.AF_INET6, struct.pack("!QQ", value >> 64, value & 0xFFFFFFFFFFFFFFFF))
+
+
+class AddressBlock:
+    """
+    The addresses of a network or an address range object. Addresses are computed one at a time, in a random order
+    that visits every address once: the i'th address is first + (a * i + c) mod size, with a coprime to size.
+    """
+
+    def __init__(self, name, first, size, limit=None, shuffle=True, family=socket.AF_INET, uid=None):
+        """
+        Init function of Class
+        :param name: name of the object
+        :param first: first address (integer)
+        :param size: number of addresses
+        :param limit: [optional] maximum number of addresses to yield
+        :param shuffle: yield the addresses in random order, instead of from first to last
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param uid: [optional] uid of the object
+        """
+        self.name = name
+        self.uid = uid
+        self.family = family
+        self.first = first
+        self.size = size
+        self.limit = size if limit is None else min(size, limit)
+        self.multiplier, self.offset = 1, 0
+        if shuffle and size > 1:
+            self.multiplier = random.randrange(1, size)
+            while gcd(self.multiplier, size) != 1:
+                self.multiplier = random.randrange(1, size)
+            self.offset = random.randrange(size)
+        # number of addresses yielded, and number of them that answered
+        self.yielded = 0
+        self.answered = 0
+
+    def next_address(self):
+        """
+        :return: the next address (string)
+        """
+        value = self.first + (self.multiplier * self.yielded + self.offset) % self.size
+        self.yielded += 1
+        return int_to_ip(value, self.family)
+
+
+class AddressSpace:
+    """
+    Expands IPv4 and IPv6 network and address range objects into addresses lazily, so sweeping big networks never
+    builds the list of their addresses.
+    The addresses of all the objects are interleaved, so the load is spread over the subnets, and each object stops
+    yielding addresses when it reaches its cap, or when enough of its addresses answered (see record).
+    The addresses may be iterated in one thread while their results are recorded in another.
+    """
+
+    def __init__(self, max_per_block=None, stop_after=None, shuffle=True):
+        """
+        Init function of Class
+        :param max_per_block: [optional] maximum number of addresses to yield from each object
+        :param stop_after: [optional] stop yielding the addresses of an object after this many of them answered
+        :param shuffle: yield the addresses of each object in random order
+        """
+        self.max_per_block = max_per_block
+        self.stop_after = stop_after
+        self.shuffle = shuffle
+        self.blocks = []
+        # address -> list of the blocks it was yielded from, until its result is recorded
+        self.__pending = {}
+        # guards __pending and the counters of the blocks
+        self.__lock = Lock()
+
+    def add_network(self, name, subnet, mask_length, uid=None):
+        """
+        Adds the host addresses of a network (without the network and broadcast addresses of IPv4 networks of more
+        than two addresses, and without the subnet-router anycast address of IPv6 networks).
+
+        :param name: name of the network object
+        :param subnet: network address (string)
+        :param mask_length: prefix length
+        :param uid: [optional] uid of the network object
+        :return: the AddressBlock
+        """
+        family = address_family(subnet)
+        size = 1 << (address_bits(family) - mask_length)
+        first = ip_to_int(subnet) & ~(size - 1)
+        if family == socket.AF_INET6 and size > 1:
+            first += 1
+            size -= 1
+        elif size > 2:
+            first += 1
+            size -= 2
+        return self.__add(name, first, size, family, uid)
+
+    def add_range(self, name, first, last, uid=None):
+        """
+        Adds the addresses of an address range.
+
+        :param name: name of the address range object
+        :param first: first address (string)
+        :param last: last address (string)
+        :param uid: [optional] uid of the address range object
+        :return: the AddressBlock
+        """
+        family = address_family(first)
+        first = ip_to_int(first)
+        return self.__add(name, first, max(0, ip_to_int(last) - first + 1), family, uid)
+
+    def __add(self, name, first, size, family, uid):
+        block = AddressBlock(name, first, size, self.max_per_block, self.shuffle, family, uid)
+        self.blocks.append(block)
+        return block
+
+    def __len__(self):
+        """returns the maximum number of addresses that will be yielded"""
+        return sum(block.limit for block in self.blocks)
+
+    def __is_done(self, block):
+        return block.yielded >= block.limit or (self.stop_after is not None and block.answered >= self.stop_after)
+
+    def __iter__(self):
+        """
+        :yields: the addresses (strings), one from each object in turn
+        """
+        blocks = deque(self.blocks)
+        while blocks:
+            block = blocks.popleft()
+            with self.__lock:
+                if self.__is_done(block):
+                    continue
+                address = block.next_address()
+                self.__pending.setdefault(address, []).append(block)
+            yield address
+            blocks.append(block)
+
+    def record(self, address, active):
+        """
+        Records the result of an address that was yielded, for the early stop of its object.
+
+        :param address: the address (string)
+        :param active: whether it answered
+        :return: the AddressBlock of the object the address was yielded from, or None if it was not yielded
+        """
+        with self.__lock:
+            blocks = self.__pending.get(address)
+            if not blocks:
+                return None
+            block = blocks.pop(0)
+            if not blocks:
+                del self.__pending[address]
+            if active:
+                block.answered += 1
+            return block
@@ -0,0 +1,70 @@
+from threading import Event, Lock
+
+from api_exceptions import APIClientException
+
+
+class APIFuture:
+    """
+    The result of an API operation that runs in the background.
+    """
+
+    def __init__(self):
+        self.__done = Event()
+        self.__lock = Lock()
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+
+    def done(self):
+        """returns whether the operation is completed (bool)"""
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the operation to complete.
+
+        :param timeout: [optional] seconds to wait. None means wait forever.
+        :return: the result of the operation (usually an APIResponse object)
+        :raises: the exception raised by the operation, or APIClientException if the timeout expired
+        """
+        if not self.__done.wait(timeout):
+            raise APIClientException("Timed out waiting for the operation to complete")
+        if self.__exc_info is not None:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def exception(self, timeout=None):
+        """
+        Waits for the operation to complete.
+
+        :return: the exception raised by the operation, or None
+        """
+        if not self.__done.wait(timeout):
+            raise APIClientException("Timed out waiting for the operation to complete")
+        return self.__exc_info[1] if self.__exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) when the operation completes (at once, if it is already completed).
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self.__complete(result, None)
+
+    def set_exc_info(self, exc_info):
+        self.__complete(None, exc_info)
+
+    def __complete(self, result, exc_info):
+        with self.__lock:
+            self.__result = result
+            self.__exc_info = exc_info
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for fn in callbacks:
+            fn(self)
+
@@ -14,6 +14,8 @@ class APIResponse:
     def __init__(self, json_response, success, status_code=None, err_message=""):
         self.status_code = status_code
         self.data = None
+        # size of the response body in bytes, when it was received over HTTP
+        self.size = None
 
         if err_message:
             self.success = False
@@ -68,8 +70,11 @@ class APIResponse:
         :return: The APIResponse object we generated
         """
         assert isinstance(http_response, HTTPResponse)
-        return cls(http_response.read(), success=(http_response.status == 200), status_code=http_response.status,
-                   err_message=err_message)
+        body = http_response.read()
+        res = cls(body, success=(http_response.status == 200), status_code=http_response.status,
+                  err_message=err_message)
+        res.size = len(body)
+        return res
 
     def set_success_status(self, status):
         """
@@ -0,0 +1,220 @@
+import copy
+import json
+import sys
+
+from api_future import APIFuture
+from async_transport import AsyncTransport
+from mgmt_api import APIClient, APIClientArgs
+
+
+class AsyncAPIClient:
+    """
+    AsyncAPIClient sends API calls to a management server without waiting for them, and returns APIFuture objects, so
+    a single caller can have many calls in flight.
+    The calls are sent by an AsyncTransport over non-blocking connections, from one thread, and the tasks of the calls
+    are checked together by the TaskWaiter of one APIClient, so no thread waits for a call. The number of calls in
+    flight is not limited; up to max_concurrency of them are sent to the server at the same time, and the others wait
+    for a connection. Clients of several servers can share one AsyncTransport.
+    The calls share the session, the verified fingerprint and the debug log of the APIClient.
+    """
+
+    def __init__(self, api_client_args=None, max_concurrency=8, transport=None):
+        """Constructor
+        :param api_client_args: APIClientArgs object containing arguments
+        :param max_concurrency: maximum number of requests sent to the server at the same time
+        :param transport: [optional] AsyncTransport object that sends the calls, e.g. shared with the clients of other
+                          servers (its max_connections applies instead of max_concurrency). By default, the client has
+                          its own.
+        """
+        # if a client_args is not supplied, make a default one
+        if api_client_args is None:
+            api_client_args = APIClientArgs()
+        api_client_args = copy.copy(api_client_args)
+        if api_client_args.max_concurrency is None:
+            api_client_args.max_concurrency = max_concurrency
+        if api_client_args.pool_size < max_concurrency:
+            api_client_args.pool_size = max_concurrency
+        self.max_concurrency = max_concurrency
+        # the client of the session. It builds and logs the requests, checks the tasks, and runs the queries of the
+        # generator functions.
+        self.client = APIClient(api_client_args)
+        self.__own_transport = transport is None
+        self.transport = transport if transport is not None else AsyncTransport(max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """destructor"""
+        # wait for the calls in flight before logging out
+        if self.__own_transport:
+            self.transport.close()
+        self.client.__exit__(exc_type, exc_value, traceback)
+
+    @property
+    def sid(self):
+        return self.client.sid
+
+    def check_fingerprint(self):
+        """
+        See APIClient.check_fingerprint. Call it before the other calls: it runs in the caller's thread, since it may
+        ask the user a question, and the transport then uses the fingerprint it verified.
+
+        :return: False if the user does not accept the server certificate, True in all other cases.
+        """
+        return self.client.check_fingerprint()
+
+    def login(self, username, password, continue_last_session=False, domain=None, read_only=False, payload=None):
+        """
+        See APIClient.login
+
+        :return: APIFuture object with the APIResponse of the login command. The session is used by the calls made
+                 after it completes.
+        """
+        future = APIFuture()
+
+        def on_login(login_future):
+            try:
+                login_res = login_future.result()
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+                return
+            self.client.set_session(login_res, domain)
+            future.set_result(login_res)
+
+        self.api_call("login", self.client.login_credentials(username, password, continue_last_session, domain,
+                                                             read_only, payload)).add_done_callback(on_login)
+        return future
+
+    def api_call(self, command, payload=None, sid=None, wait_for_task=True):
+        """
+        See APIClient.api_call. When the server responds with a "task-id" and wait_for_task is True, the future
+        completes after the task completes. The tasks of all the calls in flight are checked together.
+
+        :return: APIFuture object with the APIResponse
+        """
+        future = APIFuture()
+        try:
+            url, data, headers = self.client.build_request(command, payload, sid)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return future
+
+        def on_response(http_future):
+            try:
+                res = http_future.result()
+            except Exception as err:
+                res = self.client.error_response(err)
+            # Store the request and the reply (for debug purpose).
+            self.client.log_api_call(command, payload, url, headers, res.response())
+            task_ids = self.client.task_waiter.get_task_ids(res) if wait_for_task and command != "show-task" else []
+            if task_ids:
+                self.client.task_waiter.submit(task_ids).add_done_callback(
+                    lambda task_future: self.__copy_future(task_future, future))
+            else:
+                future.set_result(res)
+
+        client = self.client
+        self.transport.request((client.server, client.get_port(), client.proxy_host, client.proxy_port), url, data,
+                               headers, None if client.unsafe else client.get_trusted_fingerprint,
+                               client.timeout).add_done_callback(on_response)
+        return future
+
+    @staticmethod
+    def __copy_future(source, target):
+        """complete the target future with the result (or the exception) of the source future"""
+        try:
+            target.set_result(source.result())
+        except Exception:
+            target.set_exc_info(sys.exc_info())
+
+    def api_query(self, command, details_level="standard", container_key="objects", include_container_key=False,
+                  payload=None, limit=50):
+        """
+        See APIClient.api_query. The first page tells the number of objects, then all the other pages are requested
+        at the same time (up to max_concurrency of them are sent together).
+
+        :return: APIFuture object with the APIResponse
+        """
+        future = APIFuture()
+        if payload is None:
+            payload = {}
+        elif isinstance(payload, str):
+            payload = json.loads(payload)
+        payload = dict(payload, **{"details-level": details_level, "limit": limit, "offset": 0})
+
+        def done(api_res, objects):
+            if objects is not None:
+                api_res.data[container_key] = objects
+            if api_res.success and container_key in api_res.data and include_container_key is False:
+                api_res.data = api_res.data[container_key]
+            future.set_result(api_res)
+
+        def on_first_page(first_future):
+            try:
+                first_res = first_future.result()
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+                return
+            if not first_res.data or not isinstance(first_res.data.get(container_key), list) \
+                    or not first_res.data.get("total"):
+                done(first_res, None)
+                return
+            # the server may return fewer objects per page than limit
+            stride = first_res.data["to"] - first_res.data["from"] + 1
+            if stride <= 0:
+                done(first_res, None)
+                return
+            offsets = range(first_res.data["to"], first_res.data["total"], stride)
+            if not offsets:
+                done(first_res, None)
+                return
+            pages = {}
+
+            def on_page(offset, page_future):
+                if future.done():
+                    # an earlier page failed
+                    return
+                try:
+                    page_res = page_future.result()
+                except Exception:
+                    future.set_exc_info(sys.exc_info())
+                    return
+                pages[offset] = page_res
+                if len(pages) < len(offsets):
+                    return
+                objects = list(first_res.data[container_key])
+                for page_offset in offsets:
+                    page_res = pages[page_offset]
+                    if not page_res.success:
+                        future.set_result(page_res)
+                        return
+                    objects += page_res.data.get(container_key, [])
+                done(pages[offsets[-1]], objects)
+
+            for offset in offsets:
+                self.api_call(command, dict(payload, limit=stride, offset=offset)).add_done_callback(
+                    lambda page_future, page_offset=offset: on_page(page_offset, page_future))
+
+        self.api_call(command, payload).add_done_callback(on_first_page)
+        return future
+
+    def gen_api_query(self, command, details_level="standard", container_keys=None, payload=None, limit=50):
+        """
+        See APIClient.gen_api_query. The caller waits for the pages, so they are requested by the threads of the
+        APIClient: up to max_concurrency at the same time, yielded in order as they arrive.
+
+        :yields: APIResponse objects
+        """
+        return self.client.gen_api_query(command, details_level, container_keys, payload,
+                                         thread_count=self.max_concurrency, limit=limit)
+
+    def gen_api_objects(self, command, details_level="standard", container_key="objects", payload=None, limit=50,
+                        pages=False):
+        """
+        See APIClient.gen_api_objects. The pages are requested like in gen_api_query.
+
+        :yields: the objects (dicts) one by one, or a list of objects per page
+        """
+        return self.client.gen_api_objects(command, details_level, container_key, payload,
+                                           thread_count=self.max_concurrency, limit=limit, pages=pages)
@@ -0,0 +1,592 @@
+import errno
+import hashlib
+import itertools
+import select
+import socket
+import ssl
+import time
+from collections import deque
+from threading import Thread, Lock
+
+from api_exceptions import APIClientException
+from api_future import APIFuture
+from api_response import APIResponse
+from sweep import CONNECT_IN_PROGRESS, TimeoutQueue
+
+# bytes read from a socket at a time
+RECV_SIZE = 65536
+
+# the states of a connection: opening the TCP connection, opening the tunnel of the proxy, TLS handshake, sending a
+# request, reading its reply, and waiting for the next request (keep-alive)
+STATE_CONNECT = "connect"
+STATE_TUNNEL = "tunnel"
+STATE_HANDSHAKE = "handshake"
+STATE_SEND = "send"
+STATE_RECV = "recv"
+STATE_IDLE = "idle"
+
+
+def _wakeup_pair():
+    """
+    :return: (reader, writer) pair of connected sockets, to wake up the event loop from other threads
+    """
+    if hasattr(socket, "socketpair"):
+        reader, writer = socket.socketpair()
+    else:
+        # Windows
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader, _ = listener.accept()
+        listener.close()
+    reader.setblocking(0)
+    writer.setblocking(0)
+    return reader, writer
+
+
+class _Request:
+    """A request waiting for a connection, or being sent on one."""
+
+    def __init__(self, key, url, data, headers, fingerprint_verifier, timeout):
+        self.key = key
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.fingerprint_verifier = fingerprint_verifier
+        self.timeout = timeout
+        self.future = APIFuture()
+        # whether it was sent again on a new connection, after a keep-alive connection failed
+        self.retried = False
+
+
+class _Connection:
+    """An HTTPS connection of the event loop, with the state of its current request."""
+
+    ids = itertools.count()
+
+    def __init__(self, key):
+        self.id = next(self.ids)
+        self.key = key
+        self.sock = None
+        self.state = STATE_CONNECT
+        # whether the TLS handshake (or a send) is waiting for the socket to be readable, instead of writable
+        self.want_read = False
+        # seconds of inactivity after which the request fails, and the time of the last progress
+        self.timeout = None
+        self.deadline = None
+        self.request = None
+        # whether a request was already completed on the connection
+        self.reused = False
+        self.out = ""
+        self.__reset_reply()
+
+    def __reset_reply(self):
+        # the bytes received and not parsed yet, the parts of the body, and the number of bytes of the reply received
+        self.buf = ""
+        self.received = 0
+        self.status = None
+        self.headers = None
+        self.body = []
+        self.body_size = 0
+        # bytes of the body still expected (None - until the server closes the connection), or for chunked replies,
+        # bytes of the current chunk and its CRLF still expected (None - its size line is next)
+        self.content_length = None
+        self.chunked = False
+        self.chunk_left = None
+        self.keep_alive = False
+
+    def start(self, request, message):
+        self.__reset_reply()
+        self.request = request
+        self.out = message
+        self.state = STATE_SEND
+        self.want_read = False
+
+    def touch(self, now):
+        """records progress of the request"""
+        if self.timeout is not None:
+            self.deadline = now + self.timeout
+
+    def feed(self, data):
+        """
+        Parses the bytes of the reply.
+
+        :return: True when the whole reply was received
+        :raises socket.error: if the reply is not valid HTTP
+        """
+        if self.headers is None:
+            self.buf += data
+            end = self.buf.find("\r\n\r\n")
+            if end < 0:
+                return False
+            lines = self.buf[:end].split("\r\n")
+            data, self.buf = self.buf[end + 4:], ""
+            parts = lines[0].split(" ", 2)
+            try:
+                version, self.status = parts[0], int(parts[1])
+            except (IndexError, ValueError):
+                raise socket.error("Invalid HTTP status line: " + lines[0][:100])
+            self.headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                self.headers[name.strip().lower()] = value.strip()
+            connection = self.headers.get("connection", "").lower()
+            self.keep_alive = connection == "keep-alive" or version == "HTTP/1.1" and connection != "close"
+            self.chunked = "chunked" in self.headers.get("transfer-encoding", "").lower()
+            if not self.chunked and "content-length" in self.headers:
+                self.content_length = int(self.headers["content-length"])
+            elif not self.chunked:
+                # the body ends when the server closes the connection
+                self.keep_alive = False
+            if self.content_length == 0:
+                return True
+        if self.chunked:
+            return self.__feed_chunked(data)
+        self.body.append(data)
+        self.body_size += len(data)
+        return self.content_length is not None and self.body_size >= self.content_length
+
+    def __feed_chunked(self, data):
+        self.buf += data
+        while True:
+            if self.chunk_left is None:
+                end = self.buf.find("\r\n")
+                if end < 0:
+                    return False
+                try:
+                    size = int(self.buf[:end].split(";")[0].strip(), 16)
+                except ValueError:
+                    raise socket.error("Invalid HTTP chunk size: " + self.buf[:end][:100])
+                if size == 0:
+                    # the last chunk, followed by optional trailers and an empty line
+                    if self.buf[end + 2:end + 4] == "\r\n":
+                        return True
+                    return self.buf.find("\r\n\r\n", end) >= 0
+                self.buf = self.buf[end + 2:]
+                self.chunk_left = size + 2
+            if not self.buf:
+                return False
+            piece = self.buf[:self.chunk_left]
+            # the chunk ends with a CRLF, which is not part of the body
+            self.body.append(piece[:max(0, self.chunk_left - 2)])
+            self.chunk_left -= len(piece)
+            self.buf = self.buf[len(piece):]
+            if self.chunk_left == 0:
+                self.chunk_left = None
+
+    def reply(self):
+        """returns the (status, body) of the reply"""
+        return self.status, "".join(self.body)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class AsyncTransport:
+    """
+    Sends API requests to management servers from a single thread, over non-blocking HTTPS connections.
+    Every request is sent on an idle keep-alive connection to its server, or on a new one, up to max_connections
+    connections per server; the other requests wait for a connection. Any number of requests to any number of servers
+    can be in flight, and no thread waits for them.
+    The certificate of every new connection is checked with a fingerprint verifier (see
+    APIClient.get_trusted_fingerprint), which is called from the thread of the transport, so it should not ask the
+    user (call APIClient.check_fingerprint first).
+    The callbacks of the futures run in the thread of the transport, and should not block.
+    """
+
+    def __init__(self, max_connections=8):
+        """
+        Init function of Class
+        :param max_connections: maximum number of connections to each server, which is the number of requests sent to
+                                it at the same time
+        """
+        self.max_connections = max_connections
+        # ssl context with no ssl verification, the fingerprint is checked instead
+        self.__ssl_context = ssl.create_default_context()
+        self.__ssl_context.check_hostname = False
+        self.__ssl_context.verify_mode = ssl.CERT_NONE
+        self.__lock = Lock()
+        # requests submitted by other threads, not seen by the loop yet
+        self.__submitted = []
+        self.__closing = False
+        # key -> deque of the requests waiting for a connection
+        self.__waiting = {}
+        # key -> list of idle connections
+        self.__idle = {}
+        # key -> number of connections (opening, busy or idle)
+        self.__open = {}
+        # fd -> connection
+        self.__connections = {}
+        self.__timeouts = TimeoutQueue()
+        # number of requests served by an idle connection, that needed a new connection, and that were sent again on
+        # a new connection because an idle one was closed by the server
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.__wakeup_reader, self.__wakeup_writer = _wakeup_pair()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """destructor"""
+        self.close()
+
+    def request(self, key, url, data, headers, fingerprint_verifier=None, timeout=None):
+        """
+        Sends a POST request.
+
+        :param key: (server, port, proxy host, proxy port) of the request. Requests with the same key share their
+                    connections. The proxy is used when its host and port are set.
+        :param url: the path of the request
+        :param data: the body of the request (string)
+        :param headers: dict of the headers of the request
+        :param fingerprint_verifier: [optional] function that gets the SHA1 fingerprint of the certificate of a new
+                                     connection, and returns the fingerprint trusted for the server
+        :param timeout: [optional] seconds the request may go without progress. None means wait forever.
+        :return: APIFuture object with the APIResponse of the request. Errors of the connection (socket.error, or
+                 ValueError("Fingerprint value mismatch", expected, actual)) are raised by the future.
+        """
+        request = _Request(key, url, data, headers, fingerprint_verifier, timeout)
+        with self.__lock:
+            if self.__thread is None:
+                raise APIClientException("The transport is closed")
+            self.__submitted.append(request)
+        self.__wakeup()
+        return request.future
+
+    def stats(self):
+        """
+        :return: dict with the connection counters, and the number of open connections
+        """
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses, "reconnects": self.reconnects,
+                    "open": sum(self.__open.values())}
+
+    def close(self):
+        """
+        Waits for the requests that were submitted (and the requests submitted by their callbacks), then closes the
+        connections and stops the thread of the transport.
+        """
+        with self.__lock:
+            thread = self.__thread
+            self.__closing = True
+        if thread is None:
+            return
+        self.__wakeup()
+        thread.join()
+        with self.__lock:
+            self.__thread = None
+        self.__wakeup_reader.close()
+        self.__wakeup_writer.close()
+
+    def __wakeup(self):
+        try:
+            self.__wakeup_writer.send("x")
+        except socket.error:
+            # the loop has a wakeup pending already
+            pass
+
+    def __run(self):
+        """thread function of the event loop"""
+        try:
+            while True:
+                with self.__lock:
+                    submitted, self.__submitted = self.__submitted, []
+                    closing = self.__closing
+                for request in submitted:
+                    self.__waiting.setdefault(request.key, deque()).append(request)
+                self.__dispatch()
+                if closing and not any(self.__waiting.values()) and \
+                        not any(conn.request is not None for conn in self.__connections.values()):
+                    with self.__lock:
+                        if not self.__submitted:
+                            return
+                    continue
+                self.__wait()
+                self.__expire()
+        finally:
+            for conn in self.__connections.values():
+                conn.close()
+            self.__connections = {}
+
+    def __dispatch(self):
+        """starts the waiting requests on idle connections, or on new ones"""
+        for key, waiting in self.__waiting.items():
+            idle = self.__idle.setdefault(key, [])
+            while waiting:
+                if idle:
+                    conn = idle.pop()
+                    self.hits += 1
+                    self.__send(conn, waiting.popleft())
+                elif self.__open.get(key, 0) < self.max_connections:
+                    self.misses += 1
+                    self.__connect(key, waiting.popleft())
+                else:
+                    break
+            if not waiting:
+                del self.__waiting[key]
+
+    @staticmethod
+    def __message(request):
+        """returns the HTTP request message"""
+        server, port = request.key[:2]
+        lines = ["POST {} HTTP/1.1".format(request.url), "Host: {}:{}".format(server, port),
+                 "Accept-Encoding: identity"]
+        for name, value in request.headers.items():
+            lines.append("{}: {}".format(name, value))
+        return "\r\n".join(lines) + "\r\n\r\n" + request.data
+
+    def __send(self, conn, request):
+        conn.start(request, self.__message(request))
+        conn.timeout = request.timeout
+        conn.touch(time.time())
+        self.__watch_deadline(conn)
+
+    def __connect(self, key, request):
+        """opens a new connection for the request"""
+        server, port, proxy_host, proxy_port = key
+        conn = _Connection(key)
+        conn.request = request
+        conn.timeout = request.timeout
+        conn.touch(time.time())
+        try:
+            host, host_port = (proxy_host, proxy_port) if proxy_host and proxy_port else (server, port)
+            family, socktype, proto, _, address = socket.getaddrinfo(host, host_port, 0, socket.SOCK_STREAM)[0]
+            conn.sock = socket.socket(family, socktype, proto)
+            conn.sock.setblocking(0)
+            err = conn.sock.connect_ex(address)
+            if err and err not in CONNECT_IN_PROGRESS:
+                raise socket.error(err, errno.errorcode.get(err, str(err)))
+        except Exception as err:
+            conn.close()
+            request.future.set_exc_info((type(err), err, None))
+            return
+        self.__open[key] = self.__open.get(key, 0) + 1
+        self.__connections[conn.sock.fileno()] = conn
+        self.__watch_deadline(conn)
+
+    def __watch_deadline(self, conn):
+        if conn.deadline is not None:
+            self.__timeouts.add(conn.deadline, conn.id)
+
+    def __wait(self):
+        """waits for the sockets that are ready, or the next deadline, and handles them"""
+        readers = [self.__wakeup_reader.fileno()]
+        writers = []
+        for fd, conn in self.__connections.items():
+            if conn.state == STATE_CONNECT or \
+                    conn.state in (STATE_TUNNEL, STATE_SEND) and conn.out and not conn.want_read or \
+                    conn.state == STATE_HANDSHAKE and not conn.want_read:
+                writers.append(fd)
+            else:
+                readers.append(fd)
+        wait = None
+        deadline = self.__timeouts.next_deadline()
+        if deadline is not None:
+            wait = max(0, deadline - time.time())
+
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            for fd in readers:
+                poller.register(fd, select.POLLIN)
+            for fd in writers:
+                poller.register(fd, select.POLLOUT)
+            try:
+                events = poller.poll(None if wait is None else wait * 1000)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                events = []
+            ready = [fd for fd, event in events]
+        else:
+            try:
+                readable, writable, _ = select.select(readers, writers, [], wait)
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                readable, writable = [], []
+            ready = readable + writable
+
+        for fd in ready:
+            if fd == self.__wakeup_reader.fileno():
+                try:
+                    while self.__wakeup_reader.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+                continue
+            conn = self.__connections.get(fd)
+            if conn is not None:
+                self.__progress(conn)
+
+    def __progress(self, conn):
+        """advances a connection whose socket is ready"""
+        try:
+            if conn.state == STATE_IDLE:
+                # an idle keep-alive socket should never be readable. the server closed it.
+                self.__drop(conn)
+                return
+            conn.touch(time.time())
+            if conn.state == STATE_CONNECT:
+                err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, errno.errorcode.get(err, str(err)))
+                server, port, proxy_host, proxy_port = conn.key
+                if proxy_host and proxy_port:
+                    conn.state = STATE_TUNNEL
+                    conn.out = "CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n".format(server, port)
+                    return
+                self.__start_handshake(conn)
+            if conn.state == STATE_TUNNEL:
+                if conn.out:
+                    sent = conn.sock.send(conn.out)
+                    conn.out = conn.out[sent:]
+                    return
+                self.__read_tunnel(conn)
+                return
+            if conn.state == STATE_HANDSHAKE:
+                self.__handshake(conn)
+                if conn.state != STATE_SEND:
+                    return
+            if conn.state == STATE_SEND:
+                self.__write(conn)
+                if conn.state != STATE_RECV:
+                    return
+            if conn.state == STATE_RECV:
+                self.__read(conn)
+        except ssl.SSLWantReadError:
+            conn.want_read = True
+        except ssl.SSLWantWriteError:
+            conn.want_read = False
+        except socket.error as err:
+            if err.args and err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.__fail(conn, err)
+        except Exception as err:
+            self.__fail(conn, err)
+
+    def __read_tunnel(self, conn):
+        """reads the reply of the proxy to CONNECT"""
+        data = conn.sock.recv(RECV_SIZE)
+        if not data:
+            raise socket.error("Tunnel connection failed: the proxy closed the connection")
+        conn.buf += data
+        end = conn.buf.find("\r\n\r\n")
+        if end < 0:
+            return
+        status_line = conn.buf.split("\r\n", 1)[0]
+        conn.buf = ""
+        parts = status_line.split(" ", 2)
+        if len(parts) < 2 or parts[1] != "200":
+            raise socket.error("Tunnel connection failed: " + status_line[:100])
+        self.__start_handshake(conn)
+
+    def __start_handshake(self, conn):
+        conn.sock = self.__ssl_context.wrap_socket(conn.sock, do_handshake_on_connect=False)
+        conn.state = STATE_HANDSHAKE
+        conn.want_read = False
+
+    def __handshake(self, conn):
+        conn.sock.do_handshake()
+        request = conn.request
+        if request.fingerprint_verifier is not None:
+            actual = hashlib.new("SHA1", conn.sock.getpeercert(True)).hexdigest().upper()
+            expected = request.fingerprint_verifier(actual)
+            if expected.replace(':', '').upper() != actual:
+                raise ValueError("Fingerprint value mismatch", expected, actual)
+        conn.start(request, self.__message(request))
+
+    def __write(self, conn):
+        while conn.out:
+            sent = conn.sock.send(conn.out[:RECV_SIZE])
+            conn.out = conn.out[sent:]
+        conn.state = STATE_RECV
+        conn.want_read = True
+
+    def __read(self, conn):
+        while True:
+            data = conn.sock.recv(RECV_SIZE)
+            if not data:
+                if conn.headers is not None and conn.content_length is None and not conn.chunked:
+                    # the body ends when the server closes the connection
+                    conn.keep_alive = False
+                    self.__complete(conn)
+                    return
+                raise socket.error("The server closed the connection")
+            conn.received += len(data)
+            if conn.feed(data):
+                self.__complete(conn)
+                return
+
+    def __complete(self, conn):
+        """completes the request of a connection with its reply, and keeps the connection for the next request"""
+        request = conn.request
+        status, body = conn.reply()
+        conn.request = None
+        conn.reused = True
+        conn.deadline = None
+        if conn.keep_alive:
+            conn.state = STATE_IDLE
+            self.__idle.setdefault(conn.key, []).append(conn)
+        else:
+            self.__drop(conn)
+        try:
+            res = APIResponse(body, success=(status == 200), status_code=status)
+            res.size = len(body)
+        except Exception as err:
+            request.future.set_exc_info((type(err), err, None))
+            return
+        request.future.set_result(res)
+
+    def __fail(self, conn, err):
+        """closes a connection that failed, and fails its request (or sends it again on a new connection)"""
+        request = conn.request
+        # the keep-alive connection failed before the whole request was sent, or before any byte of the reply
+        # arrived, so the server did not carry out the request (e.g. publish) and it may be sent again
+        not_received = conn.reused and (conn.state == STATE_SEND or conn.state == STATE_RECV and conn.received == 0)
+        self.__drop(conn)
+        if request is None:
+            return
+        if not_received and not request.retried and not isinstance(err, socket.timeout):
+            # The server closed the idle connection between our requests. Reconnect once and retry.
+            request.retried = True
+            self.reconnects += 1
+            self.__waiting.setdefault(request.key, deque()).appendleft(request)
+            return
+        request.future.set_exc_info((type(err), err, None))
+
+    def __drop(self, conn):
+        """closes a connection and forgets it"""
+        fd = conn.sock.fileno() if conn.sock is not None else None
+        if fd is not None and self.__connections.get(fd) is conn:
+            del self.__connections[fd]
+            self.__open[conn.key] -= 1
+        idle = self.__idle.get(conn.key, [])
+        if conn in idle:
+            idle.remove(conn)
+        conn.close()
+
+    def __expire(self):
+        """fails the requests that made no progress in their timeout"""
+        now = time.time()
+        expired = set(self.__timeouts.pop_expired(now))
+        if not expired:
+            return
+        for conn in self.__connections.values():
+            if conn.id not in expired or conn.request is None or conn.deadline is None:
+                continue
+            if conn.deadline > now:
+                # it made progress since
+                self.__timeouts.add(conn.deadline, conn.id)
+            else:
+                self.__fail(conn, socket.timeout("timed out"))
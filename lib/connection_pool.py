@@ -0,0 +1,99 @@
+import select
+import socket
+from threading import Lock
+
+
+class ConnectionPool:
+    """
+    A pool of idle keep-alive HTTPS connections.
+    Connections are grouped by a key (server, port, proxy host, proxy port) so that one pool can serve several servers.
+    """
+
+    def __init__(self, max_idle=8):
+        """
+        Init function of Class
+        :param max_idle: maximum number of idle connections kept per key. Extra connections are closed on release.
+        """
+        self.max_idle = max_idle
+        # key -> list of idle connections
+        self.__idle = {}
+        self.__lock = Lock()
+        # number of requests served by an idle connection
+        self.hits = 0
+        # number of requests that needed a new connection
+        self.misses = 0
+        # number of idle connections that were found stale (closed by the server) and replaced
+        self.reconnects = 0
+
+    @staticmethod
+    def is_stale(conn):
+        """
+        An idle keep-alive socket should never be readable. If it is, the server either closed it or sent
+        unexpected data, and in both cases the connection can not be reused.
+
+        :param conn: HTTPSConnection object
+        :return: True if the connection can not be reused
+        """
+        sock = conn.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def acquire(self, key):
+        """
+        Get an idle connection for the given key.
+
+        :param key: pool key
+        :return: an idle connection, or None if a new connection should be made
+        """
+        with self.__lock:
+            idle = self.__idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if self.is_stale(conn):
+                    conn.close()
+                    self.reconnects += 1
+                    continue
+                self.hits += 1
+                return conn
+            self.misses += 1
+            return None
+
+    def release(self, key, conn):
+        """
+        Return a connection to the pool after its response has been fully read.
+
+        :param key: pool key
+        :param conn: the connection to keep alive
+        """
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def record_reconnect(self):
+        """count a reused connection that failed mid-request and had to be replaced"""
+        with self.__lock:
+            self.reconnects += 1
+
+    def close(self):
+        """close all the idle connections"""
+        with self.__lock:
+            for idle in self.__idle.values():
+                for conn in idle:
+                    conn.close()
+            self.__idle = {}
+
+    def stats(self):
+        """
+        :return: dict with the pool hit/miss counters and the number of idle connections
+        """
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses, "reconnects": self.reconnects,
+                    "idle": sum(len(idle) for idle in self.__idle.values())}
@@ -0,0 +1,151 @@
+from __future__ import print_function
+from collections import deque
+from threading import Thread, Lock
+import Queue
+import json
+import os
+import sys
+
+
+class DebugLog:
+    """
+    A debug sink for the API calls of an APIClient.
+    Every call is written to a JSON Lines file as soon as it is made, instead of keeping all the calls in memory
+    and writing them when the client exits.
+    """
+
+    def __init__(self, file_name="", max_calls=None, include_bodies=True, max_bytes=None, backup_count=1,
+                 background=False):
+        """
+        Init function of Class
+        :param file_name: JSON Lines file to write the calls to. If left empty, the calls are only kept in memory.
+        :param max_calls: number of the last calls to keep in memory (None - all of them, 0 - none)
+        :param include_bodies: if False, only the request and the status of the reply are logged, without the
+                               payload and the reply data
+        :param max_bytes: rotate the file when it grows beyond this size (None - never rotate)
+        :param backup_count: number of rotated files to keep (file_name.1, file_name.2, ...)
+        :param background: write the file from a background thread, so API calls don't wait for the disk
+        """
+        self.file_name = file_name
+        self.include_bodies = include_bodies
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_calls = max_calls
+        # the last calls, in memory
+        self.calls = deque(maxlen=max_calls) if max_calls is not None else []
+        self.__lock = Lock()
+        self.__file = None
+        self.__size = 0
+        # The queue of lines for the background writer
+        self.__lines_q = None
+        self.__writer = None
+        if background and file_name:
+            self.__lines_q = Queue.Queue()
+            self.__writer = Thread(target=self.__write_lines)
+            self.__writer.daemon = True
+            self.__writer.start()
+
+    def append(self, api_log):
+        """
+        Logs an API call.
+
+        :param api_log: dict with the "request" and the "response" of the call
+        """
+        if not self.include_bodies:
+            api_log = self.strip_bodies(api_log)
+        if self.max_calls != 0:
+            self.calls.append(api_log)
+        if not self.file_name:
+            return
+
+        # serialize now: the objects of a reply may be changed by the caller after the call returns
+        line = json.dumps(api_log, sort_keys=True, default=str) + "\n"
+        if self.__lines_q is not None:
+            self.__lines_q.put(line)
+        else:
+            self.__write(line)
+
+    @staticmethod
+    def strip_bodies(api_log):
+        """
+        :param api_log: dict with the "request" and the "response" of the call
+        :return: a copy of the log with the URL, the headers and the status code, but without the payload and the
+                 reply data (except for an error message)
+        """
+        response = api_log["response"]
+        stripped_response = {"status_code": response.get("status_code")}
+        data = response.get("data")
+        if isinstance(data, dict) and "message" in data:
+            stripped_response["message"] = data["message"]
+        return {
+            "request": {"url": api_log["request"]["url"], "headers": api_log["request"]["headers"]},
+            "response": stripped_response
+        }
+
+    def __write(self, line):
+        """write a line to the file, rotating it when it's too big"""
+        with self.__lock:
+            try:
+                if self.__file is None:
+                    self.__open()
+                elif self.max_bytes and self.__size + len(line) > self.max_bytes:
+                    try:
+                        self.__rotate()
+                    except (IOError, OSError) as e:
+                        # the line is written to the current file
+                        print("Couldn't rotate debug file: " + self.file_name + "\n" + str(e), file=sys.stderr)
+                self.__file.write(line)
+                self.__size += len(line)
+            except (IOError, OSError) as e:
+                print("Couldn't write to debug file: " + self.file_name + "\n" + str(e), file=sys.stderr)
+
+    def __write_lines(self):
+        """
+        background writer function for thread
+        :return: None
+        """
+        while True:
+            line = self.__lines_q.get()
+            if line is None:
+                break
+            self.__write(line)
+
+    def __open(self):
+        self.__size = os.path.getsize(self.file_name) if os.path.isfile(self.file_name) else 0
+        self.__file = open(self.file_name, "a")
+
+    def __rotate(self):
+        """file_name -> file_name.1 -> file_name.2 ... the oldest file is removed"""
+        self.__file.close()
+        # if the file can't be opened again, the next write tries to open it
+        self.__file = None
+        try:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = "{}.{}".format(self.file_name, i)
+                if os.path.exists(src):
+                    os.rename(src, "{}.{}".format(self.file_name, i + 1))
+            if self.backup_count > 0:
+                os.rename(self.file_name, self.file_name + ".1")
+            else:
+                os.remove(self.file_name)
+        finally:
+            # keep writing to the file even if it wasn't rotated
+            self.__open()
+
+    def flush(self):
+        """flush the lines written so far to the disk"""
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+
+    def close(self):
+        """stop the background writer (after it writes all the pending lines) and close the file"""
+        if self.__writer is not None:
+            self.__lines_q.put(None)
+            self.__writer.join()
+            self.__writer = None
+            self.__lines_q = None
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
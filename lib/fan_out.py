@@ -0,0 +1,213 @@
+import copy
+import sys
+from threading import Thread, Event
+import Queue
+
+from api_exceptions import APIException
+from mgmt_api import APIClient, APIClientArgs
+
+
+class FanOutTarget:
+    """
+    A management server (or a domain of an MDS) to run queries on, with its credentials.
+    """
+
+    def __init__(self, server, username, password, domain=None, api_client_args=None, name=None):
+        """
+        :param server: management server name or IP-address
+        :param username: Check Point admin name
+        :param password: Check Point admin password
+        :param domain: [optional] the name, UID or IP-Address of the domain to login to
+        :param api_client_args: [optional] APIClientArgs object for the client of this target (its 'server' is replaced)
+        :param name: [optional] the source name the results are tagged with. Defaults to "server" or "server/domain".
+        """
+        self.server = server
+        self.username = username
+        self.password = password
+        self.domain = domain
+        self.api_client_args = api_client_args
+        self.name = name if name else (server + "/" + domain if domain else server)
+
+
+class FanOutExecutor:
+    """
+    Runs the same query on many management servers and domains at the same time, and streams the results tagged with
+    the name of their source.
+    The total number of requests in flight is capped by max_concurrency. When there are fewer targets than that, the
+    pages of each target's query are requested in parallel.
+    """
+
+    def __init__(self, targets, max_concurrency=16, max_server_concurrency=4, queue_size=10000):
+        """
+        Init function of Class
+        :param targets: list of FanOutTarget objects
+        :param max_concurrency: maximum number of requests in flight, across all the targets
+        :param max_server_concurrency: maximum number of requests in flight to a single target
+        :param queue_size: maximum number of pages of results waiting to be consumed. Workers wait while the queue is
+                           full.
+        """
+        self.targets = targets
+        self.max_concurrency = max_concurrency
+        self.max_server_concurrency = max_server_concurrency
+        self.queue_size = queue_size
+        # target name -> APIClient of the targets that logged in
+        self.clients = {}
+        # target name -> exception (or error message) of the targets that failed
+        self.errors = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """destructor"""
+        self.__run(lambda target, client: client.__exit__(exc_type, exc_value, traceback), self.__logged_in_targets())
+        self.clients = {}
+
+    def __logged_in_targets(self):
+        return [target for target in self.targets if target.name in self.clients]
+
+    def __run(self, fn, targets):
+        """
+        Runs fn(target, client) for every target, at most max_concurrency at a time.
+
+        :return: dict of target name -> return value of fn, for the targets where fn didn't raise
+        """
+        # The queue of targets
+        targets_q = Queue.Queue()
+        for target in targets:
+            targets_q.put(target)
+        results = {}
+
+        def work():
+            try:
+                while True:
+                    target = targets_q.get_nowait()
+                    try:
+                        results[target.name] = fn(target, self.clients.get(target.name))
+                    except Exception as err:
+                        self.errors[target.name] = err
+            except Queue.Empty:
+                # No more targets.
+                pass
+
+        workers = []
+        for i in range(min(self.max_concurrency, len(targets))):
+            workers.append(Thread(target=work))
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+        return results
+
+    def login(self):
+        """
+        Logs in to all the targets in parallel.
+        Fingerprints are checked first, one server at a time, since the user may be asked to accept them.
+
+        :return: dict of target name -> APIResponse of the login command
+        """
+        for target in self.targets:
+            if target.name not in self.clients:
+                client_args = copy.copy(target.api_client_args) if target.api_client_args else APIClientArgs()
+                client_args.server = target.server
+                self.clients[target.name] = APIClient(client_args)
+
+        for target in self.targets:
+            if not self.clients[target.name].check_fingerprint():
+                self.errors[target.name] = "The server's fingerprint was not accepted"
+
+        def login(target, client):
+            login_res = client.login(target.username, target.password, domain=target.domain)
+            if login_res.success is False:
+                self.errors[target.name] = login_res.error_message
+            return login_res
+
+        login_results = self.__run(login, [target for target in self.targets if target.name not in self.errors])
+        for name in self.errors:
+            client = self.clients.pop(name, None)
+            if client is not None:
+                # close its connections (and save its debug data)
+                client.__exit__(None, None, None)
+        return login_results
+
+    def api_call(self, command, payload=None):
+        """
+        Runs an API call on all the logged in targets.
+
+        :return: dict of target name -> APIResponse
+        """
+        return self.__run(lambda target, client: client.api_call(command, payload), self.__logged_in_targets())
+
+    def gen_api_objects(self, command, details_level="standard", container_key="objects", payload=None, limit=50):
+        """
+        Runs a query on all the logged in targets, and yields the objects as they are received.
+        A target whose query fails stops yielding objects, and its error is stored in 'errors'.
+
+        :param command: name of API command. This command should be an API that returns an array of objects
+                        (for example: show-hosts, show networks, ...)
+        :param details_level: query APIs always take a details-level argument. Possible values are "standard", "full", "uid"
+        :param container_key: name of the key that holds the objects in the JSON response (usually "objects").
+        :param payload: a JSON object with the command arguments
+        :param limit: [optional] number of objects to request in each API call
+        :yields: tuples of (target name, object)
+        """
+        targets = self.__logged_in_targets()
+        if not targets:
+            return
+        for target in targets:
+            self.errors.pop(target.name, None)
+        # split the requests allowed in flight between the targets
+        thread_count = max(1, min(self.max_server_concurrency, self.max_concurrency // len(targets)))
+        # The queue of results. None marks the end of a target's query.
+        out_q = Queue.Queue(self.queue_size)
+        # set when the caller stops consuming the results
+        stopped = Event()
+
+        def query(target, client):
+            try:
+                for page in client.gen_api_objects(command, details_level, container_key, copy.deepcopy(payload),
+                                                   thread_count=thread_count, limit=limit, pages=True):
+                    if stopped.is_set():
+                        break
+                    out_q.put((target.name, page))
+            except APIException:
+                self.errors[target.name] = sys.exc_info()[1]
+            finally:
+                out_q.put(None)
+
+        runner = Thread(target=self.__run, args=(query, targets))
+        runner.daemon = True
+        runner.start()
+
+        finished = 0
+        try:
+            while finished < len(targets):
+                item = out_q.get()
+                if item is None:
+                    finished += 1
+                    continue
+                name, page = item
+                for obj in page:
+                    yield name, obj
+        finally:
+            # if the caller stopped early, let the workers finish their current page and stop
+            stopped.set()
+            while runner.is_alive():
+                try:
+                    out_q.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    def api_query(self, command, details_level="standard", container_key="objects", payload=None, limit=50):
+        """
+        Runs a query on all the logged in targets.
+
+        :return: dict of target name -> list of objects, for the targets whose query succeeded
+        """
+        results = dict((target.name, []) for target in self.__logged_in_targets())
+        for name, obj in self.gen_api_objects(command, details_level, container_key, payload, limit):
+            results[name].append(obj)
+        for name in self.errors:
+            results.pop(name, None)
+        return results
@@ -0,0 +1,173 @@
+import errno
+import os
+import random
+import socket
+import struct
+import sys
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+# missing from the socket module of some platforms
+IPPROTO_ICMPV6 = getattr(socket, "IPPROTO_ICMPV6", 58)
+
+# bytes of data sent in every echo request
+PAYLOAD = "CP_API_Cleanup!!"
+# bytes of the socket's receive buffer
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+# Linux socket option that attaches a classic BPF program to a socket
+SO_ATTACH_FILTER = 26
+
+
+def checksum(data):
+    """
+    Internet checksum (RFC 1071) of a packet
+    :param data: string of bytes
+    :return: 16 bit checksum
+    """
+    if len(data) % 2:
+        data += "\0"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_echo_request(ident, seq, payload=PAYLOAD, family=socket.AF_INET):
+    """
+    :param family: socket.AF_INET for ICMP, socket.AF_INET6 for ICMPv6. The kernel computes the checksum of ICMPv6
+                   packets, since it covers the IPv6 addresses.
+    :return: ICMP echo request packet (string of bytes)
+    """
+    if family == socket.AF_INET6:
+        return struct.pack("!BBHHH", ICMPV6_ECHO_REQUEST, 0, 0, ident, seq) + payload
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, checksum(header + payload), ident, seq) + payload
+
+
+class ICMPSocket:
+    """
+    A single ICMP (or ICMPv6) socket that sends echo requests to many hosts and receives their replies.
+    An unprivileged datagram socket is used where the system allows it (Linux net.ipv4.ping_group_range),
+    and a raw socket otherwise (requires root/administrator).
+    """
+
+    def __init__(self, family=socket.AF_INET):
+        """
+        :param family: socket.AF_INET or socket.AF_INET6
+        :raises socket.error: if neither kind of ICMP socket can be opened
+        """
+        self.family = family
+        proto = IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+        self.reply_type = ICMPV6_ECHO_REPLY if family == socket.AF_INET6 else ICMP_ECHO_REPLY
+        try:
+            self.sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+            self.raw = False
+        except socket.error:
+            self.sock = socket.socket(family, socket.SOCK_RAW, proto)
+            self.raw = True
+        self.sock.setblocking(False)
+        # a big receive buffer, so replies are not dropped while thousands of requests are in flight
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        except socket.error:
+            pass
+        # identifier of our echo requests. datagram sockets replace it with the socket's port, and the kernel only
+        # delivers the replies of this socket, so it is checked only with raw sockets.
+        self.ident = (os.getpid() ^ random.getrandbits(16)) & 0xFFFF
+        if self.raw:
+            self.__attach_ident_filter()
+
+    def __attach_ident_filter(self):
+        """
+        Raw sockets receive a copy of every ICMP packet of the host, including the replies to the other sweeps (e.g.
+        of the other processes of a sharded sweep). On Linux, a BPF filter drops all the packets but the echo replies
+        to this socket in the kernel, before they take room in the receive buffer.
+        """
+        if ctypes is None or not sys.platform.startswith("linux"):
+            return
+        program = [
+            # x = length of the IP header. raw ICMPv6 sockets don't get the IPv6 header.
+            (0x01, 0, 0, 0) if self.family == socket.AF_INET6 else (0xb1, 0, 0, 0),
+            # a = ICMP type and code
+            (0x48, 0, 0, 0),
+            # echo reply (code 0)?
+            (0x15, 0, 3, self.reply_type << 8),
+            # a = ICMP identifier
+            (0x48, 0, 0, 4),
+            (0x15, 0, 1, self.ident),
+            # accept the packet
+            (0x06, 0, 0, 0xFFFF),
+            # drop it
+            (0x06, 0, 0, 0),
+        ]
+        instructions = ctypes.create_string_buffer("".join(struct.pack("HBBI", *ins) for ins in program))
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                                 struct.pack("HP", len(program), ctypes.addressof(instructions)))
+        except socket.error:
+            # the replies are still checked in recv_replies
+            pass
+
+    @staticmethod
+    def available(family=socket.AF_INET):
+        """returns whether ICMP sockets of the family can be opened on this system (bool)"""
+        try:
+            ICMPSocket(family).close()
+        except socket.error:
+            return False
+        return True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, address, seq):
+        """
+        Sends an echo request.
+
+        :param address: IP address of the socket's family (string)
+        :param seq: 16 bit sequence number, used to match the reply
+        :return: True if the request was sent, None if the socket buffer is full (try again later), and False if it
+                 can not be sent (e.g. the network is unreachable)
+        """
+        try:
+            self.sock.sendto(build_echo_request(self.ident, seq, family=self.family), (address, 0))
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                return None
+            return False
+        return True
+
+    def recv_replies(self):
+        """
+        Reads all the echo replies waiting on the socket.
+
+        :return: list of (address, seq) tuples
+        """
+        replies = []
+        while True:
+            try:
+                packet, source = self.sock.recvfrom(2048)
+            except socket.error:
+                # no more packets
+                return replies
+            address = source[0]
+            if self.raw and self.family == socket.AF_INET:
+                # raw sockets get the IP header too (but not the IPv6 header)
+                packet = packet[(ord(packet[0]) & 0x0F) * 4:]
+            if len(packet) < 8:
+                continue
+            icmp_type, code, csum, ident, seq = struct.unpack("!BBHHH", packet[:8])
+            if icmp_type != self.reply_type or (self.raw and ident != self.ident):
+                continue
+            replies.append((address, seq))
+
@@ -0,0 +1,125 @@
+import json
+
+# characters that JSON allows between tokens
+WHITESPACE = " \t\n\r"
+# characters that may follow a complete value
+DELIMITERS = WHITESPACE + ",:]}"
+
+
+class JSONStreamParser:
+    """
+    Parses a JSON object from a file-like stream (e.g. an HTTP response) and yields the items of one of its arrays
+    as soon as each item is read. Only the current item and one chunk of the stream are held in memory.
+    The other members of the object are collected into 'fields'.
+    """
+
+    def __init__(self, stream, chunk_size=64 * 1024):
+        """
+        Init function of Class
+        :param stream: object with a read(size) method
+        :param chunk_size: number of bytes to read from the stream at a time
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # members of the top-level object, other than the streamed array
+        self.fields = {}
+        # number of bytes read from the stream so far
+        self.bytes_read = 0
+        self.__decoder = json.JSONDecoder()
+        self.__buf = ""
+        self.__pos = 0
+        self.__eof = False
+
+    def __fill(self):
+        """
+        Reads the next chunk of the stream into the buffer, dropping the part of the buffer already parsed.
+
+        :return: False at the end of the stream
+        """
+        if self.__eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.__eof = True
+            return False
+        self.bytes_read += len(chunk)
+        self.__buf = self.__buf[self.__pos:] + chunk
+        self.__pos = 0
+        return True
+
+    def __peek(self):
+        """
+        Skips whitespace.
+
+        :return: the next character, or "" at the end of the stream
+        """
+        while True:
+            while self.__pos < len(self.__buf) and self.__buf[self.__pos] in WHITESPACE:
+                self.__pos += 1
+            if self.__pos < len(self.__buf):
+                return self.__buf[self.__pos]
+            if not self.__fill():
+                return ""
+
+    def __expect(self, chars):
+        """
+        Consumes the next character, which must be one of chars.
+
+        :return: the character
+        """
+        char = self.__peek()
+        if char == "" or char not in chars:
+            raise ValueError("Invalid JSON: expected one of '{}' at byte {}".format(
+                chars, self.bytes_read - len(self.__buf) + self.__pos))
+        self.__pos += 1
+        return char
+
+    def __value(self):
+        """
+        Decodes the next complete JSON value, reading more of the stream until it is complete.
+
+        :return: the decoded value
+        """
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buf, self.__pos)
+            except ValueError:
+                if not self.__fill():
+                    raise
+                continue
+            # a number cut by the end of the buffer (e.g. "1." of "1.5") may continue in the next chunk
+            if (end == len(self.__buf) or self.__buf[end] not in DELIMITERS) and self.__fill():
+                continue
+            self.__pos = end
+            return value
+
+    def iter_items(self, array_key):
+        """
+        Parses the stream, yielding the items of the array in array_key one at a time.
+        When the generator is exhausted, 'fields' holds the rest of the object.
+
+        :param array_key: key of the array in the top-level object
+        :yields: the items of the array
+        :raises ValueError: if the stream is not a valid JSON object
+        """
+        self.__expect("{")
+        if self.__peek() == "}":
+            self.__pos += 1
+            return
+        while True:
+            key = self.__value()
+            self.__expect(":")
+            if key == array_key and self.__peek() == "[":
+                self.__pos += 1
+                if self.__peek() == "]":
+                    self.__pos += 1
+                else:
+                    while True:
+                        yield self.__value()
+                        if self.__expect(",]") == "]":
+                            break
+            else:
+                self.fields[key] = self.__value()
+            if self.__expect(",}") == "}":
+                return
@@ -10,17 +10,25 @@
 
 from __future__ import print_function
 
+import errno
 import hashlib
 import httplib
 import json
 import os.path
+import Queue
+import socket
 import ssl
 import subprocess
 import sys
 import time
+from threading import BoundedSemaphore, Lock, Thread
 
 from api_exceptions import APIException, APIClientException
 from api_response import APIResponse
+from connection_pool import ConnectionPool
+from json_stream import JSONStreamParser
+from page_size import AdaptivePageSize
+from task_waiter import TaskWaiter
 
 
 class APIClientArgs:
@@ -32,7 +40,8 @@ class APIClientArgs:
     # port is set to None by default, but it gets replaced with 443 if not specified
     def __init__(self, port=None, fingerprint=None, sid=None, server="127.0.0.1", http_debug_level=0,
                  api_calls=None, debug_file="", proxy_host=None, proxy_port=8080,
-                 api_version="1.1", unsafe=False, unsafe_auto_accept=False):
+                 api_version="1.1", unsafe=False, unsafe_auto_accept=False, pool_size=8,
+                 fingerprint_ttl=None, timeout=None, debug_log=None, max_concurrency=None):
         self.port = port
         # management server fingerprint
         self.fingerprint = fingerprint
@@ -56,6 +65,18 @@ class APIClientArgs:
         self.unsafe = unsafe
         # Indicates that the client should automatically accept and save the server's certificate
         self.unsafe_auto_accept = unsafe_auto_accept
+        # maximum number of idle keep-alive connections kept per server
+        self.pool_size = pool_size
+        # seconds a verified server fingerprint is trusted before it's checked against the fingerprints file again.
+        # None means the fingerprint is verified once per session.
+        self.fingerprint_ttl = fingerprint_ttl
+        # socket timeout in seconds for API requests. None means wait forever.
+        self.timeout = timeout
+        # DebugLog object that gets every API call as it is made. When given, api_calls holds only the calls that the
+        # DebugLog keeps in memory.
+        self.debug_log = debug_log
+        # maximum number of requests sent to the server at the same time (None - no limit)
+        self.max_concurrency = max_concurrency
 
 
 class APIClient:
@@ -96,6 +117,29 @@ class APIClient:
         self.unsafe = api_client_args.unsafe
         # Indicates that the client should automatically accept and save the server's certificate
         self.unsafe_auto_accept = api_client_args.unsafe_auto_accept
+        # keep-alive connections, reused between API calls
+        self.pool = ConnectionPool(api_client_args.pool_size)
+        # ssl context with no ssl verification, we do it by ourselves
+        self.__ssl_context = ssl.create_default_context()
+        self.__ssl_context.check_hostname = False
+        self.__ssl_context.verify_mode = ssl.CERT_NONE
+        # seconds a verified server fingerprint stays in the cache (None - for the whole session)
+        self.fingerprint_ttl = api_client_args.fingerprint_ttl
+        # (server, port) -> (verified fingerprint, time of verification)
+        self.__verified_fingerprints = {}
+        self.__fingerprint_lock = Lock()
+        # socket timeout in seconds for API requests (None - wait forever)
+        self.timeout = api_client_args.timeout
+        # streaming debug sink (None - keep all the api calls in api_calls)
+        self.debug_log = api_client_args.debug_log
+        if self.debug_log is not None:
+            self.api_calls = self.debug_log.calls
+        # limits the number of requests sent to the server at the same time (None - no limit)
+        self.__requests_semaphore = BoundedSemaphore(api_client_args.max_concurrency) \
+            if api_client_args.max_concurrency else None
+        # waits for the tasks of commands like publish and install-policy.
+        # task_waiter.submit(task_ids) waits in the background and returns an APIFuture.
+        self.task_waiter = TaskWaiter(self)
 
     def __enter__(self):
         return self
@@ -105,6 +149,8 @@ class APIClient:
         # if sid is not empty (the login api was called), then call logout
         if self.sid:
             self.api_call("logout")
+        # close the keep-alive connections
+        self.pool.close()
         # save debug data with api calls to disk
         self.save_debug_data()
 
@@ -120,12 +166,19 @@ class APIClient:
         self.__port = port
         self.__is_port_default = False
 
+    def get_pool_stats(self):
+        """returns the hit/miss counters of the connection pool (dict)"""
+        return self.pool.stats()
+
     def save_debug_data(self):
         """save debug data with api calls to disk"""
+        if self.debug_log is not None:
+            # the calls were already written as they were made
+            self.debug_log.close()
         if self.debug_file:
             print("\nSaving data to debug file {}\n".format(self.debug_file), file=sys.stderr)
             out_file = open(self.debug_file, 'w+')
-            out_file.write(json.dumps(self.api_calls, indent=4, sort_keys=True))
+            out_file.write(json.dumps(list(self.api_calls), indent=4, sort_keys=True))
 
     def login(self, username, password, continue_last_session=False, domain=None, read_only=False,
               payload=None):
@@ -143,6 +196,17 @@ class APIClient:
         :returns: APIResponse object
         :side-effects: updates the class's uid and server variables
         """
+        login_res = self.api_call("login", self.login_credentials(username, password, continue_last_session, domain,
+                                                                  read_only, payload))
+        self.set_session(login_res, domain)
+        return login_res
+
+    @staticmethod
+    def login_credentials(username, password, continue_last_session=False, domain=None, read_only=False,
+                          payload=None):
+        """
+        :return: the payload of the 'login' API call (dict). See login for the parameters.
+        """
         credentials = {"user": username, "password": password, "continue-last-session": continue_last_session,
                        "read-only": read_only}
 
@@ -150,14 +214,19 @@ class APIClient:
             credentials.update({"domain": domain})
         if isinstance(payload, dict):
             credentials.update(payload)
+        return credentials
 
-        login_res = self.api_call("login", credentials)
+    def set_session(self, login_res, domain=None):
+        """
+        Uses the session of a 'login' API call for the next API calls, if the login succeeded.
 
+        :param login_res: APIResponse object of the login
+        :param domain: the domain that was logged into
+        """
         if login_res.success:
             self.sid = login_res.data["sid"]
             self.domain = domain
             self.api_version = login_res.data["api-server-version"]
-        return login_res
 
     def login_as_root(self, domain=None, payload=None):
         """
@@ -222,89 +291,31 @@ class APIClient:
         :return: APIResponse object
         :side-effects: updates the class's uid and server variables
         """
-        self.check_fingerprint()
-        if payload is None:
-            payload = {}
-        # Convert the json payload to a string if needed
-        if isinstance(payload, str):
-            _data = payload
-        elif isinstance(payload, dict):
-            _data = json.dumps(payload, sort_keys=False)
-        else:
-            raise TypeError('Invalid payload type - must be dict/string')
-        # update class members if needed.
-        if sid is None:
-            sid = self.sid
-
-        # Set headers
-        _headers = {
-            "User-Agent": "python-api-wrapper",
-            "Accept": "*/*",
-            "Content-Type": "application/json",
-            "Content-Length": len(_data)
-        }
-
-        # In all API calls (except for 'login') a header containing the Check Point session-id is required.
-        if sid is not None:
-            _headers["X-chkp-sid"] = sid
-
-        # Create ssl context with no ssl verification, we do it by ourselves
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-
-        # create https connection
-        if self.proxy_host and self.proxy_port:
-            conn = HTTPSConnection(self.proxy_host, self.proxy_port, context=context)
-            conn.set_tunnel(self.server, self.get_port())
-        else:
-            conn = HTTPSConnection(self.server, self.get_port(), context=context)
-
-        # Set fingerprint
-        conn.fingerprint = self.fingerprint
-
-        # Set debug level
-        conn.set_debuglevel(self.http_debug_level)
-        url = "/web_api/" + (("v" + str(self.api_version) + "/") if self.api_version else "") + command
+        url, _data, _headers = self.build_request(command, payload, sid)
 
+        pool_key = self.__pool_key()
+        conn = None
         response = None
+        keep_alive = False
+        if self.__requests_semaphore is not None:
+            self.__requests_semaphore.acquire()
         try:
-            # Send the data to the server
-            conn.request("POST", url, _data, _headers)
-            # Get the reply from the server
-            response = conn.getresponse()
+            conn, response = self.__open_request(pool_key, url, _data, _headers)
             res = APIResponse.from_http_response(response)
-        except ValueError as err:
-            if err.args[0] == "Fingerprint value mismatch":
-                err_message = "Error: Fingerprint value mismatch:\n" + " Expecting : {}\n".format(
-                    err.args[1]) + " Got: {}\n".format(
-                    err.args[2]) + "If you trust the new fingerprint, edit the 'fingerprints.txt' file."
-                res = APIResponse("", False, err_message=err_message)
-            else:
-                res = APIResponse("", False, err_message=err)
+            keep_alive = not response.will_close
         except Exception as err:
-            res = APIResponse("", False, err_message=err)
+            res = self.error_response(err)
+        finally:
+            if self.__requests_semaphore is not None:
+                self.__requests_semaphore.release()
+
+        self.__release_connection(pool_key, conn, keep_alive)
 
         if response:
             res.status_code = response.status
 
-        # When the command is 'login' we'd like to convert the password to "****" so that it
-        # would not appear as plaintext in the debug file.
-        if command == "login":
-            json_data = json.loads(_data)
-            json_data["password"] = "****"
-            _data = json.dumps(json_data)
-
         # Store the request and the reply (for debug purpose).
-        _api_log = {
-            "request": {
-                "url": url,
-                "payload": json.loads(_data),
-                "headers": _headers
-            },
-            "response": res.response()
-        }
-        self.api_calls.append(_api_log)
+        self.log_api_call(command, payload, url, _headers, res.response())
 
         # If we want to wait for the task to end, wait for it
         if wait_for_task is True and res.success and command != "show-task":
@@ -316,7 +327,7 @@ class APIClient:
         return res
 
     def api_query(self, command, details_level="standard", container_key="objects", include_container_key=False,
-                  payload=None):
+                  payload=None, thread_count=1, limit=50, adaptive_limit=False):
         """
         The APIs that return a list of objects are limited by the number of objects that they return.
         To get the full list of objects, there's a need to make repeated API calls each time using a different offset
@@ -335,19 +346,24 @@ class APIClient:
                                       Otherwise, the date field of the APIResponse will be a dictionary in the following
                                       format: { container_key: [ List of the wanted objects], "total": size of the list}
         :param payload: a JSON object (or a string representing a JSON object) with the command arguments
+        :param thread_count: [optional] number of pages to request at the same time. See gen_api_query.
+        :param limit: [optional] number of objects to request in each API call. See gen_api_query.
+        :param adaptive_limit: [optional] adjust the number of objects per API call. See gen_api_query.
         :return: if include-container-key is False:
                      an APIResponse object whose .data member contains a list of the objects requested: [ , , , ...]
                  if include-container-key is True:
                      an APIResponse object whose .data member contains a dict: { container_key: [...], "total": n }
         """
         api_res = None
-        for api_res in self.gen_api_query(command, details_level, [container_key], payload=payload):
+        for api_res in self.gen_api_query(command, details_level, [container_key], payload=payload,
+                                          thread_count=thread_count, limit=limit, adaptive_limit=adaptive_limit):
             pass
         if api_res and api_res.success and container_key in api_res.data and include_container_key is False:
             api_res.data = api_res.data[container_key]
         return api_res
 
-    def gen_api_query(self, command, details_level="standard", container_keys=None, payload=None):
+    def gen_api_query(self, command, details_level="standard", container_keys=None, payload=None, thread_count=1,
+                      limit=50, adaptive_limit=False):
         """
         This is a generator function that yields the list of wanted objects received so far from the management server.
         This is in contrast to normal API calls that return only a limited number of objects.
@@ -358,10 +374,18 @@ class APIClient:
         :param details_level: query APIs always take a details-level argument. Possible values are "standard", "full", "uid"
         :param container_keys: the field in the .data dict that contains the objects
         :param payload: a JSON object (or a string representing a JSON object) with the command arguments
+        :param thread_count: [optional] number of pages to request at the same time. When greater than 1, the pages
+                             after the first one are requested by a pool of thread_count workers that share the
+                             session, and are yielded in order as they arrive.
+        :param limit: [optional] number of objects to request in each API call (the API allows up to 500).
+        :param adaptive_limit: [optional] True (or an AdaptivePageSize object) to start with 'limit' objects per call,
+                               and then grow the page size while the responses are fast and small, and shrink it
+                               after slow or big responses, timeouts and server errors. A page that timed out or
+                               failed on the server is requested again with the smaller size.
+                               Applies when the pages are fetched one after the other (thread_count=1). With
+                               parallel fetching the page size stays fixed at 'limit'.
         :yields: an APIResponse object as detailed above
         """
-        limit = 50  # each time get no more than 50 objects
-        finished = False  # will become true after getting all the data
         all_objects = {}  # accumulate all the objects from all the API calls
 
         # default
@@ -372,126 +396,488 @@ class APIClient:
             container_keys = [container_keys]
         for key in container_keys:
             all_objects[key] = []
-        iterations = 0  # number of times we've made an API call
+
+        for api_res in self.__gen_query_pages(command, details_level, container_keys, payload, thread_count, limit,
+                                              adaptive_limit):
+            if not self.__is_query_page(api_res, container_keys):
+                yield api_res
+                return
+
+            for container_key in container_keys:
+                all_objects[container_key] += api_res.data[container_key]
+                api_res.data[container_key] = all_objects[container_key]
+            # yield the current result
+            yield api_res
+
+    def gen_api_objects(self, command, details_level="standard", container_key="objects", payload=None,
+                        thread_count=1, limit=50, adaptive_limit=False, pages=False, stream=False):
+        """
+        This is a generator function that yields the wanted objects as they are received from the management server.
+        Unlike gen_api_query, the objects of a page are not kept after they are yielded, so the caller can process
+        any number of objects with constant memory while the next pages are still arriving.
+
+        :param command: name of API command. This command should be an API that returns an array of objects
+                        (for example: show-hosts, show networks, ...)
+        :param details_level: query APIs always take a details-level argument. Possible values are "standard", "full", "uid"
+        :param container_key: name of the key that holds the objects in the JSON response (usually "objects").
+        :param payload: a JSON object (or a string representing a JSON object) with the command arguments
+        :param thread_count: [optional] number of pages to request at the same time. See gen_api_query.
+        :param limit: [optional] number of objects to request in each API call. See gen_api_query.
+        :param adaptive_limit: [optional] adjust the number of objects per API call. See gen_api_query.
+        :param pages: [optional] if True, yield the list of objects of each page instead of single objects.
+        :param stream: [optional] if True, parse each response while it is read from the socket and yield every
+                       object as soon as it is parsed, instead of reading and parsing the whole page first.
+                       Useful for big pages (e.g. details-level "full"). The pages are requested one after the
+                       other with a fixed page size, and the debug log holds the page's fields without its objects.
+        :yields: the objects (dicts) one by one, or a list of objects per page
+        :raises APIException: if one of the API calls failed
+        """
+        if stream:
+            for obj in self.__gen_streamed_objects(command, details_level, container_key, payload, limit, pages):
+                yield obj
+            return
+
+        for api_res in self.__gen_query_pages(command, details_level, [container_key], payload, thread_count, limit,
+                                              adaptive_limit):
+            if not self.__is_query_page(api_res, [container_key]):
+                if api_res.success is False:
+                    raise APIException(api_res.error_message, api_res.data)
+                # the query returned no objects
+                return
+
+            if pages:
+                yield api_res.data[container_key]
+            else:
+                for obj in api_res.data[container_key]:
+                    yield obj
+
+    def __gen_streamed_objects(self, command, details_level, container_key, payload, limit, pages):
+        """
+        Requests the pages of a query one after the other and yields their objects while each reply is parsed.
+        """
         if payload is None:
             payload = {}
+        payload.update({"details-level": details_level})
+        offset = 0
+        while True:
+            payload.update({"limit": limit, "offset": offset})
+            page_fields = {}
+            page_objects = self.__gen_streamed_page(command, payload, container_key, page_fields)
+            if pages:
+                page = list(page_objects)
+                if page:
+                    yield page
+            else:
+                for obj in page_objects:
+                    yield obj
+
+            # did we get all the objects that we're supposed to get
+            if "to" not in page_fields or "total" not in page_fields or page_fields["to"] >= page_fields["total"] \
+                    or page_fields["to"] <= offset:
+                return
+            offset = page_fields["to"]
+
+    def __gen_streamed_page(self, command, payload, container_key, page_fields):
+        """
+        Requests a single page of a query and yields its objects while the reply body is parsed.
+        The connection goes back to the pool only if the whole body was read.
+
+        :param page_fields: dict that gets the other fields of the reply ("from", "to", "total") after the last object
+        :raises APIException: if the call failed
+        """
+        url, _data, _headers = self.build_request(command, payload, None)
 
-        payload.update({"limit": limit, "offset": iterations * limit, "details-level": details_level})
-        api_res = self.api_call(command, payload)
+        pool_key = self.__pool_key()
+        try:
+            conn, response = self.__open_request(pool_key, url, _data, _headers)
+        except Exception as err:
+            res = self.error_response(err)
+            self.log_api_call(command, payload, url, _headers, res.response())
+            raise APIException(res.error_message, res.data)
+
+        if response.status != 200:
+            try:
+                res = APIResponse.from_http_response(response)
+            except Exception as err:
+                res = self.error_response(err)
+            res.status_code = response.status
+            self.__release_connection(pool_key, conn, not response.will_close)
+            self.log_api_call(command, payload, url, _headers, res.response())
+            raise APIException(res.error_message, res.data)
+
+        parser = JSONStreamParser(response)
+        count = 0
+        keep_alive = False
+        try:
+            for obj in parser.iter_items(container_key):
+                count += 1
+                yield obj
+            keep_alive = not response.will_close and response.read() == ""
+        except ValueError as err:
+            raise APIException("APIResponse received a response which is not a valid JSON.", str(err))
+        finally:
+            self.__release_connection(pool_key, conn, keep_alive)
+            page_fields.update(parser.fields)
+            log_data = dict(parser.fields)
+            log_data[container_key + "-count"] = count
+            self.log_api_call(command, payload, url, _headers, {"status_code": response.status, "data": log_data})
+
+    @staticmethod
+    def __is_query_page(api_res, container_keys):
+        """
+        :return: True if the response holds a non-empty page of a query (a list of objects and a total count)
+        """
         for container_key in container_keys:
             if not api_res.data or container_key not in api_res.data or not isinstance(api_res.data[container_key], list) \
                     or "total" not in api_res.data or api_res.data["total"] == 0:
-                finished = True
-                yield api_res
-                break
+                return False
+        return True
+
+    def __gen_query_pages(self, command, details_level, container_keys, payload, thread_count, limit,
+                          adaptive_limit):
+        """
+        Yields the response of every page of a query, in order.
+        If the first response is not a page of objects (e.g. it failed, or there are no objects), it is the only
+        response yielded.
+
+        :raises APIException: if the request of a page after the first one failed
+        """
+        page_sizer = None
+        if isinstance(adaptive_limit, AdaptivePageSize):
+            page_sizer = adaptive_limit
+        elif adaptive_limit and thread_count <= 1:
+            page_sizer = AdaptivePageSize(limit)
+        if payload is None:
+            payload = {}
+
+        payload.update({"details-level": details_level})
+        api_res = self.__query_page(command, payload, 0, limit, page_sizer)
+        if not self.__is_query_page(api_res, container_keys):
+            yield api_res
+            return
+
+        if thread_count > 1:
+            pages = self.__gen_parallel_pages(command, payload, limit, api_res, thread_count)
+        else:
+            pages = self.__gen_serial_pages(command, payload, limit, api_res, page_sizer)
 
-        # are we done?
-        while not finished:
-            # make the API call, offset should be increased by 'limit' with each iteration
+        for api_res in pages:
             if api_res.success is False:
                 raise APIException(api_res.error_message, api_res.data)
+            yield api_res
 
-            total_objects = api_res.data["total"]  # total number of objects
-            received_objects = api_res.data["to"]  # number of objects we got so far
-            for container_key in container_keys:
-                all_objects[container_key] += api_res.data[container_key]
-                api_res.data[container_key] = all_objects[container_key]
-            # yield the current result
+    def __query_page(self, command, payload, offset, limit, page_sizer=None):
+        """
+        Requests a single page of a query.
+        With a page sizer, the page size is taken from it and updated with the response, and a page that timed out
+        or failed on the server is requested again with a smaller page size.
+
+        :return: APIResponse object
+        """
+        while True:
+            if page_sizer is not None:
+                limit = page_sizer.limit
+            payload.update({"limit": limit, "offset": offset})
+            start = time.time()
+            api_res = self.api_call(command, payload)
+            if page_sizer is None:
+                return api_res
+            page_sizer.update(api_res, time.time() - start)
+            if not page_sizer.should_retry(api_res) or page_sizer.limit >= limit:
+                return api_res
+
+    def __gen_serial_pages(self, command, payload, limit, first_res, page_sizer=None):
+        """
+        Yields the pages of a query one after the other, starting with the response to the first page.
+        The next page is requested only after the current one is consumed.
+        """
+        api_res = first_res
+        while True:
             yield api_res
             # did we get all the objects that we're supposed to get
-            if received_objects == total_objects:
-                break
+            if api_res.success is False or api_res.data["to"] == api_res.data["total"]:
+                return
+            # make the API call, the next page starts after the last object we got
+            api_res = self.__query_page(command, payload, api_res.data["to"], limit, page_sizer)
 
-            iterations += 1
-            payload.update({"limit": limit, "offset": iterations * limit, "details-level": details_level})
-            api_res = self.api_call(command, payload)
+    def __gen_parallel_pages(self, command, payload, limit, first_res, thread_count):
+        """
+        Yields the pages of a query in order, starting with the response to the first page.
+        The first page reports the total number of objects, so all the remaining offsets are known in advance
+        and are requested by thread_count workers at the same time. Pages that arrive out of order are kept
+        until the pages before them are yielded.
+        The offsets are spaced by the size of the first page, not by limit, since the server may return fewer
+        objects per page than requested.
+        """
+        yield first_res
+        if first_res.success is False:
+            return
+
+        total_objects = first_res.data["total"]
+        limit = first_res.data["to"] - first_res.data["from"] + 1
+        if limit <= 0:
+            return
+        # The queue of offsets to request
+        offsets_q = Queue.Queue()
+        # The queue of (offset, APIResponse) results
+        pages_q = Queue.Queue()
+        for offset in range(limit, total_objects, limit):
+            offsets_q.put(offset)
+
+        def fetch_pages():
+            try:
+                while True:
+                    page_offset = offsets_q.get_nowait()
+                    page_payload = dict(payload)
+                    page_payload.update({"limit": limit, "offset": page_offset})
+                    try:
+                        page_res = self.api_call(command, page_payload)
+                    except Exception as err:
+                        page_res = APIResponse("", False, err_message=err)
+                    pages_q.put((page_offset, page_res))
+            except Queue.Empty:
+                # No more offsets.
+                pass
+
+        workers = []
+        for i in range(min(thread_count, offsets_q.qsize())):
+            workers.append(Thread(target=fetch_pages))
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        received_pages = {}
+        try:
+            for offset in range(limit, total_objects, limit):
+                while offset not in received_pages:
+                    page_offset, page_res = pages_q.get()
+                    received_pages[page_offset] = page_res
+                api_res = received_pages.pop(offset)
+                yield api_res
+                if api_res.success is False:
+                    return
+        finally:
+            # stop the workers if the caller stopped early or a page failed
+            try:
+                while True:
+                    offsets_q.get_nowait()
+            except Queue.Empty:
+                pass
+            for w in workers:
+                w.join()
+
+    def build_request(self, command, payload, sid):
+        """
+        Builds the URL, body and headers of an API request.
+
+        :return: tuple of (url, data, headers)
+        """
+        if payload is None:
+            payload = {}
+        # Convert the json payload to a string if needed
+        if isinstance(payload, str):
+            _data = payload
+        elif isinstance(payload, dict):
+            _data = json.dumps(payload, sort_keys=False)
+        else:
+            raise TypeError('Invalid payload type - must be dict/string')
+        # update class members if needed.
+        if sid is None:
+            sid = self.sid
+
+        # Set headers
+        _headers = {
+            "User-Agent": "python-api-wrapper",
+            "Accept": "*/*",
+            "Content-Type": "application/json",
+            "Content-Length": len(_data)
+        }
+
+        # In all API calls (except for 'login') a header containing the Check Point session-id is required.
+        if sid is not None:
+            _headers["X-chkp-sid"] = sid
+
+        url = "/web_api/" + (("v" + str(self.api_version) + "/") if self.api_version else "") + command
+        return url, _data, _headers
+
+    def __open_request(self, pool_key, url, data, headers):
+        """
+        Sends an API request on a keep-alive connection (or a new one) and reads the reply headers.
+        The body of the reply is left for the caller to read, after which the connection should be given to
+        __release_connection.
+
+        :return: tuple of (HTTPSConnection, HTTPResponse)
+        """
+        # get a keep-alive connection, or create a new one
+        conn = self.pool.acquire(pool_key)
+        reused = conn is not None
+        if not reused:
+            conn = self.__new_connection()
+
+        # whether the request was sent, so the server may have carried it out
+        sent = False
+        try:
+            try:
+                conn.request("POST", url, data, headers)
+                sent = True
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error) as err:
+                if not reused or isinstance(err, socket.timeout) or sent and not self.__no_reply(err):
+                    raise
+                # The server closed the idle connection between our calls, before it got the request or before it
+                # replied. Reconnect once and retry. Requests the server may have carried out (e.g. publish) are
+                # not sent twice.
+                conn.close()
+                self.pool.record_reconnect()
+                conn = self.__new_connection()
+                return conn, self.__send_request(conn, url, data, headers)
+        except Exception:
+            conn.close()
+            raise
+
+    @staticmethod
+    def __no_reply(err):
+        """
+        :param err: the exception raised while reading the reply of a request
+        :return: True if the server closed the connection before sending any byte of the reply
+        """
+        if isinstance(err, httplib.BadStatusLine):
+            # httplib raises it with an empty status line (or a message, in newer versions) when no byte arrived
+            return not err.line.strip("'") or err.line.startswith("No status line received")
+        # a reset. a TLS connection that ended without closing the session may have ended in the middle of the reply.
+        return not isinstance(err, ssl.SSLError) and isinstance(err, socket.error) and \
+            err.errno in (errno.ECONNRESET, errno.ECONNABORTED)
+
+    def __release_connection(self, pool_key, conn, keep_alive):
+        """
+        Returns a connection to the pool if its reply was fully read and the server keeps it open, or closes it.
+        """
+        if conn is None:
+            return
+        if keep_alive:
+            self.pool.release(pool_key, conn)
+        else:
+            conn.close()
+
+    @staticmethod
+    def error_response(err):
+        """
+        :param err: the exception raised while sending a request or reading its reply
+        :return: APIResponse object with the error message
+        """
+        if isinstance(err, ValueError) and err.args and err.args[0] == "Fingerprint value mismatch":
+            err_message = "Error: Fingerprint value mismatch:\n" + " Expecting : {}\n".format(
+                err.args[1]) + " Got: {}\n".format(
+                err.args[2]) + "If you trust the new fingerprint, edit the 'fingerprints.txt' file."
+            return APIResponse("", False, err_message=err_message)
+        return APIResponse("", False, err_message=err)
+
+    def log_api_call(self, command, payload, url, headers, response):
+        """
+        Store the request and the reply (for debug purpose).
+        A dict payload is copied, instead of serializing and parsing it again. Queries reuse their payload dict
+        for every page, so it can not be logged by reference.
+        """
+        if isinstance(payload, dict):
+            log_payload = dict(payload)
+        else:
+            log_payload = json.loads(payload) if payload else {}
+
+        # When the command is 'login' we'd like to convert the password to "****" so that it
+        # would not appear as plaintext in the debug file.
+        if command == "login":
+            log_payload["password"] = "****"
+
+        _api_log = {
+            "request": {
+                "url": url,
+                "payload": log_payload,
+                "headers": headers
+            },
+            "response": response
+        }
+        if self.debug_log is not None:
+            self.debug_log.append(_api_log)
+        else:
+            self.api_calls.append(_api_log)
+
+    def __pool_key(self):
+        """returns the key of the connection pool for the current server (tuple)"""
+        return self.server, self.get_port(), self.proxy_host, self.proxy_port
+
+    def __new_connection(self):
+        """
+        Creates a new HTTPS connection to the server (through the proxy if one is configured).
+        The connection verifies the server's fingerprint with the certificate of its own socket when it is opened,
+        so reused connections do not repeat the check and no extra handshake is made for it.
+
+        :return: HTTPSConnection object (not connected yet)
+        """
+        # create https connection
+        if self.proxy_host and self.proxy_port:
+            conn = HTTPSConnection(self.proxy_host, self.proxy_port, timeout=self.timeout, context=self.__ssl_context)
+            conn.set_tunnel(self.server, self.get_port())
+        else:
+            conn = HTTPSConnection(self.server, self.get_port(), timeout=self.timeout, context=self.__ssl_context)
+
+        # Set fingerprint verification
+        conn.fingerprint_verifier = None if self.unsafe else self.get_trusted_fingerprint
+
+        # Set debug level
+        conn.set_debuglevel(self.http_debug_level)
+        return conn
+
+    @staticmethod
+    def __send_request(conn, url, data, headers):
+        """
+        Sends a POST request on the connection and reads the reply headers.
+
+        :return: HTTPResponse object
+        """
+        # Send the data to the server
+        conn.request("POST", url, data, headers)
+        # Get the reply from the server
+        return conn.getresponse()
 
     def get_server_fingerprint(self):
         """
         Initiates an HTTPS connection to the server and extracts the SHA1 fingerprint from the server's certificate.
         :return: string with SHA1 fingerprint (all uppercase letters)
         """
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-
         if self.proxy_host and self.proxy_port:
-            conn = HTTPSConnection(self.proxy_host, self.proxy_port, context=context)
+            conn = HTTPSConnection(self.proxy_host, self.proxy_port, context=self.__ssl_context)
             conn.set_tunnel(self.server, self.get_port())
         else:
-            conn = HTTPSConnection(self.server, self.get_port(), context=context)
+            conn = HTTPSConnection(self.server, self.get_port(), context=self.__ssl_context)
 
-        return conn.get_fingerprint_hash()
+        try:
+            return conn.get_fingerprint_hash()
+        finally:
+            conn.close()
 
     def __wait_for_task(self, task_id):
         """
         When the server needs to perform an API call that may take a long time (e.g. run-script, install-policy,
         publish), the server responds with a 'task-id'.
         Using the show-task API it is possible to check on the status of this task until its completion.
-        Every two seconds, this function will check for the status of the task.
+        The task is checked after 100ms, and then less and less often, up to every two seconds (see TaskWaiter).
         The function will return when the task (and its sub-tasks) are no longer in-progress.
 
         :param task_id: The task identifier.
         :return: APIResponse object (response of show-task command).
         :raises APIException
         """
-        task_complete = False
-        task_result = None
-        in_progress = "in progress"
-
-        # As long as there is a task in progress
-        while not task_complete:
-            # Check the status of the task
-            task_result = self.api_call("show-task", {"task-id": task_id, "details-level": "full"}, self.sid, False)
-
-            attempts_counter = 0
-            while task_result.success is False:
-                if attempts_counter < 5:
-                    attempts_counter += 1
-                    time.sleep(2)
-                    task_result = self.api_call("show-task", {"task-id": task_id, "details-level": "full"},
-                                                self.sid, False)
-                else:
-                    raise APIException(
-                        "ERROR: Failed to handle asynchronous tasks as synchronous, tasks result is undefined",
-                        task_result)
-
-            # Count the number of tasks that are not in-progress
-            completed_tasks = sum(1 for task in task_result.data["tasks"] if task["status"] != in_progress)
-
-            # Get the total number of tasks
-            total_tasks = len(task_result.data["tasks"])
-
-            # Are we done?
-            if completed_tasks == total_tasks:
-                task_complete = True
-            else:
-                time.sleep(2)  # Wait for two seconds
-
-        self.check_tasks_status(task_result)
-        return task_result
+        return self.task_waiter.wait(task_id)
 
     def __wait_for_tasks(self, task_objects):
         """
-        The version of __wait_for_task function for the collection of tasks
+        The version of __wait_for_task function for the collection of tasks.
+        All the tasks are checked together with one show-task call.
 
         :param task_objects: A list of task objects
         :return: APIResponse object (response of show-task command).
         """
-
-        # A list of task ids to be retrieved
-        tasks = []
-        for task_obj in task_objects:
-            # Retrieve the taskId and wait for the task to be completed
-            task_id = task_obj["task-id"]
-            tasks.append(task_id)
-            self.__wait_for_task(task_id)
-
-        task_result = self.api_call("show-task", {"task-id": tasks, "details-level": "full"},
-                                    self.sid, False)
-
-        APIClient.check_tasks_status(task_result)
-        return task_result
+        return self.task_waiter.wait([task_obj["task-id"] for task_obj in task_objects])
 
     @staticmethod
     def check_tasks_status(task_result):
@@ -512,44 +898,87 @@ class APIClient:
         If the server's fingerprint is not found, an HTTPS connection is made to the server
         and the user is asked if he or she accepts the server's fingerprint.
         If the fingerprint is trusted, it is stored in the fingerprint file.
+        The connection used for the check is kept in the connection pool for the next API call.
 
         :return: False if the user does not accept the server certificate, True in all other cases.
         """
-        if self.unsafe:
+        if self.unsafe or self.__get_cached_fingerprint() is not None:
             return True
-        # Read the fingerprint from the local file
-        local_fingerprint = self.read_fingerprint_from_file(self.server)
-        server_fingerprint = self.get_server_fingerprint()
-
-        # If the fingerprint is not stored in the local file
-        if local_fingerprint == "" or \
-                local_fingerprint.replace(':', '').upper() != server_fingerprint.replace(':', '').upper():
-            # Get the server's fingerprint with a socket.
-            if server_fingerprint == "":
-                return False
 
-            if self.unsafe_auto_accept:
-                self.save_fingerprint_to_file(self.server, server_fingerprint)
-                return True
+        conn = self.__new_connection()
+        try:
+            conn.connect()
+        except Exception:
+            conn.close()
+            return False
+        self.pool.release(self.__pool_key(), conn)
+        return True
 
-            if local_fingerprint == "":
-                print("You currently do not have a record of this server's fingerprint.", file=sys.stderr)
-            else:
-                print(
-                    "The server's fingerprint is different from your local record of this server's fingerprint.\n"
-                    "You maybe a victim to a Man-in-the-Middle attack, please beware.", file=sys.stderr)
-            print("Server's fingerprint: {}".format(server_fingerprint), file=sys.stderr)
-
-            if self.ask_yes_no_question("Do you accept this fingerprint?"):
-                if self.save_fingerprint_to_file(self.server, server_fingerprint):
-                    print("Fingerprint saved.", file=sys.stderr)
-                else:
-                    print("Could not save fingerprint to file. Continuing anyway.", file=sys.stderr)
-            else:
-                return False
+    def __get_cached_fingerprint(self):
+        """
+        :return: the fingerprint verified for the current server, or None if it was not verified yet
+                 or the verification expired.
+        """
+        cached = self.__verified_fingerprints.get((self.server, self.get_port()))
+        if cached is None:
+            return None
+        fingerprint, verified_at = cached
+        if self.fingerprint_ttl is not None and time.time() - verified_at > self.fingerprint_ttl:
+            return None
+        return fingerprint
+
+    def get_trusted_fingerprint(self, server_fingerprint):
+        """
+        Called by a new HTTPS connection with the SHA1 fingerprint of the certificate it received.
+        A fingerprint that was already verified in this session is returned from memory. Otherwise, the fingerprint is
+        compared with the local fingerprints file, and the user is asked to accept it if it is not found there.
 
-        self.fingerprint = server_fingerprint  # set the actual fingerprint in the class instance
-        return True
+        :param server_fingerprint: SHA1 fingerprint of the server's certificate
+        :return: the fingerprint trusted for this server. The connection is refused if it is different from
+                 server_fingerprint.
+        """
+        with self.__fingerprint_lock:
+            cached = self.__get_cached_fingerprint()
+            if cached is not None:
+                return cached
+
+            # Read the fingerprint from the local file
+            local_fingerprint = self.read_fingerprint_from_file(self.server)
+
+            # If the fingerprint is not stored in the local file
+            if local_fingerprint == "" or \
+                    local_fingerprint.replace(':', '').upper() != server_fingerprint.replace(':', '').upper():
+                if self.unsafe_auto_accept:
+                    self.save_fingerprint_to_file(self.server, server_fingerprint)
+                elif not self.__ask_to_accept_fingerprint(local_fingerprint, server_fingerprint):
+                    return local_fingerprint
+
+            self.fingerprint = server_fingerprint  # set the actual fingerprint in the class instance
+            self.__verified_fingerprints[(self.server, self.get_port())] = (server_fingerprint, time.time())
+            return server_fingerprint
+
+    def __ask_to_accept_fingerprint(self, local_fingerprint, server_fingerprint):
+        """
+        Asks the user whether to trust a fingerprint that is missing from (or different from) the local file.
+        If the fingerprint is trusted, it is stored in the fingerprint file.
+
+        :return: True if the user accepts the fingerprint
+        """
+        if local_fingerprint == "":
+            print("You currently do not have a record of this server's fingerprint.", file=sys.stderr)
+        else:
+            print(
+                "The server's fingerprint is different from your local record of this server's fingerprint.\n"
+                "You maybe a victim to a Man-in-the-Middle attack, please beware.", file=sys.stderr)
+        print("Server's fingerprint: {}".format(server_fingerprint), file=sys.stderr)
+
+        if self.ask_yes_no_question("Do you accept this fingerprint?"):
+            if self.save_fingerprint_to_file(self.server, server_fingerprint):
+                print("Fingerprint saved.", file=sys.stderr)
+            else:
+                print("Could not save fingerprint to file. Continuing anyway.", file=sys.stderr)
+            return True
+        return False
 
     @staticmethod
     def ask_yes_no_question(question):
@@ -650,11 +1079,23 @@ class HTTPSConnection(httplib.HTTPSConnection):
     """
     A class for making HTTPS connections that overrides the default HTTPS checks (e.g. not accepting
     self-signed-certificates) and replaces them with a server fingerprint check.
+    The fingerprint is checked once, when the socket is opened. Keep-alive requests on the same socket are not
+    checked again.
     """
 
+    # function that gets the SHA1 fingerprint of the socket's certificate and returns the fingerprint trusted for the
+    # server. None to skip the check.
+    fingerprint_verifier = None
+
     def connect(self):
         httplib.HTTPConnection.connect(self)
         self.sock = ssl.wrap_socket(self.sock, self.key_file, self.cert_file, cert_reqs=ssl.CERT_NONE)
+        if self.fingerprint_verifier is not None:
+            actual = hashlib.new("SHA1", self.sock.getpeercert(True)).hexdigest().upper()
+            expected = self.fingerprint_verifier(actual)
+            if expected.replace(':', '').upper() != actual:
+                self.close()
+                raise ValueError("Fingerprint value mismatch", expected, actual)
 
     def get_fingerprint_hash(self):
         try:
@@ -0,0 +1,69 @@
+from array import array
+from collections import namedtuple
+
+# statistics of the queries sent to one name server. latencies are in seconds, of the queries it answered, and are None
+# if it answered none. timeout_rate is the percentage of the queries that were not answered.
+NameserverSummary = namedtuple("NameserverSummary", "queries answered timeouts timeout_rate p50 p95 p99")
+
+
+class NameserverStats:
+    """
+    Latency and timeouts of the queries sent to each name server. The latencies of a name server are kept in an
+    array, so the percentiles are exact.
+    """
+
+    def __init__(self):
+        # name server -> array of the latencies of its answers
+        self.latencies = {}
+        # name server -> number of queries that timed out
+        self.timeouts = {}
+
+    def __server(self, nameserver):
+        if nameserver not in self.latencies:
+            self.latencies[nameserver] = array("d")
+            self.timeouts[nameserver] = 0
+
+    def add(self, nameserver, latency):
+        """
+        Records a query that the name server answered (whatever its answer).
+
+        :param nameserver: IP address of the name server
+        :param latency: seconds from the query to the answer
+        """
+        self.__server(nameserver)
+        self.latencies[nameserver].append(latency)
+
+    def add_timeout(self, nameserver):
+        """records a query that the name server did not answer in time"""
+        self.__server(nameserver)
+        self.timeouts[nameserver] += 1
+
+    @staticmethod
+    def percentile(values, percent):
+        """
+        :param values: sorted list of values
+        :param percent: 0 - 100
+        :return: the nearest-rank percentile of the values, or None if there are none
+        """
+        if not values:
+            return None
+        rank = int(-(-percent * len(values) // 100))
+        return values[max(0, rank - 1)]
+
+    def summary(self, nameserver):
+        """
+        :param nameserver: IP address of the name server
+        :return: NameserverSummary of the name server
+        """
+        latencies = sorted(self.latencies.get(nameserver, ()))
+        timeouts = self.timeouts.get(nameserver, 0)
+        queries = len(latencies) + timeouts
+        return NameserverSummary(queries, len(latencies), timeouts, 100.0 * timeouts / queries if queries else 0.0,
+                                 self.percentile(latencies, 50), self.percentile(latencies, 95),
+                                 self.percentile(latencies, 99))
+
+    def summaries(self):
+        """
+        :return: dict of name server -> NameserverSummary, of all the name servers that were queried
+        """
+        return dict((nameserver, self.summary(nameserver)) for nameserver in self.latencies)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import sqlite3
+
+
+# the query commands of the object types a snapshot can hold
+OBJECT_COMMANDS = {"host": "show-hosts", "network": "show-networks", "address-range": "show-address-ranges"}
+
+
+def object_hash(obj):
+    """
+    :param obj: management object (dict)
+    :return: SHA-1 hex digest of its content, the same whatever the order of its keys
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+
+
+def last_modify_time(obj):
+    """
+    :param obj: management object (dict) with meta-info (details-level "full")
+    :return: (posix time in milliseconds, ISO 8601 string) of its last modification on the server, or (None, None)
+    """
+    modified = obj.get("meta-info", {}).get("last-modify-time", {})
+    return modified.get("posix"), modified.get("iso-8601")
+
+
+class ObjectSnapshot:
+    """
+    A local copy of management objects, keyed by uid, with the last-modify time of every object (from its meta-info,
+    by the clock of the server) and a hash of its content. See sync_snapshot, which keeps it up to date from the changes
+    on the server, so recurring jobs don't download all the objects again.
+    The snapshot is an SQLite database, which locks the file, so several processes can use it at the same time.
+    An ObjectSnapshot object must be used by one thread.
+    """
+
+    def __init__(self, path, busy_timeout=30):
+        """
+        Init function of Class
+        :param path: the snapshot file (created if it does not exist)
+        :param busy_timeout: seconds to wait for the other writers of the file
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=busy_timeout)
+        self.conn.text_factory = str
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS objects (uid TEXT PRIMARY KEY, type TEXT NOT NULL, "
+                              "last_modify INTEGER, last_modify_iso TEXT, hash TEXT NOT NULL, data TEXT NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS objects_type ON objects (type)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS synced_types (type TEXT PRIMARY KEY)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """destructor"""
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def get(self, uid):
+        """
+        :param uid: uid of the object
+        :return: the object (dict), or None if it is not in the snapshot
+        """
+        row = self.conn.execute("SELECT data FROM objects WHERE uid = ?", (uid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def objects(self, object_type):
+        """
+        :param object_type: type of the objects (e.g. "host")
+        :yields: the objects (dicts) of the type
+        """
+        for row in self.conn.execute("SELECT data FROM objects WHERE type = ?", (object_type,)):
+            yield json.loads(row[0])
+
+    def is_synced(self, object_type):
+        """returns whether all the objects of the type were downloaded once (see sync_snapshot)"""
+        return self.conn.execute("SELECT 1 FROM synced_types WHERE type = ?", (object_type,)).fetchone() is not None
+
+    def last_modify(self, object_types):
+        """
+        :param object_types: list of object types
+        :return: the ISO 8601 time of the last modification of the objects of the types, or None if there are none
+        """
+        row = self.conn.execute("SELECT last_modify_iso FROM objects WHERE last_modify IS NOT NULL AND type IN (%s) "
+                                "ORDER BY last_modify DESC LIMIT 1" % ",".join("?" * len(object_types)),
+                                list(object_types)).fetchone()
+        return row[0] if row else None
+
+    def merge(self, obj, object_type=None):
+        """
+        Adds or updates an object. An object that is older than the one in the snapshot (by last-modify time) is
+        ignored.
+
+        :param obj: management object (dict), with its uid
+        :param object_type: [optional] type of the object, when obj has no "type"
+        :return: True if the object was added or changed, False otherwise
+        """
+        content_hash = object_hash(obj)
+        posix, iso = last_modify_time(obj)
+        row = self.conn.execute("SELECT last_modify, hash FROM objects WHERE uid = ?", (obj["uid"],)).fetchone()
+        if row is not None and (row[1] == content_hash or
+                                (posix is not None and row[0] is not None and posix < row[0])):
+            return False
+        self.conn.execute("INSERT OR REPLACE INTO objects (uid, type, last_modify, last_modify_iso, hash, data) "
+                          "VALUES (?, ?, ?, ?, ?, ?)",
+                          (obj["uid"], obj.get("type", object_type), posix, iso, content_hash, json.dumps(obj)))
+        return True
+
+    def delete(self, uid):
+        """
+        Removes an object.
+
+        :return: True if it was in the snapshot
+        """
+        return self.conn.execute("DELETE FROM objects WHERE uid = ?", (uid,)).rowcount > 0
+
+    def replace(self, object_type, objects):
+        """
+        Replaces all the objects of a type, e.g. with the result of a full query. The objects are merged, and the
+        objects of the type that are not in objects are removed.
+
+        :param object_type: type of the objects
+        :param objects: iterable of the objects (dicts)
+        :return: (number of objects added or changed, number of objects removed)
+        """
+        changed = 0
+        with self.conn:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (uid TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM seen")
+            for obj in objects:
+                self.conn.execute("INSERT OR IGNORE INTO seen (uid) VALUES (?)", (obj["uid"],))
+                if self.merge(obj, object_type):
+                    changed += 1
+            deleted = self.conn.execute("DELETE FROM objects WHERE type = ? AND uid NOT IN (SELECT uid FROM seen)",
+                                        (object_type,)).rowcount
+            self.conn.execute("INSERT OR IGNORE INTO synced_types (type) VALUES (?)", (object_type,))
+        return changed, deleted
+
+    def apply_changes(self, changes, object_types):
+        """
+        Merges the result of the show-changes command: the added and modified objects of the types are merged, and
+        the deleted ones are removed.
+
+        :param changes: the tasks of the response of show-changes (with their task-details)
+        :param object_types: the object types kept in the snapshot
+        :return: (number of objects added or changed, number of objects removed)
+        """
+        changed = deleted = 0
+        with self.conn:
+            for task in changes:
+                for details in task.get("task-details", []):
+                    for change in details.get("changes", []):
+                        operations = change.get("operations", {})
+                        new_objects = operations.get("added-objects", []) + \
+                            [modified.get("new-object", {}) for modified in operations.get("modified-objects", [])]
+                        for obj in new_objects:
+                            if obj.get("type") in object_types and "uid" in obj and self.merge(obj):
+                                changed += 1
+                        for obj in operations.get("deleted-objects", []):
+                            if obj.get("type") in object_types and "uid" in obj and self.delete(obj["uid"]):
+                                deleted += 1
+        return changed, deleted
+
+    def close(self):
+        """commits the changes that are not committed yet (of merge and delete) and closes the file"""
+        self.conn.commit()
+        self.conn.close()
+
+
+def sync_snapshot(client, snapshot, object_types=("host",), full=False):
+    """
+    Brings a snapshot up to date with the management server.
+    When all the types were downloaded once, only the changes since the last modification in the snapshot are
+    downloaded, with the show-changes command (a few API calls). Otherwise, or with full, or if show-changes fails
+    (e.g. on an older server), all the objects of the types are downloaded with their meta-info, and the objects that
+    are gone from the server are removed.
+
+    :param client: logged in APIClient
+    :param snapshot: ObjectSnapshot object
+    :param object_types: the types of the objects, keys of OBJECT_COMMANDS
+    :param full: download all the objects
+    :return: ("delta" or "full", number of objects added or changed, number of objects removed)
+    :raises APIException: if the objects can not be downloaded
+    """
+    since = snapshot.last_modify(object_types)
+    if not full and since is not None and all(snapshot.is_synced(object_type) for object_type in object_types):
+        changes_res = client.api_call("show-changes", {"from-date": since})
+        if changes_res.success and changes_res.data.get("tasks") and \
+                all(task.get("status") == "succeeded" for task in changes_res.data["tasks"]):
+            changed, deleted = snapshot.apply_changes(changes_res.data["tasks"], object_types)
+            return "delta", changed, deleted
+
+    changed = deleted = 0
+    for object_type in object_types:
+        type_changed, type_deleted = snapshot.replace(
+            object_type, client.gen_api_objects(OBJECT_COMMANDS[object_type], "full"))
+        changed += type_changed
+        deleted += type_deleted
+    return "full", changed, deleted
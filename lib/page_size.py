@@ -0,0 +1,55 @@
+class AdaptivePageSize:
+    """
+    Chooses the 'limit' of the next page of a paginated query.
+    The page size grows while the responses stay below the latency and payload size targets, and shrinks when a
+    response is too slow, too big, timed out or failed on the server side.
+    """
+
+    # the management API does not return more than 500 objects per page
+    MAX_LIMIT = 500
+
+    def __init__(self, limit=50, min_limit=10, max_limit=MAX_LIMIT, target_latency=2.0, target_size=4 * 1024 * 1024):
+        """
+        Init function of Class
+        :param limit: page size of the first page
+        :param min_limit: the page size never goes below this value
+        :param max_limit: the page size never goes above this value
+        :param target_latency: seconds a single page request may take
+        :param target_size: bytes a single page response may take
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.target_size = target_size
+        self.limit = max(min_limit, min(limit, max_limit))
+
+    @staticmethod
+    def should_retry(api_res):
+        """
+        :param api_res: APIResponse of a page request
+        :return: True if the request failed in a way that a smaller page may fix (no reply at all, e.g. a timeout,
+                 or a server error)
+        """
+        return api_res.success is False and (api_res.status_code is None or api_res.status_code >= 500)
+
+    def update(self, api_res, latency):
+        """
+        Adjusts the page size after a page request.
+
+        :param api_res: APIResponse of the request
+        :param latency: seconds the request took
+        :return: the page size for the next request
+        """
+        if api_res.success is False:
+            if self.should_retry(api_res):
+                self.limit = max(self.min_limit, self.limit // 2)
+            return self.limit
+
+        size = api_res.size or 0
+        # how far the response is from the targets. below 1 there's room to grow, above 1 the page is too big.
+        load = max(latency / self.target_latency, float(size) / self.target_size)
+        if load > 1:
+            self.limit = max(self.min_limit, int(self.limit / load))
+        elif load < 0.5:
+            self.limit = min(self.max_limit, self.limit * 2)
+        return self.limit
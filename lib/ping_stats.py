@@ -0,0 +1,104 @@
+from array import array
+from collections import namedtuple
+
+# statistics of the probes of one host. rtt values are in seconds, and are None if the host did not reply.
+# loss is the percentage of the probes that were not answered. method is the kind of probe the host answered
+# (e.g. "icmp" or "tcp/443"), or None.
+PingResult = namedtuple("PingResult", "sent received loss min avg max jitter method")
+
+
+class PingStats:
+    """
+    Probe statistics of all the hosts of a sweep, kept in parallel arrays indexed by the position of the host in the
+    sweep, so a sweep of many hosts does not allocate an object for every probe.
+    Jitter is the mean difference between the round trip times of consecutive replies.
+    """
+
+    def __init__(self):
+        self.sent = array("i")
+        self.received = array("i")
+        self.rtt_min = array("d")
+        self.rtt_max = array("d")
+        self.rtt_avg = array("d")
+        self.jitter = array("d")
+        # index in method_names of the method each host answered
+        self.method = array("H")
+        self.method_names = [None]
+        # rtt of the last reply, to compute the jitter
+        self.__last = array("d")
+
+    def __len__(self):
+        return len(self.sent)
+
+    def __grow(self, index):
+        """makes room for the host at index"""
+        missing = index + 1 - len(self.sent)
+        if missing > 0:
+            for arr in (self.sent, self.received, self.method):
+                arr.extend([0] * missing)
+            for arr in (self.rtt_min, self.rtt_max, self.rtt_avg, self.jitter, self.__last):
+                arr.extend([0.0] * missing)
+
+    def add(self, index, rtt):
+        """
+        Records the result of a probe.
+
+        :param index: index of the host
+        :param rtt: round trip time in seconds, or None if the probe was not answered
+        """
+        self.__grow(index)
+        self.sent[index] += 1
+        if rtt is None:
+            return
+        received = self.received[index] + 1
+        self.received[index] = received
+        if received == 1:
+            self.rtt_min[index] = self.rtt_max[index] = self.rtt_avg[index] = rtt
+        else:
+            self.rtt_min[index] = min(self.rtt_min[index], rtt)
+            self.rtt_max[index] = max(self.rtt_max[index], rtt)
+            self.rtt_avg[index] += (rtt - self.rtt_avg[index]) / received
+            self.jitter[index] += (abs(rtt - self.__last[index]) - self.jitter[index]) / (received - 1)
+        self.__last[index] = rtt
+
+    def set(self, index, sent, received, rtt_min=None, rtt_avg=None, rtt_max=None, jitter=None):
+        """
+        Records the summary of all the probes of a host (e.g. as reported by the ping command).
+        Unknown rtt values are None.
+        """
+        self.__grow(index)
+        self.sent[index] = sent
+        self.received[index] = received
+        nan = float("nan")
+        self.rtt_min[index] = nan if rtt_min is None else rtt_min
+        self.rtt_avg[index] = nan if rtt_avg is None else rtt_avg
+        self.rtt_max[index] = nan if rtt_max is None else rtt_max
+        self.jitter[index] = nan if jitter is None else jitter
+
+    def set_method(self, index, method):
+        """
+        Records the kind of probe the host answered.
+
+        :param index: index of the host
+        :param method: name of the method (e.g. "icmp" or "tcp/443")
+        """
+        self.__grow(index)
+        if method not in self.method_names:
+            self.method_names.append(method)
+        self.method[index] = self.method_names.index(method)
+
+    def result(self, index):
+        """
+        :param index: index of the host
+        :return: PingResult of the host
+        """
+        sent = self.sent[index]
+        received = self.received[index]
+        loss = 100.0 * (sent - received) / sent if sent else 100.0
+
+        def value(arr):
+            # NaN is not equal to itself
+            return arr[index] if received and arr[index] == arr[index] else None
+
+        return PingResult(sent, received, loss, value(self.rtt_min), value(self.rtt_avg), value(self.rtt_max),
+                          value(self.jitter), self.method_names[self.method[index]])
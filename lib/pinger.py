@@ -1,88 +1,507 @@
 from __future__ import print_function
-from threading import Thread
+from array import array
+from collections import deque
+from threading import Thread, Event, Lock
 import subprocess
+import multiprocessing
 import Queue
 import platform
+import math
 import os
+import re
+import socket
+import time
+import traceback
+
+from address_space import address_family
+from icmp import ICMPSocket
+from ping_stats import PingStats
+from sweep import INPUT_POLL, PingSweep, TCPSweep
+
+# the summary lines of the ping command
+LINUX_COUNTS = re.compile(r"(\d+) packets transmitted, (\d+) (?:packets )?received")
+LINUX_RTT = re.compile(r"= ([\d.]+)/([\d.]+)/([\d.]+)/([\d.]+) ms")
+WINDOWS_COUNTS = re.compile(r"Sent = (\d+), Received = (\d+)")
+WINDOWS_RTT = re.compile(r"Minimum = (\d+)ms, Maximum = (\d+)ms, Average = (\d+)ms")
+
+# maximum number of results in a message from a sweep process (and of addresses in a message to it), and seconds a
+# result may wait for the rest of them
+SHARD_BATCH_SIZE = 512
+SHARD_BATCH_DELAY = 0.2
+# maximum number of messages waiting for the main process
+SHARD_QUEUE_SIZE = 256
 
 
 class Pinger:
-    def __init__(self, thread_count, ip_list):
+    def __init__(self, thread_count, ip_list, use_icmp=True, window=4096, rate=None, count=1, interval=1.0,
+                 timeout=1.0, methods=("icmp",), ports=(80, 443, 22), processes=1):
+        """
+        Init function of Class
+        :param thread_count: number of ping subprocesses to run at the same time
+        :param ip_list: List of IP addresses (IPv4 or IPv6). Any iterable is consumed lazily, and may yield None when no
+                        address is available yet (see sweep.INPUT_POLL).
+        :param use_icmp: send the echo requests from this process when ICMP sockets are available, instead of running
+                         a ping subprocess per address
+        :param window: number of hosts probed in-process at the same time, and of the addresses read ahead for the ping
+                       subprocesses
+        :param rate: maximum in-process echo requests per second (None - no limit)
+        :param count: number of echo requests sent to each address
+        :param interval: seconds between the echo requests sent to an address
+        :param timeout: seconds to wait for each reply
+        :param methods: the kinds of probes to send, in order: "icmp" (echo requests) and "tcp" (connections to
+                        'ports'). An address is probed with the next method only if it did not answer the previous one.
+        :param ports: the ports "tcp" probes connect to
+        :param processes: number of processes to split ip_list between. Every process runs its own sweep, with its own
+                          window, and thread_count and rate are split between them.
+        """
         self.thread_count = thread_count
         self.ip_list = ip_list
-        # The queue of addresses to ping
-        self.ips_q = Queue.Queue()
+        self.use_icmp = use_icmp
+        self.window = window
+        self.rate = rate
+        self.count = count
+        self.interval = interval
+        self.timeout = timeout
+        self.methods = methods
+        self.ports = ports
+        self.processes = processes
+        # The queue of (index, address) to ping, then a None for every thread
+        self.ips_q = Queue.Queue(window)
         # The queue of results
         self.out_q = Queue.Queue()
+        # statistics of the addresses, by their position in ip_list
+        self.stats = PingStats()
 
     @ staticmethod
-    def determine_platform_ping_arg():
+    def determine_platform_ping_arg(count=1, interval=1.0, timeout=1.0, family=socket.AF_INET):
         """
         Provides ping arguments based on platform of device executing program.
         Needed due to differences between OS ping options
+        :param count: number of echo requests
+        :param interval: seconds between the echo requests (not supported on Windows)
+        :param timeout: seconds to wait for each reply
+        :param family: socket.AF_INET to ping IPv4 addresses, socket.AF_INET6 to ping IPv6 addresses
         :return: list of ping with arguments
         """
         # Platform determination for ping command arguments
         plat = platform.system()
         if plat == 'Windows':
-            ping_args = ["ping", "-n", "1", "-w", "1"]
+            ping_args = ["ping", "-n", str(count), "-w", str(int(timeout * 1000))]
         elif plat == 'Linux':
-            ping_args = ["ping", "-c", "1", "-w", "1"]
+            ping_args = ["ping", "-c", str(count), "-i", str(interval), "-W", str(int(math.ceil(timeout)))]
         else:
             raise ValueError("Unknown platform")
+        if family == socket.AF_INET6:
+            ping_args.insert(1, "-6")
         return ping_args
 
+    def parse_ping_output(self, output, return_code):
+        """
+        Reads the summary that the ping command prints at the end.
+        :param output: the standard output of ping
+        :param return_code: the exit code of ping, used when the summary can not be read
+        :return: (sent, received, rtt_min, rtt_avg, rtt_max, jitter) tuple. rtt values are in seconds, or None if
+                 unknown.
+        """
+        counts = LINUX_COUNTS.search(output) or WINDOWS_COUNTS.search(output)
+        if counts is None:
+            return self.count, 0 if return_code else self.count, None, None, None, None
+        sent, received = int(counts.group(1)), int(counts.group(2))
+        rtt = LINUX_RTT.search(output)
+        if rtt is not None:
+            rtt_min, rtt_avg, rtt_max, mdev = [float(value) / 1000 for value in rtt.groups()]
+            return sent, received, rtt_min, rtt_avg, rtt_max, mdev
+        rtt = WINDOWS_RTT.search(output)
+        if rtt is not None:
+            rtt_min, rtt_max, rtt_avg = [float(value) / 1000 for value in rtt.groups()]
+            return sent, received, rtt_min, rtt_avg, rtt_max, None
+        return sent, received, None, None, None, None
+
     def ping(self):
         """
         ping function wrapper for threads
         :return: None
         """
+        ping_args = dict((family, self.determine_platform_ping_arg(self.count, self.interval, self.timeout, family))
+                         for family in (socket.AF_INET, socket.AF_INET6))
+        # os.devnull used to send output to null
+        limbo = open(os.devnull, "wb")
         try:
             while True:
-                # get an IP item from queue
-                address = self.ips_q.get_nowait()
+                # get an IP item from queue. None - no more addresses.
+                item = self.ips_q.get()
+                if item is None:
+                    break
+                index, address = item
 
                 # ping IP address
-                # os.devnull used to send output to null
-                with open(os.devnull, "wb") as limbo:
-                    result = subprocess.Popen(self.determine_platform_ping_arg() + [address], stdout=limbo,
-                                              stderr=limbo).wait()
-                    # add results to output queue
-                    if result:
-                        self.out_q.put((address, "inactive"))
-                    else:
-                        self.out_q.put((address, "active"))
-        except Queue.Empty:
-            # No more addresses.
-            pass
+                try:
+                    process = subprocess.Popen(ping_args[address_family(address)] + [address],
+                                               stdout=subprocess.PIPE, stderr=limbo)
+                    output = process.communicate()[0]
+                except OSError:
+                    # ping could not run (e.g. it is not installed, or no process can be started now). the address
+                    # did not answer.
+                    self.out_q.put((index, address, self.parse_ping_output("", 1)))
+                    continue
+                # add results to output queue
+                self.out_q.put((index, address, self.parse_ping_output(output, process.returncode)))
         finally:
+            limbo.close()
             self.out_q.put(None)
 
-    def start_ping(self):
+    def iter_ping(self):
+        """
+        Probes the list of IP addresses and yields each result as soon as all the probes of an address finish.
+        Echo requests are sent from an in-process ICMP socket when possible, and from ping subprocesses otherwise.
+        The statistics of every address are also kept in 'stats', by the position of the address in ip_list. They are
+        the statistics of the method the address answered.
+        :return: generator of (address, status, result) tuples. status is "active" if any probe was answered and
+                 "inactive" otherwise, result is a PingResult with the loss and the round trip times of the address,
+                 and the method it answered
+        """
+        for index, address, status, result in self.iter_indexed():
+            yield address, status, result
+
+    def iter_indexed(self):
+        """
+        Same as iter_ping, with the position of the address in ip_list.
+        :return: generator of (index, address, status, result) tuples
+        """
+        if self.processes > 1:
+            for item in self.__iter_shards():
+                yield item
+            return
+
+        # (index, address) of the addresses that did not answer the methods so far
+        unanswered = self.__enumerate()
+        for method in self.methods:
+            last_method = method == self.methods[-1]
+            probed = self.__icmp_probes(unanswered) if method == "icmp" else self.__tcp_probes(unanswered)
+            unanswered = []
+            for index, address in probed:
+                if self.stats.received[index] or last_method:
+                    yield (index,) + self.__result(index, address)
+                else:
+                    unanswered.append((index, address))
+
+    def __enumerate(self):
+        """
+        :return: generator of (index, address) of ip_list. None (no address available yet) is passed on as it is.
+        """
+        index = 0
+        for address in self.ip_list:
+            if address is None:
+                yield None
+                continue
+            yield index, address
+            index += 1
+
+    def __iter_shards(self):
+        """
+        Splits ip_list between 'processes' worker processes, each running its own sweep, and merges their results.
+        Worker n probes the addresses n, n + processes, n + 2 * processes, ... The addresses are sent to the workers
+        in batches as they are read from ip_list, so the workers start probing before ip_list ends.
+        :return: generator of (index, address, status, result) tuples
+        """
+        # The queues of the addresses of every worker, in batches, then None
+        in_qs = [multiprocessing.Queue() for shard in range(self.processes)]
+        # The queue of results. Workers wait while it is full.
+        out_q = multiprocessing.Queue(SHARD_QUEUE_SIZE)
+        workers = []
+        for shard in range(self.processes):
+            shard_args = dict(thread_count=max(1, self.thread_count // self.processes), use_icmp=self.use_icmp,
+                              window=self.window, rate=float(self.rate) / self.processes if self.rate else None,
+                              count=self.count, interval=self.interval, timeout=self.timeout, methods=self.methods,
+                              ports=self.ports)
+            workers.append(multiprocessing.Process(target=sweep_shard, args=(shard, shard_args, in_qs[shard], out_q)))
+
+        # Start all the workers
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        addresses = iter(self.ip_list)
+        exhausted = False
+        # number of addresses sent to the workers, and of the addresses of every worker that were not probed yet. A
+        # worker gets no more addresses than its window, and a batch more, so ip_list is read as the workers go.
+        sent = 0
+        in_flight = [0] * self.processes
+        max_in_flight = self.window + SHARD_BATCH_SIZE
+        # whether all the workers read all their addresses, and finished
+        finished = False
+        try:
+            # every worker puts None in the output queue when it's done
+            running = len(workers)
+            while running:
+                fed = False
+                if not exhausted:
+                    batches = [[] for in_q in in_qs]
+                    started = time.time()
+                    while in_flight[sent % self.processes] < max_in_flight:
+                        try:
+                            address = next(addresses)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        if address is None:
+                            # no address is available yet
+                            break
+                        batches[sent % self.processes].append(address)
+                        in_flight[sent % self.processes] += 1
+                        sent += 1
+                        # send the batches when they are full, or when ip_list is slow
+                        if sent % (SHARD_BATCH_SIZE * self.processes) == 0 or \
+                                time.time() - started >= SHARD_BATCH_DELAY:
+                            break
+                    for in_q, batch in zip(in_qs, batches):
+                        if batch:
+                            in_q.put(batch)
+                            fed = True
+                    if exhausted:
+                        for in_q in in_qs:
+                            in_q.put(None)
+
+                # wait for the results only when there are no addresses to send
+                try:
+                    if fed:
+                        item = out_q.get_nowait()
+                    else:
+                        item = out_q.get(timeout=None if exhausted else INPUT_POLL)
+                except Queue.Empty:
+                    continue
+                if item is None:
+                    running -= 1
+                    continue
+                shard, results = item
+                if not isinstance(results, list):
+                    raise RuntimeError("Ping worker {} failed:\n{}".format(shard, results))
+                in_flight[shard] -= len(results)
+                for shard_index, address, result in results:
+                    index = shard_index * self.processes + shard
+                    self.stats.set(index, result.sent, result.received, result.min, result.avg, result.max,
+                                   result.jitter)
+                    if result.method is not None:
+                        self.stats.set_method(index, result.method)
+                    yield (index,) + self.__result(index, address)
+            finished = True
+        finally:
+            # if the caller stopped early, stop the workers
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+                w.join()
+            for in_q in in_qs:
+                if not finished:
+                    # the workers were stopped. read back the addresses they did not read, so they are not sent to
+                    # a closed pipe, and don't wait for the queue.
+                    try:
+                        while True:
+                            in_q.get(timeout=INPUT_POLL)
+                    except Queue.Empty:
+                        pass
+                    in_q.cancel_join_thread()
+                in_q.close()
+                in_q.join_thread()
+
+    def __icmp_probes(self, addresses):
         """
-        Thread function to ping list of IP addresses
-        :return: output queue as deque list (list of tuples)
+        Sends echo requests to the addresses and records their statistics.
+        :param addresses: iterable of (index, address), or None when no address is available yet
+        :return: generator of (index, address) of the addresses as soon as all their probes finish
         """
+        if self.use_icmp and ICMPSocket.available():
+            # the index of every address of the sweep
+            indexes = array("i")
+
+            def gen_addresses():
+                for item in addresses:
+                    if item is None:
+                        yield None
+                        continue
+                    indexes.append(item[0])
+                    yield item[1]
+
+            sweep = PingSweep(timeout=self.timeout, max_outstanding=self.window, rate=self.rate, count=self.count,
+                              interval=self.interval)
+            for sweep_index, address, probe, rtt in sweep.run_probes(gen_addresses()):
+                index = indexes[sweep_index]
+                self.stats.add(index, rtt)
+                if probe == self.count - 1:
+                    if self.stats.received[index]:
+                        self.stats.set_method(index, "icmp")
+                    yield index, address
+            return
 
         # create the workers
         workers = []
         for i in range(self.thread_count):
             workers.append(Thread(target=self.ping))
 
-        # put all of the IPs in the ips_q queue
-        for ip in self.ip_list:
-            self.ips_q.put(ip)
-
         # Start all the workers
         for w in workers:
             w.daemon = True
             w.start()
 
-        # wait until worker threads are done to exit
-        for w in workers:
-            w.join()
+        addresses = iter(addresses)
+        exhausted = False
+        # the items read from addresses that did not fit in ips_q yet, then a None for every worker
+        unsent = deque()
+        # every worker puts None in the output queue when it's done
+        running = len(workers)
+        try:
+            while running:
+                # read the addresses while ips_q has room, so they are read as the workers go
+                while True:
+                    if not unsent:
+                        if exhausted:
+                            break
+                        try:
+                            item = next(addresses)
+                        except StopIteration:
+                            exhausted = True
+                            unsent.extend([None] * len(workers))
+                            continue
+                        if item is None:
+                            # no address is available yet
+                            break
+                        unsent.append(item)
+                    try:
+                        self.ips_q.put_nowait(unsent[0])
+                    except Queue.Full:
+                        break
+                    unsent.popleft()
+
+                try:
+                    item = self.out_q.get(timeout=None if exhausted and not unsent else INPUT_POLL)
+                except Queue.Empty:
+                    continue
+                if item is None:
+                    running -= 1
+                    continue
+                index, address, summary = item
+                self.stats.set(index, *summary)
+                if self.stats.received[index]:
+                    self.stats.set_method(index, "icmp")
+                yield index, address
+        finally:
+            if running:
+                # the caller stopped early. drop the addresses that were not pinged, and stop the workers.
+                try:
+                    while True:
+                        self.ips_q.get_nowait()
+                except Queue.Empty:
+                    pass
+                for w in workers:
+                    self.ips_q.put(None)
+
+    def __tcp_probes(self, addresses):
+        """
+        Connects to the ports of the addresses and records their statistics.
+        :param addresses: iterable of (index, address), or None when no address is available yet
+        :return: generator of (index, address) of the addresses as soon as they are known
+        """
+        # the index of every address of the sweep
+        indexes = array("i")
+
+        def gen_addresses():
+            for item in addresses:
+                if item is None:
+                    yield None
+                    continue
+                indexes.append(item[0])
+                yield item[1]
+
+        sweep = TCPSweep(self.ports, timeout=self.timeout, max_outstanding=self.window, rate=self.rate)
+        for sweep_index, address, method, rtt in sweep.run_probes(gen_addresses()):
+            index = indexes[sweep_index]
+            if method is not None:
+                self.stats.set(index, 1, 1, rtt, rtt, rtt)
+                self.stats.set_method(index, method)
+            elif index >= len(self.stats) or not self.stats.sent[index]:
+                # not probed by another method
+                self.stats.set(index, 1, 0)
+            yield index, address
+
+    def __result(self, index, address):
+        result = self.stats.result(index)
+        return address, "active" if result.received else "inactive", result
+
+    def start_ping(self, callback=None):
+        """
+        Function to ping list of IP addresses
+        :param callback: [optional] function called with (address, status, result) as soon as each address finishes
+        :return: deque list of (address, status) tuples
+        """
+        results = deque()
+        for address, status, result in self.iter_ping():
+            if callback is not None:
+                callback(address, status, result)
+            results.append((address, status))
+        return results
+
+
+def shard_addresses(in_q):
+    """
+    :param in_q: multiprocessing.Queue of the batches of addresses of a worker, then None
+    :return: generator of the addresses, which yields None when the next batch did not arrive yet
+    """
+    while True:
+        try:
+            batch = in_q.get_nowait()
+        except Queue.Empty:
+            yield None
+            continue
+        if batch is None:
+            return
+        for address in batch:
+            yield address
+
+
+def sweep_shard(shard, shard_args, in_q, out_q):
+    """
+    process function of a sharded sweep. Probes the addresses of in_q, and sends the results in batches to out_q, as
+    (shard, list of (index, address, result)), then None. A batch is sent when it is full, or at most
+    SHARD_BATCH_DELAY seconds after the last one. If the sweep fails, sends (shard, traceback) instead.
+    :param shard: number of the worker
+    :param shard_args: dict of the Pinger arguments of the worker, without ip_list
+    :param in_q: multiprocessing.Queue of the addresses (see shard_addresses)
+    :param out_q: multiprocessing.Queue of the results
+    :return: None
+    """
+    batch = []
+    lock = Lock()
+    done = Event()
+
+    def flush():
+        with lock:
+            if batch:
+                out_q.put((shard, list(batch)))
+                del batch[:]
+
+    def flush_on_timer():
+        # results of a quiet sweep are not held back until its next result
+        while not done.wait(SHARD_BATCH_DELAY):
+            flush()
 
-        return self.out_q.queue
+    flusher = Thread(target=flush_on_timer)
+    flusher.daemon = True
+    flusher.start()
+    try:
+        for index, address, status, result in Pinger(ip_list=shard_addresses(in_q), **shard_args).iter_indexed():
+            with lock:
+                batch.append((index, address, result))
+                full = len(batch) >= SHARD_BATCH_SIZE
+            if full:
+                flush()
+        done.set()
+        flusher.join()
+        flush()
+    except Exception:
+        done.set()
+        out_q.put((shard, traceback.format_exc()))
+    finally:
+        out_q.put(None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+import time
+import traceback
+from threading import Thread, Event
+import Queue
+
+# seconds a stage waits for the next batch of items before it checks whether the pipeline stopped
+POLL_INTERVAL = 0.05
+# maximum number of items in a batch passed between two stages, and seconds an item may wait for the rest of its batch
+BATCH_SIZE = 256
+BATCH_DELAY = 0.05
+
+# marks the end of the items of a stage
+_END = object()
+
+
+class Stage:
+    """
+    A stage of a Pipeline, with its throughput counters. The stage that spends the least time waiting for the
+    stages around it is the bottleneck (see busy).
+    """
+
+    def __init__(self, name, func, poll=False):
+        """
+        Init function of Class
+        :param name: name of the stage
+        :param func: function that takes the iterable of the items of the previous stage (None for the first stage),
+                     and returns the iterable of the items of this stage. It runs in its own thread.
+        :param poll: give func None right away when no item of the previous stage is available, instead of waiting for
+                     it. For stages that run their own event loop (e.g. a sweep), which wait for the next item in their
+                     loop. The time until they ask again counts as waiting for input.
+        """
+        self.name = name
+        self.func = func
+        self.poll = poll
+        # number of items received and produced
+        self.items_in = 0
+        self.items_out = 0
+        # seconds spent waiting for the previous stage, and for room in the queue of the next stage (backpressure)
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+        self.started = None
+        self.finished = None
+
+    def elapsed(self):
+        """returns the seconds the stage has been running"""
+        if self.started is None:
+            return 0.0
+        return (self.finished if self.finished is not None else time.time()) - self.started
+
+    def busy(self):
+        """returns the seconds the stage has been working, i.e. not waiting for the other stages"""
+        return max(0.0, self.elapsed() - self.input_wait - self.output_wait)
+
+    def rate(self):
+        """returns the number of items produced per second"""
+        elapsed = self.elapsed()
+        return self.items_out / elapsed if elapsed else 0.0
+
+    def summary(self):
+        """returns a line with the counters of the stage"""
+        return "{}: {} in, {} out, {:.1f}/s, busy {:.1f}s, waited {:.1f}s for input and {:.1f}s for output".format(
+            self.name, self.items_in, self.items_out, self.rate(), self.busy(), self.input_wait, self.output_wait)
+
+
+class Pipeline:
+    """
+    Runs stages that stream items to each other, each in its own thread, so all the stages work at the same time and
+    the whole run takes about as long as the slowest stage.
+    The stages are connected by bounded queues: a stage waits while the queue of the next stage is full, so a slow
+    stage slows down the stages before it instead of piling up items in memory.
+    """
+
+    def __init__(self, queue_size=64):
+        """
+        Init function of Class
+        :param queue_size: maximum number of batches (of up to BATCH_SIZE items) waiting between two stages
+        """
+        self.queue_size = queue_size
+        self.stages = []
+        # (stage name, traceback) of the stage that failed
+        self.failure = None
+        self.__error = None
+
+    def add_stage(self, name, func, poll=False):
+        """
+        Adds a stage after the stages that were added so far. See Stage.
+
+        :return: the Stage
+        """
+        stage = Stage(name, func, poll)
+        self.stages.append(stage)
+        return stage
+
+    @staticmethod
+    def __put(q, item, stopped):
+        """puts an item in a queue, unless the pipeline stops first. returns whether it was put."""
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __inputs(self, stage, in_q, flush, stopped):
+        """
+        :return: generator of the items of the previous stage
+        """
+        while True:
+            try:
+                batch = in_q.get_nowait()
+            except Queue.Empty:
+                # pass on what this stage has done before waiting
+                flush()
+                started = time.time()
+                if stage.poll:
+                    # the stage waits in its own event loop, and asks again
+                    yield None
+                    batch = None
+                else:
+                    try:
+                        batch = in_q.get(timeout=POLL_INTERVAL)
+                    except Queue.Empty:
+                        batch = None
+                stage.input_wait += time.time() - started
+                if batch is None:
+                    if stopped.is_set():
+                        return
+                    continue
+            if batch is _END:
+                return
+            stage.items_in += len(batch)
+            for item in batch:
+                yield item
+
+    def __run_stage(self, stage, in_q, out_q, stopped):
+        """
+        thread function of a stage. Puts the items of the stage in out_q in batches, then _END.
+        """
+        batch = []
+        # time of the first item of the batch
+        batch_started = [0.0]
+
+        def flush():
+            if batch:
+                started = time.time()
+                self.__put(out_q, list(batch), stopped)
+                stage.output_wait += time.time() - started
+                del batch[:]
+
+        stage.started = time.time()
+        try:
+            inputs = self.__inputs(stage, in_q, flush, stopped) if in_q is not None else None
+            for item in stage.func(inputs):
+                stage.items_out += 1
+                if not batch:
+                    batch_started[0] = time.time()
+                batch.append(item)
+                if len(batch) >= BATCH_SIZE or time.time() - batch_started[0] >= BATCH_DELAY:
+                    flush()
+                if stopped.is_set():
+                    break
+            flush()
+        except Exception as err:
+            if self.__error is None:
+                self.__error = err
+                self.failure = (stage.name, traceback.format_exc())
+            stopped.set()
+        finally:
+            stage.finished = time.time()
+            self.__put(out_q, _END, stopped)
+
+    def run(self):
+        """
+        Runs all the stages.
+
+        :yields: the items of the last stage, as they are produced
+        :raises: the exception of the first stage that failed (its traceback is in 'failure'). The other stages are
+                 stopped.
+        """
+        stopped = Event()
+        queues = [Queue.Queue(self.queue_size) for stage in self.stages]
+        workers = []
+        for i, stage in enumerate(self.stages):
+            workers.append(Thread(target=self.__run_stage,
+                                  args=(stage, queues[i - 1] if i else None, queues[i], stopped)))
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        try:
+            while True:
+                try:
+                    batch = queues[-1].get(timeout=POLL_INTERVAL)
+                except Queue.Empty:
+                    if stopped.is_set():
+                        break
+                    continue
+                if batch is _END:
+                    break
+                for item in batch:
+                    yield item
+        finally:
+            # if the caller stopped early or a stage failed, the stages stop at their next item
+            stopped.set()
+            for w in workers:
+                w.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def bottleneck(self):
+        """returns the Stage that was busy the longest, or None if there are no stages"""
+        return max(self.stages, key=lambda stage: stage.busy()) if self.stages else None
+
+    def report(self):
+        """returns a list of lines with the counters of every stage, and the bottleneck"""
+        lines = [stage.summary() for stage in self.stages]
+        if self.stages:
+            lines.append("bottleneck: " + self.bottleneck().name)
+        return lines
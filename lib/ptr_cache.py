@@ -0,0 +1,148 @@
+import sqlite3
+import time
+
+from ptr_engine import ANSWER_FOUND, ANSWER_NXDOMAIN, ANSWER_NO_ANSWER
+
+# number of addresses read from the cache in one query (SQLite allows 999 parameters)
+READ_CHUNK = 500
+
+
+class PTRCache:
+    """
+    On-disk cache of reverse lookups, keyed by IP address and shared by all the runs that use the same file: the names
+    of the addresses, and the negative answers (NXDOMAIN, or no PTR records). Names expire after the TTL of their PTR
+    records, and negative answers after the lifetime configured for their kind. When the cache has more than
+    max_entries entries, the least recently used ones are evicted.
+    The cache is an SQLite database, which locks the file, so several processes can read and write it at the same time.
+    A PTRCache object must be used by one thread.
+    """
+
+    def __init__(self, path, max_entries=1000000, nxdomain_ttl=3600, noanswer_ttl=3600, max_ttl=None,
+                 batch_size=1000, busy_timeout=30):
+        """
+        Init function of Class
+        :param path: the cache file (created if it does not exist)
+        :param max_entries: maximum number of entries kept in the cache
+        :param nxdomain_ttl: seconds to cache NXDOMAIN answers
+        :param noanswer_ttl: seconds to cache answers without PTR records
+        :param max_ttl: [optional] maximum seconds to cache a name, whatever the TTL of its PTR records
+        :param batch_size: number of answers written to the file in one transaction
+        :param busy_timeout: seconds to wait for the other writers of the file
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.negative_ttl = {ANSWER_NXDOMAIN: nxdomain_ttl, ANSWER_NO_ANSWER: noanswer_ttl}
+        self.max_ttl = max_ttl
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path, timeout=busy_timeout)
+        self.conn.text_factory = str
+        try:
+            # readers don't wait for the writers
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.DatabaseError:
+            pass
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS ptr (ip TEXT PRIMARY KEY, status TEXT NOT NULL, name TEXT, "
+                              "expires REAL NOT NULL, used REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ptr_used ON ptr (used)")
+        # number of entries of the file when it was last counted, plus the answers written since. it can only be too
+        # high (an answer may replace an entry), or miss the answers of other processes until the next count, so the
+        # file is counted again only when it exceeds max_entries.
+        self.__entries = self.conn.execute("SELECT COUNT(*) FROM ptr").fetchone()[0]
+        # (ip, status, name, expires, used) of the answers that are not written yet
+        self.__pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """destructor"""
+        self.close()
+
+    def lookup(self, addresses):
+        """
+        Reads the cached answers of addresses.
+
+        :param addresses: iterable of IP addresses (strings). None (no address available yet) ends the current chunk
+                          of addresses, and is passed on as (None, None, None).
+        :yields: (address, status, name) tuples, in the order of the addresses. status is one of the ANSWER_* values of
+                 ptr_engine, or None if the address is not cached (or expired), and name is the cached name or None.
+        """
+        addresses = iter(addresses)
+        while True:
+            chunk = []
+            idle = False
+            for address in addresses:
+                if address is None:
+                    idle = True
+                    break
+                chunk.append(address)
+                if len(chunk) >= READ_CHUNK:
+                    break
+            if not chunk:
+                if not idle:
+                    return
+                yield None, None, None
+                continue
+            now = time.time()
+            rows = self.conn.execute("SELECT ip, status, name FROM ptr WHERE expires > ? AND ip IN (%s)"
+                                     % ",".join("?" * len(chunk)), [now] + chunk).fetchall()
+            cached = dict((ip, (status, name)) for ip, status, name in rows)
+            if cached:
+                with self.conn:
+                    self.conn.executemany("UPDATE ptr SET used = ? WHERE ip = ?", [(now, ip) for ip in cached])
+            self.hits += len(cached)
+            self.misses += len(chunk) - len(cached)
+            for address in chunk:
+                status, name = cached.get(address, (None, None))
+                yield address, status, name
+            if idle:
+                yield None, None, None
+
+    def put(self, address, status, name=None, ttl=None):
+        """
+        Caches an answer. Failed lookups are not cached.
+
+        :param address: IP address (string)
+        :param status: one of the ANSWER_* values of ptr_engine
+        :param name: the name of the address, for ANSWER_FOUND
+        :param ttl: TTL of the PTR records, for ANSWER_FOUND
+        """
+        if status == ANSWER_FOUND:
+            if ttl is None:
+                return
+            lifetime = ttl if self.max_ttl is None else min(ttl, self.max_ttl)
+        elif status in self.negative_ttl:
+            lifetime = self.negative_ttl[status]
+        else:
+            return
+        now = time.time()
+        self.__pending.append((address, status, name, now + lifetime, now))
+        if len(self.__pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """writes the cached answers to the file, and evicts the least recently used entries"""
+        if not self.__pending:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO ptr (ip, status, name, expires, used) VALUES (?, ?, ?, ?, ?)",
+                                  self.__pending)
+            self.__entries += len(self.__pending)
+            self.__pending = []
+            if self.__entries <= self.max_entries:
+                return
+            self.__entries = self.conn.execute("SELECT COUNT(*) FROM ptr").fetchone()[0]
+            excess = self.__entries - self.max_entries
+            if excess > 0:
+                self.conn.execute("DELETE FROM ptr WHERE ip IN (SELECT ip FROM ptr ORDER BY used LIMIT ?)", (excess,))
+                self.__entries = self.max_entries
+
+    def close(self):
+        """writes the cached answers and closes the file"""
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
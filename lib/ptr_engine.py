@@ -0,0 +1,330 @@
+import errno
+import random
+import select
+import socket
+import struct
+import time
+from collections import deque
+from collections import namedtuple
+from threading import Thread
+import Queue
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+import dns.rcode
+import dns.rdatatype
+import dns.reversename
+
+from address_space import address_family
+from nameserver_stats import NameserverStats
+from sweep import INPUT_POLL, RateLimiter, TimeoutQueue, resolve_address
+
+# bytes of the receive buffer of every UDP socket
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+
+# the kinds of answers: the address has a name, the name server says it has none (NXDOMAIN, or no PTR records), no
+# name server answered in time, the name servers failed (e.g. SERVFAIL, or the network is unreachable), or it is not an
+# IP address
+ANSWER_FOUND = "found"
+ANSWER_NXDOMAIN = "nxdomain"
+ANSWER_NO_ANSWER = "noanswer"
+ANSWER_TIMEOUT = "timeout"
+ANSWER_FAILED = "failed"
+ANSWER_INVALID = "invalid"
+
+# the outcome of the lookup of one address. name and ttl are set for ANSWER_FOUND only. latency is the number of
+# seconds from the first query of the address to its outcome, and nameserver the name server of the last query (None
+# if no query was sent).
+LookupResult = namedtuple("LookupResult", "address status name ttl latency nameserver")
+
+# an item of the addresses of run_results, on which it yields None right away (without waiting for the input), so the
+# caller gets control back, e.g. to yield results it has from elsewhere
+HAND_BACK = object()
+
+
+class PTREngine:
+    """
+    Reverse DNS lookups of many addresses at the same time, from a single thread. The PTR queries are sent from a few
+    UDP sockets, spread over the name servers, and the responses are matched to their queries by the query id.
+    Failed queries are retried on the next name server, and truncated responses are queried again over TCP.
+    """
+
+    def __init__(self, nameservers, timeout=1.5, tries=2, max_outstanding=2048, sockets_per_family=4, rate=None,
+                 port=53, stats=None):
+        """
+        Init function of Class
+        :param nameservers: list of IP addresses of DNS servers (strings)
+        :param timeout: seconds to wait for each response
+        :param tries: number of times an address is queried (on different name servers) before giving up
+        :param max_outstanding: maximum number of queries waiting for a response
+        :param sockets_per_family: number of UDP sockets for the IPv4 servers, and for the IPv6 servers
+        :param rate: maximum queries per second (None - no limit)
+        :param port: DNS port of the name servers
+        :param stats: [optional] NameserverStats object that records the latency and the timeouts of every query
+        """
+        if not nameservers:
+            raise ValueError("At least one name server is required")
+        # the addresses written the way the socket module writes the sources of packets
+        self.nameservers = [resolve_address(server)[1] for server in nameservers]
+        self.timeout = timeout
+        self.tries = tries
+        self.max_outstanding = max_outstanding
+        self.sockets_per_family = sockets_per_family
+        self.rate = rate
+        self.port = port
+        self.stats = stats if stats is not None else NameserverStats()
+
+    @staticmethod
+    def answer(response):
+        """
+        :param response: dns.message.Message of a PTR query
+        :return: (status, name, ttl) tuple. status is one of ANSWER_FOUND, ANSWER_NXDOMAIN, ANSWER_NO_ANSWER, or None if
+                 another name server should be asked (e.g. SERVFAIL). name is the first PTR target without the final
+                 dot, and ttl the TTL of the PTR records, for ANSWER_FOUND only.
+        """
+        rcode = response.rcode()
+        if rcode == dns.rcode.NXDOMAIN:
+            return ANSWER_NXDOMAIN, None, None
+        if rcode != dns.rcode.NOERROR:
+            return None, None, None
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.PTR:
+                return ANSWER_FOUND, rrset[0].target.to_text(omit_final_dot=True), rrset.ttl
+        return ANSWER_NO_ANSWER, None, None
+
+    def __open_socket(self, family):
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
+        except socket.error:
+            pass
+        return sock
+
+    def __tcp_query(self, query, server, key, tcp_q):
+        """
+        TCP query function for threads. Puts (key, response, end time) in tcp_q. The response is ANSWER_TIMEOUT or
+        ANSWER_FAILED if the query failed.
+        """
+        try:
+            response = dns.query.tcp(query, server, timeout=self.timeout, port=self.port)
+        except dns.exception.Timeout:
+            response = ANSWER_TIMEOUT
+        except (dns.exception.DNSException, socket.error, EOFError):
+            response = ANSWER_FAILED
+        tcp_q.put((key, response, time.time()))
+
+    def run(self, addresses):
+        """
+        Looks up the names of the addresses.
+
+        :param addresses: iterable of IPv4 or IPv6 addresses (strings). It is consumed lazily.
+        :yields: (address, name) tuples as the responses arrive. name is None if the address has no name, or if no
+                 name server answered.
+        """
+        for result in self.run_results(addresses):
+            if result is not None:
+                yield result.address, result.name
+
+    def run_results(self, addresses):
+        """
+        Looks up the names of the addresses, like run, with the outcome of every lookup.
+
+        :param addresses: iterable of IPv4 or IPv6 addresses (strings). It is consumed lazily, and may yield None when
+                          no address is available yet (see sweep.INPUT_POLL), or HAND_BACK.
+        :yields: LookupResult of every address, as the responses arrive, and None for every None and HAND_BACK of
+                 addresses, so the caller gets control back while the addresses are not available
+        """
+        limiter = RateLimiter(self.rate)
+        timeouts = TimeoutQueue()
+        # family -> list of UDP sockets, opened for the first name server of the family
+        sockets = {}
+        # fd -> socket
+        socket_fds = {}
+        # (fd, query id) -> (address, query, try, first server, send time, time of the first query)
+        outstanding = {}
+        # (address, query name, try, first server, time of the first query) of the queries to send again
+        retries = deque()
+        # (key, response, end time) of the TCP queries
+        tcp_q = Queue.Queue()
+        tcp_count = 0
+        queries = 0
+        addresses = iter(addresses)
+        exhausted = False
+
+        def server_of(first_server, attempt):
+            # every try of an address goes to the next name server
+            return self.nameservers[(first_server + attempt) % len(self.nameservers)]
+
+        def failed(status, address, qname, attempt, first_server, started, now):
+            """returns the result of the address if it has no more tries, or None after scheduling the next try"""
+            if attempt + 1 < self.tries:
+                retries.append((address, qname, attempt + 1, first_server, started))
+                return None
+            return LookupResult(address, status, None, None, now - started, server_of(first_server, attempt))
+
+        def answered(entry, response, now):
+            """returns the result of the address, or None after scheduling the next try"""
+            address, query, attempt, first_server, sent_at, started = entry
+            server = server_of(first_server, attempt)
+            if isinstance(response, str):
+                if response == ANSWER_TIMEOUT:
+                    self.stats.add_timeout(server)
+                return failed(response, address, query.question[0].name, attempt, first_server, started, now)
+            self.stats.add(server, now - sent_at)
+            status, name, ttl = self.answer(response)
+            if status is None:
+                return failed(ANSWER_FAILED, address, query.question[0].name, attempt, first_server, started, now)
+            return LookupResult(address, status, name, ttl, now - started, server)
+
+        try:
+            while not exhausted or retries or outstanding or tcp_count:
+                now = time.time()
+                # the socket whose buffer was full on the last send
+                send_blocked = None
+                # no address was available
+                starved = False
+                while (retries or not exhausted) and len(outstanding) + tcp_count < self.max_outstanding \
+                        and limiter.try_acquire(now):
+                    if retries:
+                        address, qname, attempt, first_server, started = retries.popleft()
+                    else:
+                        try:
+                            address = next(addresses)
+                            while address is HAND_BACK:
+                                yield None
+                                address = next(addresses)
+                        except StopIteration:
+                            exhausted = True
+                            limiter.refund()
+                            break
+                        if address is None:
+                            starved = True
+                            limiter.refund()
+                            yield None
+                            break
+                        try:
+                            qname = dns.reversename.from_address(address)
+                        except dns.exception.SyntaxError:
+                            limiter.refund()
+                            yield LookupResult(address, ANSWER_INVALID, None, None, 0.0, None)
+                            continue
+                        attempt = 0
+                        first_server = queries
+                        queries += 1
+                        started = None
+                    server = server_of(first_server, attempt)
+                    family = address_family(server)
+                    if family not in sockets:
+                        sockets[family] = [self.__open_socket(family) for i in range(self.sockets_per_family)]
+                        for sock in sockets[family]:
+                            socket_fds[sock.fileno()] = sock
+                    sock = sockets[family][(first_server + attempt) % self.sockets_per_family]
+                    query = dns.message.make_query(qname, dns.rdatatype.PTR)
+                    query.id = random.getrandbits(16)
+                    while (sock.fileno(), query.id) in outstanding:
+                        query.id = random.getrandbits(16)
+                    sent_at = time.time()
+                    if started is None:
+                        started = sent_at
+                    try:
+                        sock.sendto(query.to_wire(), (server, self.port))
+                    except socket.error as err:
+                        if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                            # the socket buffer is full. try again when the socket is writable.
+                            retries.appendleft((address, qname, attempt, first_server, started))
+                            send_blocked = sock
+                            limiter.refund()
+                            break
+                        limiter.refund()
+                        result = failed(ANSWER_FAILED, address, qname, attempt, first_server, started, sent_at)
+                        if result is not None:
+                            yield result
+                        continue
+                    key = (sock.fileno(), query.id)
+                    outstanding[key] = (address, query, attempt, first_server, sent_at, started)
+                    timeouts.add(sent_at + self.timeout, (key, sent_at))
+
+                # wait for a response, the next timeout, or the next send
+                wait = None
+                deadline = timeouts.next_deadline()
+                if deadline is not None:
+                    wait = max(0, deadline - now)
+                if (retries or not exhausted and not starved) and len(outstanding) + tcp_count < self.max_outstanding \
+                        and send_blocked is None:
+                    send_wait = limiter.wait_time(now)
+                    wait = send_wait if wait is None else min(wait, send_wait)
+                if starved:
+                    wait = INPUT_POLL if wait is None else min(wait, INPUT_POLL)
+                if tcp_count:
+                    # TCP responses arrive from other threads
+                    wait = 0.05 if wait is None else min(wait, 0.05)
+                if wait is None and send_blocked is None:
+                    continue
+                try:
+                    readable, _, _ = select.select(socket_fds.values(), [send_blocked] if send_blocked else [], [],
+                                                   wait)
+                except select.error as err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+
+                for sock in readable:
+                    while True:
+                        try:
+                            wire, source = sock.recvfrom(65535)
+                        except socket.error:
+                            # no more responses
+                            break
+                        now = time.time()
+                        if len(wire) < 2:
+                            continue
+                        key = (sock.fileno(), struct.unpack("!H", wire[:2])[0])
+                        entry = outstanding.get(key)
+                        if entry is None:
+                            continue
+                        query = entry[1]
+                        server = server_of(entry[3], entry[2])
+                        if source[0] != server:
+                            continue
+                        try:
+                            response = dns.message.from_wire(wire)
+                        except dns.exception.DNSException:
+                            continue
+                        if not query.is_response(response):
+                            continue
+                        del outstanding[key]
+                        if response.flags & dns.flags.TC:
+                            # truncated. ask the same server over TCP.
+                            tcp_count += 1
+                            tcp_thread = Thread(target=self.__tcp_query, args=(query, server, entry, tcp_q))
+                            tcp_thread.daemon = True
+                            tcp_thread.start()
+                            continue
+                        result = answered(entry, response, now)
+                        if result is not None:
+                            yield result
+
+                while True:
+                    try:
+                        entry, response, now = tcp_q.get_nowait()
+                    except Queue.Empty:
+                        break
+                    tcp_count -= 1
+                    result = answered(entry, response, now)
+                    if result is not None:
+                        yield result
+
+                now = time.time()
+                for key, sent_at in timeouts.pop_expired(now):
+                    entry = outstanding.get(key)
+                    if entry is not None and entry[4] == sent_at:
+                        del outstanding[key]
+                        result = answered(entry, ANSWER_TIMEOUT, now)
+                        if result is not None:
+                            yield result
+        finally:
+            for sock in socket_fds.values():
+                sock.close()
@@ -0,0 +1,295 @@
+import cPickle
+import csv
+import heapq
+import json
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+
+from address_index import AddressIndex, address_sort_key, key_to_address
+
+# the columns of the results, in order, and their types
+RESULT_COLUMNS = (
+    ("ip", "ip"),
+    ("status", "str"),
+    ("name", "str"),
+    ("uid", "str"),
+    ("domain", "str"),
+    ("method", "str"),
+    ("loss", "float"),
+    ("rtt_min", "float"),
+    ("rtt_avg", "float"),
+    ("rtt_max", "float"),
+    ("jitter", "float"),
+    ("dns_name", "str"),
+)
+RESULT_FIELDS = tuple(name for name, column_type in RESULT_COLUMNS)
+
+# the output formats
+OUTPUT_FORMATS = ("csv", "jsonl", "columnar")
+
+# first bytes of a columnar file
+COLUMNAR_MAGIC = "CPCOL1\n"
+
+
+class ResultWriter:
+    """
+    Base class of the result writers. Rows are written as they arrive, with the columns of RESULT_COLUMNS.
+    """
+
+    def __init__(self, f):
+        """
+        Init function of Class
+        :param f: file object opened for writing (in binary mode)
+        """
+        self.f = f
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """destructor"""
+        self.close()
+
+    @staticmethod
+    def values(row):
+        """
+        :param row: dict of column name -> value (missing columns are None)
+        :return: list of the values, in the order of the columns
+        """
+        return [row.get(field) for field in RESULT_FIELDS]
+
+    def write(self, row):
+        """
+        Writes a row.
+
+        :param row: dict of column name -> value (missing columns are None)
+        """
+        self.write_values(self.values(row))
+
+    def write_values(self, values):
+        """writes a row given as a list of values in the order of the columns"""
+        raise NotImplementedError()
+
+    def close(self):
+        """writes whatever is buffered and closes the file"""
+        self.f.close()
+
+
+class CSVResultWriter(ResultWriter):
+    def __init__(self, f, header=True):
+        """
+        Init function of Class
+        :param f: file object opened for writing (in binary mode)
+        :param header: write the names of the columns in the first row
+        """
+        ResultWriter.__init__(self, f)
+        self.writer = csv.writer(f)
+        if header:
+            self.writer.writerow(RESULT_FIELDS)
+
+    def write_values(self, values):
+        self.writer.writerow([value.encode("utf-8") if isinstance(value, unicode) else value for value in values])
+        self.rows += 1
+
+
+class JSONLResultWriter(ResultWriter):
+    def write_values(self, values):
+        self.f.write(json.dumps(dict(zip(RESULT_FIELDS, values)), sort_keys=True) + "\n")
+        self.rows += 1
+
+
+def _little_endian(arr):
+    """returns the bytes of an array in little endian order"""
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tostring()
+
+
+def _from_little_endian(typecode, data):
+    """returns an array of the bytes of a little endian array"""
+    arr = array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+class ColumnarResultWriter(ResultWriter):
+    """
+    A compact binary format for large runs. Rows are buffered in blocks, and every block is written column by column,
+    each column compressed with zlib:
+    - ip: 16 bytes per row (IPv4 addresses mapped into IPv6)
+    - float: 8 byte doubles, NaN for None
+    - str: 4 byte UTF-8 lengths (-1 for None), followed by the strings
+    The file starts with COLUMNAR_MAGIC and the columns (JSON), and every block with its number of rows. Integers are
+    little endian. See read_columnar.
+    """
+
+    def __init__(self, f, block_rows=65536):
+        """
+        Init function of Class
+        :param f: file object opened for writing (in binary mode)
+        :param block_rows: number of rows in a block
+        """
+        ResultWriter.__init__(self, f)
+        self.block_rows = block_rows
+        self.__block = []
+        schema = json.dumps(RESULT_COLUMNS)
+        self.f.write(COLUMNAR_MAGIC + struct.pack("<I", len(schema)) + schema)
+
+    def write_values(self, values):
+        self.__block.append(values)
+        self.rows += 1
+        if len(self.__block) >= self.block_rows:
+            self.flush()
+
+    @staticmethod
+    def __encode(column_type, values):
+        if column_type == "ip":
+            keys = [AddressIndex.key(value) for value in values]
+            return "".join(struct.pack("!QQ", key >> 64, key & 0xFFFFFFFFFFFFFFFF) for key in keys)
+        if column_type == "float":
+            return _little_endian(array("d", [float("nan") if value is None else value for value in values]))
+        strings = [value.encode("utf-8") if isinstance(value, unicode) else value for value in values]
+        lengths = array("i", [-1 if value is None else len(value) for value in strings])
+        return _little_endian(lengths) + "".join(value for value in strings if value is not None)
+
+    def flush(self):
+        """writes the buffered rows as a block"""
+        if not self.__block:
+            return
+        self.f.write(struct.pack("<I", len(self.__block)))
+        for column, (name, column_type) in enumerate(RESULT_COLUMNS):
+            data = zlib.compress(self.__encode(column_type, [values[column] for values in self.__block]))
+            self.f.write(struct.pack("<I", len(data)) + data)
+        self.__block = []
+
+    def close(self):
+        self.flush()
+        ResultWriter.close(self)
+
+
+def read_columnar(f):
+    """
+    Reads a file written by ColumnarResultWriter.
+
+    :param f: file object opened for reading (in binary mode)
+    :yields: the rows, as dicts of column name -> value
+    :raises ValueError: if it is not a columnar results file
+    """
+    if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar results file")
+    schema_length = struct.unpack("<I", f.read(4))[0]
+    columns = json.loads(f.read(schema_length))
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+        row_count = struct.unpack("<I", header)[0]
+        column_values = []
+        for name, column_type in columns:
+            data = zlib.decompress(f.read(struct.unpack("<I", f.read(4))[0]))
+            if column_type == "ip":
+                values = []
+                for i in range(row_count):
+                    high, low = struct.unpack("!QQ", data[i * 16:i * 16 + 16])
+                    values.append(key_to_address(high << 64 | low))
+            elif column_type == "float":
+                values = [None if value != value else value for value in _from_little_endian("d", data)]
+            else:
+                lengths = _from_little_endian("i", data[:row_count * 4])
+                values = []
+                offset = row_count * 4
+                for length in lengths:
+                    if length < 0:
+                        values.append(None)
+                    else:
+                        values.append(data[offset:offset + length].decode("utf-8"))
+                        offset += length
+            column_values.append(values)
+        for i in range(row_count):
+            yield dict((name, values[i]) for (name, column_type), values in zip(columns, column_values))
+
+
+class SortedResultWriter(ResultWriter):
+    """
+    Sorts the rows by IP address (IPv4 first) before they are written by another writer, in bounded memory: rows are
+    buffered up to max_rows, sorted, and spilled to temporary files, which are merged when the writer is closed.
+    """
+
+    def __init__(self, writer, max_rows=100000, tmp_dir=None):
+        """
+        Init function of Class
+        :param writer: the ResultWriter that writes the sorted rows
+        :param max_rows: maximum number of rows kept in memory
+        :param tmp_dir: [optional] directory of the temporary files
+        """
+        ResultWriter.__init__(self, writer.f)
+        self.writer = writer
+        self.max_rows = max_rows
+        self.tmp_dir = tmp_dir
+        self.__buffer = []
+        # the temporary files of the sorted runs
+        self.__runs = []
+
+    def write_values(self, values):
+        self.__buffer.append((address_sort_key(values[0]), values))
+        self.rows += 1
+        if len(self.__buffer) >= self.max_rows:
+            self.__spill()
+
+    def __spill(self):
+        """writes the buffered rows, sorted, to a temporary file"""
+        self.__buffer.sort()
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        pickler = cPickle.Pickler(run, cPickle.HIGHEST_PROTOCOL)
+        for item in self.__buffer:
+            pickler.dump(item)
+            # don't keep references to the rows
+            pickler.clear_memo()
+        run.seek(0)
+        self.__runs.append(run)
+        self.__buffer = []
+
+    @staticmethod
+    def __read_run(run):
+        unpickler = cPickle.Unpickler(run)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+    def close(self):
+        self.__buffer.sort()
+        try:
+            for sort_key, values in heapq.merge(self.__buffer, *[self.__read_run(run) for run in self.__runs]):
+                self.writer.write_values(values)
+        finally:
+            for run in self.__runs:
+                run.close()
+            self.__runs = []
+            self.__buffer = []
+            self.writer.close()
+
+
+def open_result_writer(file_name, output_format="csv", sort=False, max_rows=100000):
+    """
+    Opens a writer of results.
+
+    :param file_name: the output file
+    :param output_format: one of OUTPUT_FORMATS
+    :param sort: sort the rows by IP address (in bounded memory, see SortedResultWriter)
+    :param max_rows: when sorting, maximum number of rows kept in memory
+    :return: ResultWriter object
+    :raises ValueError: if the format is unknown
+    """
+    writers = {"csv": CSVResultWriter, "jsonl": JSONLResultWriter, "columnar": ColumnarResultWriter}
+    if output_format not in writers:
+        raise ValueError("Unknown output format: " + str(output_format))
+    writer = writers[output_format](open(file_name, "wb"))
+    return SortedResultWriter(writer, max_rows) if sort else writer
@@ -1,87 +1,138 @@
 from __future__ import print_function
-from threading import Thread
+from collections import deque
 import Queue
-import dns.reversename
 import dns.resolver
 
+from nameserver_stats import NameserverStats
+from ptr_engine import PTREngine, LookupResult, HAND_BACK, ANSWER_TIMEOUT
+
+# number of cached results of iter_results that are yielded together, when the other addresses are being looked up
+CACHED_BATCH = 256
+
 
 class ReverseLookups:
-    def __init__(self, thread_count, ip_list, name_server):
+    def __init__(self, thread_count, ip_list, name_server, cache=None):
         """
-        Init function of Class
-        :param thread_count: number of threads to use
-        :param ip_list: List of IP addresses
-        :param name_server: List of IP addresses represented as strings i.e. ['8.8.8.8', '8.8.4.4']
+        Init function of Class. The addresses are looked up from one thread, with a PTREngine.
+        :param thread_count: not used: the engine has many queries in flight from one thread (see max_outstanding of
+                             iter_results). Kept for the callers that pass it.
+        :param ip_list: List of IP addresses (IPv4 addresses are looked up in in-addr.arpa, IPv6 in ip6.arpa). Any
+                        iterable is consumed lazily by iter_results, and may yield None when no address is available
+                        yet (see sweep.INPUT_POLL).
+        :param name_server: List of IP addresses represented as strings i.e. ['8.8.8.8', '8.8.4.4'] (None - the name
+                            servers of the system)
+        :param cache: [optional] PTRCache object. start_lookups only looks up the addresses that are not cached (or
+                      expired), and caches their answers.
         """
         self.thread_count = thread_count
         self.ip_list = ip_list
-        # The queue of addresses to ping
-        self.ips_q = Queue.Queue()
-        # The queue of results
+        self.cache = cache
+        # The queue of results of lookups
         self.out_q = Queue.Queue()
         # Resolver object
         self.resolver = dns.resolver.Resolver()
         self.resolver.timeout = 3
         self.resolver.lifetime = 3
         # list of dns servers IP to use
-        self.resolver.nameservers = name_server
+        if name_server:
+            self.resolver.nameservers = name_server
+        # latency and timeouts of the queries sent to each name server
+        self.stats = NameserverStats()
 
-    def lookups(self):
+    def __engine(self, max_outstanding, timeout):
+        tries = max(1, min(3, len(self.resolver.nameservers)))
+        if timeout is None:
+            timeout = float(self.resolver.lifetime) / tries
+        return PTREngine(self.resolver.nameservers, timeout=timeout, tries=tries, max_outstanding=max_outstanding,
+                         port=self.resolver.port, stats=self.stats)
+
+    def iter_results(self, max_outstanding=2048, timeout=None, retry_timeout=None):
         """
-        lookup function wrapper for threads
-        :return: None
+        Looks up all the addresses at the same time with a PTREngine, over the name servers of the resolver. Each
+        address gets up to one try per name server (at most 3). The latency and the timeouts of the queries are
+        recorded in stats.
+        :param max_outstanding: maximum number of queries waiting for a response
+        :param timeout: seconds to wait for each response (default - the lifetime of the resolver, divided between the
+                        tries)
+        :param retry_timeout: [optional] the addresses that timed out are looked up again once all the other addresses
+                              are done, waiting this many seconds for each response. Dead addresses then cost a short
+                              timeout, and only the slow ones the long one.
+        :yields: LookupResult of every address as soon as it is known (the cached ones with latency 0)
         """
-        try:
-            while True:
-                # get an IP item from queue
-                address = self.ips_q.get_nowait()
+        # results of the cached addresses, yielded with the next result of the engine
+        cached = deque()
 
-                rev_name = dns.reversename.from_address(address)
-                try:
-                    reversed_dns = str(self.resolver.query(rev_name, "PTR")[0])[:-1]
-                    if reversed_dns:
-                        self.out_q.put((address, reversed_dns))
-                except dns.resolver.NXDOMAIN:
+        def uncached():
+            """the addresses that are not cached. None (no address available yet) is passed on."""
+            if self.cache is None:
+                for address in self.ip_list:
+                    yield address
+                return
+            for address, status, name in self.cache.lookup(self.ip_list):
+                if status is None:
+                    yield address
                     continue
-                except dns.resolver.NoAnswer:
-                    continue
-                except dns.exception.Timeout:
+                cached.append(LookupResult(address, status, name, None, 0.0, None))
+                if len(cached) >= CACHED_BATCH:
+                    # let the engine hand back control (without waiting for input), so they are yielded
+                    yield HAND_BACK
+
+        # address -> latency of the first lookup, of the addresses that timed out
+        timed_out = {}
+        try:
+            for result in self.__engine(max_outstanding, timeout).run_results(uncached()):
+                while cached:
+                    yield cached.popleft()
+                if result is None:
                     continue
-                except dns.resolver.NoNameservers:
+                if result.status == ANSWER_TIMEOUT and retry_timeout is not None:
+                    timed_out[result.address] = result.latency
                     continue
-        except Queue.Empty:
-            # No more addresses.
-            pass
+                if self.cache is not None:
+                    self.cache.put(result.address, result.status, result.name, result.ttl)
+                yield result
+            while cached:
+                yield cached.popleft()
+            if timed_out:
+                for result in self.__engine(max_outstanding, retry_timeout).run_results(list(timed_out)):
+                    if self.cache is not None:
+                        self.cache.put(result.address, result.status, result.name, result.ttl)
+                    yield result._replace(latency=timed_out[result.address] + result.latency)
         finally:
-            self.out_q.put(None)
+            if self.cache is not None:
+                self.cache.flush()
 
-    def start_lookups(self):
+    def iter_lookups(self, max_outstanding=2048):
         """
-        Thread function to perform reverse lookup of list of IP addresses
-        :return: output queue as deque list (list of tuples)
+        Looks up all the addresses, like iter_results.
+        :param max_outstanding: maximum number of queries waiting for a response
+        :yields: (address, name) tuples of the addresses that have a name, the cached ones first, then as the responses
+                 arrive
         """
-        # create the workers
-        workers = []
-        for i in range(self.thread_count):
-            workers.append(Thread(target=self.lookups))
-
-        # put all of the IPs in the ips_q queue
-        for ip in self.ip_list:
-            self.ips_q.put(ip)
+        for result in self.iter_results(max_outstanding):
+            if result.name:
+                yield result.address, result.name
 
-        # Start all the workers
-        for w in workers:
-            w.daemon = True
-            w.start()
-
-        # wait until worker threads are done to exit
-        for w in workers:
-            w.join()
+    def lookups(self):
+        """
+        Looks up all the addresses, like iter_lookups, and puts the (address, name) tuples in out_q, followed by None.
+        :return: None
+        """
+        try:
+            for address, name in self.iter_lookups():
+                self.out_q.put((address, name))
+        finally:
+            self.out_q.put(None)
 
-        return self.out_q.queue
+    def start_lookups(self):
+        """
+        Performs reverse lookup of list of IP addresses
+        :return: deque list of (address, name) tuples
+        """
+        return deque(self.iter_lookups())
 
 
 if __name__ == '__main__':
-    iplist = ['8.8.8.8', '8.8.4.4', '9.9.9.9', '172.217.10.68']
+    iplist = ['8.8.8.8', '8.8.4.4', '9.9.9.9', '172.217.10.68', '2001:4860:4860::8888']
     iplookup = ReverseLookups(8, iplist, ['8.8.8.8'])
     print(iplookup.start_lookups())
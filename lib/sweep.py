@@ -0,0 +1,538 @@
+import errno
+import heapq
+import select
+import socket
+import struct
+import time
+from collections import deque
+
+from icmp import ICMPSocket
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# connect() results of a connection that is being opened. 10035 is WSAEWOULDBLOCK.
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035)
+# connect() results when this system is out of sockets or local ports
+CONNECT_NO_RESOURCES = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL)
+# seconds to wait before asking again for the next address, when the addresses yielded None (no address is available
+# yet, e.g. the addresses come from another thread)
+INPUT_POLL = 0.05
+
+
+def resolve_address(address):
+    """
+    :param address: IPv4 or IPv6 address, or host name (resolved to its IPv4 address)
+    :return: (family, ip) tuple. IPv6 addresses are written the way the socket module writes the sources of packets.
+    :raises socket.error: if the address can not be resolved
+    """
+    if ":" in address:
+        return socket.AF_INET6, socket.getaddrinfo(address, None, socket.AF_INET6, 0, 0, socket.AI_NUMERICHOST)[0][4][0]
+    return socket.AF_INET, socket.gethostbyname(address)
+
+
+def wait_for_addresses(addresses):
+    """
+    :param addresses: iterable of addresses, which may yield None when no address is available yet
+    :return: generator of the addresses, waiting INPUT_POLL seconds on every None
+    """
+    for address in addresses:
+        if address is None:
+            time.sleep(INPUT_POLL)
+            continue
+        yield address
+
+
+def max_open_sockets():
+    """
+    :return: number of sockets this process can open, leaving some file descriptors for everything else
+    """
+    if resource is None:
+        return 1 << 20
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return 1 << 20
+    return max(1, soft_limit - 64)
+
+
+class RateLimiter:
+    """
+    Token bucket that limits the number of packets sent per second.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Init function of Class
+        :param rate: packets per second (None - no limit)
+        :param burst: maximum number of packets sent back to back (default - 1% of the rate, at least 1)
+        """
+        self.rate = rate
+        self.burst = burst if burst else max(1, int(rate // 100)) if rate else None
+        self.__tokens = float(self.burst) if rate else 0.0
+        self.__last = time.time()
+
+    def __refill(self, now):
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    def try_acquire(self, now):
+        """
+        :return: True if a packet may be sent now (and counts it)
+        """
+        if not self.rate:
+            return True
+        self.__refill(now)
+        if self.__tokens >= 1:
+            self.__tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        """gives back the packet counted by the last try_acquire, when it was not sent after all"""
+        if self.rate:
+            self.__tokens = min(self.burst, self.__tokens + 1)
+
+    def wait_time(self, now):
+        """
+        :return: seconds until the next packet may be sent
+        """
+        if not self.rate:
+            return 0
+        self.__refill(now)
+        return max(0, (1 - self.__tokens) / self.rate)
+
+
+class TimeoutQueue:
+    """
+    The single timer structure of a sweep: a heap of (deadline, key) for all the probes in flight.
+    Probes that got a reply are not removed from the heap; they are skipped when their deadline comes.
+    """
+
+    def __init__(self):
+        self.__heap = []
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def add(self, deadline, key):
+        heapq.heappush(self.__heap, (deadline, key))
+
+    def next_deadline(self):
+        """returns the earliest deadline, or None if the queue is empty"""
+        return self.__heap[0][0] if self.__heap else None
+
+    def pop_expired(self, now):
+        """
+        :return: list of the keys whose deadline passed
+        """
+        expired = []
+        while self.__heap and self.__heap[0][0] <= now:
+            expired.append(heapq.heappop(self.__heap)[1])
+        return expired
+
+
+class SocketPoller:
+    """
+    Waits until many sockets are writable (or failed): with select.poll where the system has it, and with
+    select.select, which handles a limited number of sockets, otherwise.
+    """
+
+    # number of sockets select.select can wait for
+    SELECT_LIMIT = 500
+
+    def __init__(self):
+        self.__poll = select.poll() if hasattr(select, "poll") else None
+        self.__fds = set()
+        self.limit = 1 << 20 if self.__poll is not None else self.SELECT_LIMIT
+
+    def register(self, fd):
+        self.__fds.add(fd)
+        if self.__poll is not None:
+            self.__poll.register(fd, select.POLLOUT | select.POLLERR | select.POLLHUP)
+
+    def unregister(self, fd):
+        self.__fds.discard(fd)
+        if self.__poll is not None:
+            self.__poll.unregister(fd)
+
+    def wait(self, timeout):
+        """
+        :param timeout: seconds to wait, None - until a socket is ready
+        :return: list of the file descriptors that are ready
+        """
+        try:
+            if self.__poll is not None:
+                return [fd for fd, event in self.__poll.poll(None if timeout is None else timeout * 1000)]
+            if not self.__fds:
+                time.sleep(timeout)
+                return []
+            # windows reports failed connections as exceptional
+            _, writable, failed = select.select([], list(self.__fds), list(self.__fds), timeout)
+            return writable + failed
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+
+
+class PingSweep:
+    """
+    An event-driven ICMP sweep. Thousands of echo requests can be in flight at the same time from one socket, they are
+    expired through a single timeout queue, and the send rate can be limited (so the sweep does not trip the IDS of
+    the firewalls on the way).
+    Every host can be probed several times. The probes of a host are sent one after the other, 'interval' seconds
+    apart, like the ping command does.
+    """
+
+    def __init__(self, timeout=1.0, max_outstanding=4096, rate=None, count=1, interval=1.0):
+        """
+        Init function of Class
+        :param timeout: seconds to wait for each reply
+        :param max_outstanding: maximum number of hosts being probed at the same time
+        :param rate: maximum packets per second (None - no limit)
+        :param count: number of probes sent to each host
+        :param interval: seconds between the probes of a host
+        """
+        self.timeout = timeout
+        self.max_outstanding = max_outstanding
+        self.rate = rate
+        self.count = count
+        self.interval = interval
+
+    def run(self, addresses):
+        """
+        Pings all the addresses.
+
+        :param addresses: iterable of IPv4 addresses, IPv6 addresses or host names. It is consumed lazily.
+        :yields: (address, rtt) tuples as the replies arrive, one for every probe. rtt is in seconds or None if the
+                 host did not reply
+        :raises socket.error: if an ICMP socket can not be opened
+        """
+        for index, address, probe, rtt in self.run_probes(addresses):
+            yield address, rtt
+
+    def __complete(self, hosts, scheduled, index, sent_at):
+        """
+        Bookkeeping of a probe that got a reply, timed out or could not be sent: schedules the next probe of the
+        host, or forgets the host after its last probe.
+
+        :return: (address, probe number) of the probe
+        """
+        address, target, probe = hosts[index]
+        if probe + 1 < self.count:
+            hosts[index] = (address, target, probe + 1)
+            scheduled.add(sent_at + self.interval, index)
+        else:
+            del hosts[index]
+        return address, probe
+
+    def run_probes(self, addresses):
+        """
+        Pings all the addresses, 'count' times each.
+
+        :param addresses: iterable of IPv4 addresses, IPv6 addresses or host names. It is consumed lazily, and may
+                          yield None when no address is available yet (see INPUT_POLL).
+        :yields: (index, address, probe, rtt) tuples as the replies arrive, one for every probe. index is the position
+                 of the address in addresses (not counting None), probe is the number of the probe (the last probe of a host is count - 1),
+                 and rtt is in seconds or None if the host did not reply
+        :raises socket.error: if an ICMP socket can not be opened
+        """
+        # family -> ICMPSocket. the ICMPv6 socket is opened for the first IPv6 address, and is None if it can't be.
+        sockets = {socket.AF_INET: ICMPSocket()}
+        limiter = RateLimiter(self.rate)
+        timeouts = TimeoutQueue()
+        # the times of the next probes of the hosts that were already probed
+        scheduled = TimeoutQueue()
+        # indexes of the hosts whose next probe is due
+        ready = deque()
+        # index -> (address, (family, ip), number of the probe in flight or due) of the hosts being probed
+        hosts = {}
+        # (ip, seq) -> (index, send time)
+        outstanding = {}
+        seq = 0
+        host_count = 0
+        addresses = iter(addresses)
+        next_address = None
+        exhausted = False
+        try:
+            while not exhausted or next_address is not None or hosts:
+                now = time.time()
+                ready.extend(scheduled.pop_expired(now))
+                # the socket whose buffer was full on the last send
+                send_blocked = None
+                # no address was available
+                starved = False
+                # send as many requests as the window and the rate allow. the hosts that were already probed go first.
+                while (ready or (next_address is not None or not exhausted) and len(hosts) < self.max_outstanding) \
+                        and limiter.try_acquire(now):
+                    if ready:
+                        index = ready.popleft()
+                        address, target, probe = hosts[index]
+                    else:
+                        if next_address is None:
+                            try:
+                                next_address = next(addresses)
+                            except StopIteration:
+                                exhausted = True
+                                limiter.refund()
+                                break
+                            if next_address is None:
+                                starved = True
+                                limiter.refund()
+                                break
+                        address = next_address
+                        index = host_count
+                        try:
+                            target = resolve_address(address)
+                            if target[0] not in sockets:
+                                sockets[target[0]] = ICMPSocket(target[0]) if ICMPSocket.available(target[0]) else None
+                            if sockets[target[0]] is None:
+                                raise socket.error("ICMPv6 sockets can not be opened")
+                        except socket.error:
+                            next_address = None
+                            host_count += 1
+                            limiter.refund()
+                            for probe in range(self.count):
+                                yield index, address, probe, None
+                            continue
+                    icmp_sock = sockets[target[0]]
+                    seq = (seq + 1) & 0xFFFF
+                    sent = icmp_sock.send(target[1], seq)
+                    if sent is None:
+                        # the socket buffer is full. try this probe again when the socket is writable.
+                        if index in hosts:
+                            ready.appendleft(index)
+                        send_blocked = icmp_sock
+                        limiter.refund()
+                        break
+                    sent_at = time.time()
+                    if index not in hosts:
+                        next_address = None
+                        host_count += 1
+                        hosts[index] = (address, target, 0)
+                    if not sent:
+                        limiter.refund()
+                        address, probe = self.__complete(hosts, scheduled, index, sent_at)
+                        yield index, address, probe, None
+                        continue
+                    outstanding[(target[1], seq)] = (index, sent_at)
+                    timeouts.add(sent_at + self.timeout, (target[1], seq))
+
+                # wait for a reply, the next timeout, the next scheduled probe, or the next send
+                wait = None
+                for deadline in (timeouts.next_deadline(), scheduled.next_deadline()):
+                    if deadline is not None:
+                        wait = max(0, deadline - now) if wait is None else min(wait, max(0, deadline - now))
+                if (ready or (next_address is not None or not exhausted) and not starved and
+                        len(hosts) < self.max_outstanding) and send_blocked is None:
+                    send_wait = limiter.wait_time(now)
+                    wait = send_wait if wait is None else min(wait, send_wait)
+                if starved:
+                    wait = INPUT_POLL if wait is None else min(wait, INPUT_POLL)
+                if wait is None and send_blocked is None:
+                    continue
+                open_sockets = [icmp_sock for icmp_sock in sockets.values() if icmp_sock is not None]
+                try:
+                    readable, _, _ = select.select(open_sockets, [send_blocked] if send_blocked else [], [], wait)
+                except select.error as err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+
+                now = time.time()
+                for icmp_sock in readable:
+                    for key in icmp_sock.recv_replies():
+                        if key in outstanding:
+                            index, sent_at = outstanding.pop(key)
+                            address, probe = self.__complete(hosts, scheduled, index, sent_at)
+                            yield index, address, probe, now - sent_at
+                for key in timeouts.pop_expired(now):
+                    if key in outstanding:
+                        index, sent_at = outstanding.pop(key)
+                        address, probe = self.__complete(hosts, scheduled, index, sent_at)
+                        yield index, address, probe, None
+        finally:
+            for icmp_sock in sockets.values():
+                if icmp_sock is not None:
+                    icmp_sock.close()
+
+
+class TCPSweep:
+    """
+    A TCP connect sweep, for the hosts that sit behind filters that drop ICMP.
+    Non-blocking connections are opened to a list of ports of every host, and thousands of them wait together in a
+    single poller. A host is alive when any of its ports answers the SYN, with a SYN-ACK (the port is open) or with a
+    RST (the port is closed). Connections that were established are reset right away.
+    """
+
+    def __init__(self, ports=(80, 443, 22), timeout=1.0, max_outstanding=4096, rate=None):
+        """
+        Init function of Class
+        :param ports: the ports to connect to on every host
+        :param timeout: seconds to wait for each connection
+        :param max_outstanding: maximum number of connections being opened at the same time. It is also limited by
+                                the number of files the process can open.
+        :param rate: maximum connections opened per second (None - no limit)
+        """
+        self.ports = ports
+        self.timeout = timeout
+        self.max_outstanding = max_outstanding
+        self.rate = rate
+
+    @staticmethod
+    def __close(conns, poller, fd):
+        """
+        Closes a connection. Established connections are closed with a RST, so they don't linger in TIME_WAIT.
+
+        :return: (socket, index, port, send time) of the connection
+        """
+        conn = conns.pop(fd)
+        poller.unregister(fd)
+        try:
+            conn[0].setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        except socket.error:
+            pass
+        conn[0].close()
+        return conn
+
+    def __complete(self, hosts, conns, poller, index, port, err, sent_at, now):
+        """
+        Bookkeeping of a finished connection.
+
+        :param err: the result of the connection (0 - established, errno otherwise)
+        :return: the (index, address, method, rtt) tuple of the host if it is done, None otherwise
+        """
+        address, target, remaining, fds = hosts[index]
+        remaining -= 1
+        if err == 0 or err == errno.ECONNREFUSED:
+            # the host answered. there is no need to wait for its other ports.
+            del hosts[index]
+            for fd in fds:
+                if fd in conns and conns[fd][1] == index:
+                    self.__close(conns, poller, fd)
+            return index, address, ("tcp/%d" if err == 0 else "tcp-rst/%d") % port, now - sent_at
+        if remaining == 0:
+            del hosts[index]
+            return index, address, None, None
+        hosts[index][2] = remaining
+        return None
+
+    def run_probes(self, addresses):
+        """
+        Connects to the ports of all the addresses.
+
+        :param addresses: iterable of IPv4 addresses, IPv6 addresses or host names. It is consumed lazily, and may
+                          yield None when no address is available yet (see INPUT_POLL).
+        :yields: (index, address, method, rtt) tuples, one for every address as soon as it is known. index is the
+                 position of the address in addresses (not counting None), method is "tcp/<port>" (SYN-ACK) or "tcp-rst/<port>" (RST) of
+                 the port that answered first, or None if no port answered, and rtt is the time it took in seconds
+                 (None if no port answered)
+        """
+        poller = SocketPoller()
+        max_outstanding = min(self.max_outstanding, poller.limit, max_open_sockets())
+        limiter = RateLimiter(self.rate)
+        timeouts = TimeoutQueue()
+        # index -> [address, (family, ip), number of ports without a result, file descriptors of its connections]
+        hosts = {}
+        # fd -> (socket, index, port, send time) of the connections being opened
+        conns = {}
+        # (index, port) of the connections to open
+        pending = deque()
+        host_count = 0
+        addresses = iter(addresses)
+        exhausted = False
+        try:
+            while not exhausted or hosts:
+                now = time.time()
+                # out of sockets or local ports on the last connection
+                blocked = False
+                # no address was available
+                starved = False
+                while len(conns) < max_outstanding and (pending or not exhausted) and limiter.try_acquire(now):
+                    if not pending:
+                        try:
+                            address = next(addresses)
+                        except StopIteration:
+                            exhausted = True
+                            limiter.refund()
+                            break
+                        if address is None:
+                            starved = True
+                            limiter.refund()
+                            break
+                        index = host_count
+                        host_count += 1
+                        try:
+                            target = resolve_address(address)
+                        except socket.error:
+                            limiter.refund()
+                            yield index, address, None, None
+                            continue
+                        hosts[index] = [address, target, len(self.ports), []]
+                        pending.extend((index, port) for port in self.ports)
+                    index, port = pending[0]
+                    if index not in hosts:
+                        # another port of the host already answered
+                        pending.popleft()
+                        limiter.refund()
+                        continue
+                    family, ip = hosts[index][1]
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    sent_at = time.time()
+                    err = sock.connect_ex((ip, port))
+                    if err in CONNECT_IN_PROGRESS:
+                        pending.popleft()
+                        fd = sock.fileno()
+                        conns[fd] = (sock, index, port, sent_at)
+                        hosts[index][3].append(fd)
+                        poller.register(fd)
+                        timeouts.add(sent_at + self.timeout, (fd, sent_at))
+                        continue
+                    sock.close()
+                    if err in CONNECT_NO_RESOURCES and conns:
+                        # try again when some of the connections in flight are closed
+                        blocked = True
+                        limiter.refund()
+                        break
+                    pending.popleft()
+                    result = self.__complete(hosts, conns, poller, index, port, err, sent_at, time.time())
+                    if result is not None:
+                        yield result
+
+                # wait for a connection, the next timeout, or the next connection to open
+                wait = None
+                deadline = timeouts.next_deadline()
+                if deadline is not None:
+                    wait = max(0, deadline - now)
+                if len(conns) < max_outstanding and (pending or not exhausted) and not blocked and not starved:
+                    send_wait = limiter.wait_time(now)
+                    wait = send_wait if wait is None else min(wait, send_wait)
+                if starved:
+                    wait = INPUT_POLL if wait is None else min(wait, INPUT_POLL)
+                if wait is None:
+                    continue
+                ready = poller.wait(wait)
+
+                now = time.time()
+                for fd in ready:
+                    if fd not in conns:
+                        continue
+                    sock = conns[fd][0]
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    sock, index, port, sent_at = self.__close(conns, poller, fd)
+                    result = self.__complete(hosts, conns, poller, index, port, err, sent_at, now)
+                    if result is not None:
+                        yield result
+                for fd, sent_at in timeouts.pop_expired(now):
+                    if fd in conns and conns[fd][3] == sent_at:
+                        sock, index, port, sent_at = self.__close(conns, poller, fd)
+                        result = self.__complete(hosts, conns, poller, index, port, errno.ETIMEDOUT, sent_at, now)
+                        if result is not None:
+                            yield result
+        finally:
+            for fd in list(conns):
+                self.__close(conns, poller, fd)
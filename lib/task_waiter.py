@@ -0,0 +1,193 @@
+import copy
+import sys
+import time
+from threading import Thread, Event, Lock
+
+from api_exceptions import APIException
+from api_future import APIFuture
+
+
+class TaskWaiter:
+    """
+    Waits for management server tasks (e.g. publish, install-policy, run-script) to complete.
+    All the pending task ids are checked with a single "show-task" call. The delay between the calls starts short,
+    so fast tasks return quickly, and grows up to a cap while tasks stay in progress.
+    """
+
+    IN_PROGRESS = "in progress"
+
+    def __init__(self, api_client, min_delay=0.1, max_delay=2.0, backoff=1.5, max_attempts=5):
+        """
+        Init function of Class
+        :param api_client: APIClient object, logged in
+        :param min_delay: seconds to wait after the first check
+        :param max_delay: maximum seconds to wait between checks
+        :param backoff: the delay is multiplied by this factor after every check
+        :param max_attempts: number of failed "show-task" calls in a row before giving up
+        """
+        self.api_client = api_client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.max_attempts = max_attempts
+        self.__lock = Lock()
+        # (task ids, APIFuture) of the waits submitted to the background poller
+        self.__pending = []
+        self.__poller = None
+        # set when a new wait is submitted, to check it without waiting for the current delay
+        self.__wakeup = Event()
+
+    @staticmethod
+    def get_task_ids(api_res):
+        """
+        :param api_res: APIResponse of a command
+        :return: list of the task ids the command responded with (empty if there are none)
+        """
+        if not api_res.success or not isinstance(api_res.data, dict):
+            return []
+        if "task-id" in api_res.data:
+            return [api_res.data["task-id"]]
+        if "tasks" in api_res.data:
+            return [task_obj["task-id"] for task_obj in api_res.data["tasks"]]
+        return []
+
+    def __show_tasks(self, task_ids):
+        """
+        Checks the status of the tasks with one "show-task" call, retrying failed calls.
+
+        :return: APIResponse object (response of show-task command)
+        :raises APIException
+        """
+        delay = self.min_delay
+        for attempt in range(self.max_attempts + 1):
+            task_result = self.api_client.api_call("show-task", {"task-id": task_ids, "details-level": "full"},
+                                                   self.api_client.sid, False)
+            if task_result.success:
+                return task_result
+            if attempt < self.max_attempts:
+                time.sleep(delay)
+                delay = min(self.max_delay, delay * self.backoff)
+        raise APIException("ERROR: Failed to handle asynchronous tasks as synchronous, tasks result is undefined",
+                           task_result)
+
+    def __poll(self, tasks):
+        """
+        Checks all the tasks that are still in progress and updates the tasks dict.
+
+        :param tasks: task id -> last known task object (None until the task was seen)
+        :return: APIResponse object of the check
+        """
+        pending_ids = [task_id for task_id, task in tasks.items() if task is None or task["status"] == self.IN_PROGRESS]
+        task_result = self.__show_tasks(pending_ids)
+        for task in task_result.data["tasks"]:
+            if task.get("task-id") in tasks:
+                tasks[task["task-id"]] = task
+        return task_result
+
+    def __is_complete(self, tasks):
+        return all(task is not None and task["status"] != self.IN_PROGRESS for task in tasks.values())
+
+    def __result(self, task_ids, tasks, task_result):
+        """
+        :return: the last APIResponse, with the final task objects of all task_ids, in order
+        """
+        task_result.data["tasks"] = [tasks[task_id] for task_id in task_ids]
+        self.api_client.check_tasks_status(task_result)
+        return task_result
+
+    def wait(self, task_ids):
+        """
+        Waits until all the tasks (and their sub-tasks) are no longer in-progress.
+
+        :param task_ids: a task id or a list of task ids
+        :return: APIResponse object (response of show-task command) with all the tasks
+        :raises APIException
+        """
+        if not isinstance(task_ids, list):
+            task_ids = [task_ids]
+        tasks = dict((task_id, None) for task_id in task_ids)
+        delay = self.min_delay
+        while True:
+            task_result = self.__poll(tasks)
+            if self.__is_complete(tasks):
+                return self.__result(task_ids, tasks, task_result)
+            time.sleep(delay)
+            delay = min(self.max_delay, delay * self.backoff)
+
+    def submit(self, task_ids):
+        """
+        Waits for the tasks in the background. The tasks of all the submitted waits are checked together, so
+        several publish or install operations can be waited for at the same time.
+
+        :param task_ids: a task id or a list of task ids
+        :return: APIFuture object with the APIResponse that wait() would return
+        """
+        if not isinstance(task_ids, list):
+            task_ids = [task_ids]
+        future = APIFuture()
+        with self.__lock:
+            self.__pending.append((task_ids, future))
+            if self.__poller is None:
+                self.__poller = Thread(target=self.__poll_pending)
+                self.__poller.daemon = True
+                self.__poller.start()
+        self.__wakeup.set()
+        return future
+
+    def __forget_tasks(self, tasks):
+        """removes the tasks nobody waits for from the tasks dict of the poller"""
+        with self.__lock:
+            waited_ids = set(task_id for task_ids, future in self.__pending for task_id in task_ids)
+        for task_id in tasks.keys():
+            if task_id not in waited_ids:
+                del tasks[task_id]
+
+    def __poll_pending(self):
+        """
+        background poller function for thread. runs while there are submitted waits.
+        :return: None
+        """
+        tasks = {}
+        delay = self.min_delay
+        while True:
+            with self.__lock:
+                if not self.__pending:
+                    self.__poller = None
+                    return
+                waits = list(self.__pending)
+                self.__wakeup.clear()
+            for task_ids, future in waits:
+                for task_id in task_ids:
+                    tasks.setdefault(task_id, None)
+
+            try:
+                task_result = self.__poll(tasks)
+            except Exception:
+                exc_info = sys.exc_info()
+                with self.__lock:
+                    self.__pending = [w for w in self.__pending if w not in waits]
+                self.__forget_tasks(tasks)
+                for task_ids, future in waits:
+                    future.set_exc_info(exc_info)
+                continue
+
+            for task_ids, future in waits:
+                wait_tasks = dict((task_id, tasks[task_id]) for task_id in task_ids)
+                if not self.__is_complete(wait_tasks):
+                    continue
+                with self.__lock:
+                    self.__pending.remove((task_ids, future))
+                # every wait gets its own response, with its own tasks
+                result = copy.copy(task_result)
+                result.data = dict(task_result.data)
+                future.set_result(self.__result(task_ids, wait_tasks, result))
+
+            self.__forget_tasks(tasks)
+            if not tasks:
+                # no wait is left (or a new one was submitted): don't wait for the delay
+                continue
+
+            if self.__wakeup.wait(delay):
+                delay = self.min_delay
+            else:
+                delay = min(self.max_delay, delay * self.backoff)
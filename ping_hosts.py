@@ -2,7 +2,8 @@
 # ping_hosts.py
 # version 1.1
 #
-# Purpose: Pings IP address of all Check Point Management Server host objects and prints results to csv file
+# Purpose: Pings IP address of all Check Point Management Server host objects and writes results to a csv file
+#          (or a JSON Lines or columnar file)
 # Author: Joshua J. Smith (JJSYNC)
 # October 2018
 
@@ -11,13 +12,14 @@ from __future__ import print_function
 import getpass
 import sys
 import os
-import csv
-import collections
 import argparse
+import itertools
+import threading
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # lib is a library that handles the communication with the Check Point management server.
-from lib import APIClient, APIClientArgs, Pinger
+from lib import APIClient, APIClientArgs, APIException, DebugLog, Pinger, AddressSpace, ObjectIndex, \
+    open_result_writer, Pipeline, PTRCache, ReverseLookups, ObjectSnapshot, sync_snapshot
 
 
 def main(argv):
@@ -30,13 +32,83 @@ def main(argv):
 
     # default thread count if not supplied by argv
     thread_count = 8
+    # default ping rate (packets per second) if not supplied by argv - no limit
+    ping_rate = None
+    # default number of pings per IP address, seconds between them and seconds to wait for each reply
+    ping_count = 1
+    ping_interval = 1.0
+    ping_timeout = 1.0
+    # default kinds of probes, and the ports of the TCP probes
+    ping_methods = ("icmp",)
+    ping_ports = (80, 443, 22)
+    # default number of processes the IPs are split between
+    ping_processes = 1
+    # by default, only host objects are pinged. networks and address ranges are expanded to at most
+    # max_per_network addresses, and all of them are pinged unless stop_after is set.
+    ping_networks = False
+    max_per_network = 256
+    stop_after = None
+    # default output format, sorted by IP
+    output_format = "csv"
+    sort_output = True
+    # by default, the DNS names of the addresses are not looked up. name_servers None - the name servers of the
+    # system. dns_cache - [optional] file of the cached DNS names. dns_retry_timeout - [optional] seconds to wait for the
+    # names of the addresses that timed out, when they are looked up again.
+    reverse_lookup = False
+    name_servers = None
+    dns_cache = None
+    dns_retry_timeout = None
+    # by default, all the objects are downloaded on every run. object_snapshot - [optional] file of the objects of the
+    # last run, so only the objects that changed since are downloaded. full_sync - download all of them anyway.
+    object_snapshot = None
+    full_sync = False
     if argv:
         parser = argparse.ArgumentParser(description="Ping IP address of host objects and outputs to csv file")
         parser.add_argument("-s", type=str, action="store", help="API Server IP address or hostname", dest="api_server")
         parser.add_argument("-u", type=str, action="store", help="User name", dest="username")
         parser.add_argument("-p", type=str, action="store", help="Password", dest="password")
-        parser.add_argument("-t", type=int, action="store", help="Number of Ping Threads", dest="thread_count")
+        parser.add_argument("-t", type=int, action="store", default=8, help="Number of Ping Threads",
+                            dest="thread_count")
         parser.add_argument("-o", type=str, action="store", help="File Name", dest="file_name")
+        parser.add_argument("-r", type=int, action="store", help="Maximum pings per second", dest="ping_rate")
+        parser.add_argument("-c", type=int, action="store", default=1, help="Number of pings per IP address",
+                            dest="ping_count")
+        parser.add_argument("-i", type=float, action="store", default=1.0, help="Seconds between the pings of an IP",
+                            dest="ping_interval")
+        parser.add_argument("-w", type=float, action="store", default=1.0, help="Seconds to wait for each reply",
+                            dest="ping_timeout")
+        parser.add_argument("-m", type=str, action="store", default="icmp",
+                            help="Comma separated probe methods, in order (icmp, tcp)", dest="ping_methods")
+        parser.add_argument("-P", type=str, action="store", default="80,443,22",
+                            help="Comma separated ports of the tcp probes", dest="ping_ports")
+        parser.add_argument("-n", type=int, action="store", default=1, help="Number of ping processes",
+                            dest="ping_processes")
+        parser.add_argument("-N", action="store_true", help="Also ping the addresses of networks and address ranges",
+                            dest="ping_networks")
+        parser.add_argument("-M", type=int, action="store", default=256,
+                            help="Maximum addresses to ping in each network or address range", dest="max_per_network")
+        parser.add_argument("-S", type=int, action="store",
+                            help="Stop pinging a network or address range after this many addresses answered",
+                            dest="stop_after")
+        parser.add_argument("-f", type=str, action="store", default="csv", choices=("csv", "jsonl", "columnar"),
+                            help="Output format", dest="output_format")
+        parser.add_argument("-U", action="store_false", help="Write the results as they arrive, without sorting by IP",
+                            dest="sort_output")
+        parser.add_argument("-d", action="store_true", help="Look up the DNS names of the IP addresses",
+                            dest="reverse_lookup")
+        parser.add_argument("-D", type=str, action="store",
+                            help="Comma separated IP addresses of the DNS servers (default - the system's)",
+                            dest="name_servers")
+        parser.add_argument("-C", type=str, action="store", help="File of the cached DNS names, shared between runs",
+                            dest="dns_cache")
+        parser.add_argument("-T", type=float, action="store",
+                            help="Look up the addresses whose DNS lookup timed out again, waiting this many seconds",
+                            dest="dns_retry_timeout")
+        parser.add_argument("-Y", type=str, action="store",
+                            help="File of the objects of the last run. Only the changes are downloaded",
+                            dest="object_snapshot")
+        parser.add_argument("-F", action="store_true", help="Download all the objects into the file of -Y",
+                            dest="full_sync")
 
         args = parser.parse_args()
 
@@ -50,6 +122,24 @@ def main(argv):
         password = args.password
         file_name = args.file_name
         thread_count = args.thread_count
+        ping_rate = args.ping_rate
+        ping_count = args.ping_count
+        ping_interval = args.ping_interval
+        ping_timeout = args.ping_timeout
+        ping_methods = tuple(args.ping_methods.split(","))
+        ping_ports = tuple(int(port) for port in args.ping_ports.split(","))
+        ping_processes = args.ping_processes
+        ping_networks = args.ping_networks
+        max_per_network = args.max_per_network
+        stop_after = args.stop_after
+        output_format = args.output_format
+        sort_output = args.sort_output
+        reverse_lookup = args.reverse_lookup
+        name_servers = args.name_servers.split(",") if args.name_servers else None
+        dns_cache = args.dns_cache
+        dns_retry_timeout = args.dns_retry_timeout
+        object_snapshot = args.object_snapshot
+        full_sync = args.full_sync
 
     else:
         api_server = raw_input("Enter server IP address or hostname:")
@@ -61,78 +151,241 @@ def main(argv):
             password = raw_input("Enter password: ")
         file_name = raw_input("Enter file name: ")
 
-    client_args = APIClientArgs(server=api_server)
+    # debug log. The debug file will hold all the communication between the python script and Check Point's
+    # management server, written as the calls are made, without the objects of the replies (so the pages of the
+    # queries are not kept in memory). The file is rotated to api_calls.json.1 when it grows beyond 10 MB.
+    client_args = APIClientArgs(server=api_server,
+                                debug_log=DebugLog("api_calls.json", max_calls=0, include_bodies=False,
+                                                   max_bytes=10 * 1024 * 1024))
 
-    with APIClient(client_args) as client:
+    # objects - for a given IP address, get all the objects (uid, name, domain) that use this IP address.
+    objects = ObjectIndex()
+    # network_domains - for a given network or address range uid, get the name of its domain.
+    network_domains = {}
+    # the addresses of the networks and address ranges, expanded while they are pinged
+    address_space = AddressSpace(max_per_network, stop_after)
+    # probed - for a given IP address (its id in objects.addresses), get its index in the ping statistics
+    probed = {}
+    # written - the ids of the addresses whose rows were written
+    written = set()
+    # late - (address id, (uid, name, domain)) of the objects that were found after the rows of their address were
+    # written
+    late = []
+    # dns_names - for a given IP address id, get its DNS name (if it has one)
+    dns_names = {}
+    # objects, probed, written and late are shared by the stages of the pipeline
+    index_lock = threading.Lock()
 
-        # create debug file. The debug file will hold all the communication between the python script and
-        # Check Point's management server.
-        client.debug_file = "api_calls.json"
+    # Calls Pinger class with number of threads, rate limit and the pings to send to each IP. The IPs are given by the
+    # ping stage.
+    ping = Pinger(thread_count, None, rate=ping_rate, count=ping_count, interval=ping_interval, timeout=ping_timeout,
+                  methods=ping_methods, ports=ping_ports, processes=ping_processes)
 
-        # The API client, would look for the server's certificate SHA1 fingerprint in a file.
-        # If the fingerprint is not found on the file, it will ask the user if he accepts the server's fingerprint.
-        # In case the user does not accept the fingerprint, exit the program.
-        if client.check_fingerprint() is False:
-            print("Could not get the server's fingerprint - Check connectivity with the server.")
-            exit(1)
+    def fetch(inputs):
+        """
+        pipeline stage: the IP addresses of the hosts, as each page of hosts arrives (each address once). Then gathers
+        the networks and address ranges, whose addresses are expanded by the ping stage.
+        With object_snapshot, the snapshot is brought up to date first, and the objects are read from it.
+        """
+        # the snapshot is opened by the thread of the stage, which uses it
+        snapshot = ObjectSnapshot(object_snapshot) if object_snapshot else None
+        try:
+            if snapshot is not None:
+                print("Updating the snapshot of the objects\nProcessing. Please wait...")
+                try:
+                    mode, changed, deleted = sync_snapshot(
+                        client, snapshot, ("host", "network", "address-range") if ping_networks else ("host",),
+                        full_sync)
+                except APIException as err:
+                    print("Failed to update the snapshot of the objects: {}".format(err))
+                    raise
+                print("Snapshot updated ({}): {} objects added or changed, {} removed".format(mode, changed, deleted))
+            for ipaddr in fetch_addresses(snapshot):
+                yield ipaddr
+        finally:
+            if snapshot is not None:
+                snapshot.close()
 
-        # login to server:
-        login_res = client.login(username, password)
+    def fetch_addresses(snapshot):
+        """the addresses of the fetch stage, of the objects of the snapshot, or of the server if it is None"""
+        def api_objects(command, object_type):
+            if snapshot is not None:
+                return snapshot.objects(object_type)
+            return client.gen_api_objects(command, "standard")
 
-        if login_res.success is False:
-            print("Login failed: {}".format(login_res.error_message))
-            exit(1)
-
-        # show hosts
         print("Gathering all hosts\nProcessing. Please wait...")
-        show_hosts_res = client.api_query("show-hosts", "standard")
-        if show_hosts_res.success is False:
-            print("Failed to get the list of all host objects: {}".format(show_hosts_res.error_message))
-            exit(1)
-
-    # obj_dictionary - for a given IP address, get an array of hosts (name) that use this IP address.
-    obj_dictionary = {}
-
-    # iterates through hosts creating dictionary of key: IP value: host name
-    for host in show_hosts_res.data:
-        ipaddr = host.get("ipv4-address")
-        if ipaddr is None:
-            print(host["name"] + " has no IPv4 address. Skipping...")
-            continue
-        host_data = {"name": host["name"]}
-        obj_dictionary[ipaddr] = host_data
-
-    # build IP array from passed dictionary
-    ips = obj_dictionary.keys()
-
-    # Calls Pinger class with number of threads and ip list
-    ping = Pinger(thread_count, ips)
-    # starts ping test of IP addresses
-    queue_list = ping.start_ping()
-
-    # Updates dictionary in place with status of ping results
-    for i in queue_list:
-        if i is None:
-            continue
-        else:
-            obj_dictionary[i[0]]['status'] = i[1]
+        try:
+            # iterates through hosts as they arrive, adding every host to the objects of its IP addresses
+            for host in api_objects("show-hosts", "host"):
+                host_addresses = [host[key] for key in ("ipv4-address", "ipv6-address") if host.get(key)]
+                if not host_addresses:
+                    print(host["name"] + " has no IP address. Skipping...")
+                    continue
+                for ipaddr in host_addresses:
+                    host_object = (host.get("uid"), host["name"], host.get("domain", {}).get("name"))
+                    with index_lock:
+                        address_id = objects.addresses.get(ipaddr)
+                        objects.add(ipaddr, *host_object)
+                        if address_id in written:
+                            late.append((address_id, host_object))
+                    if address_id is None:
+                        yield ipaddr
+        except APIException as err:
+            print("Failed to get the list of all host objects: {}".format(err))
+            raise
+
+        if ping_networks:
+            print("Gathering all networks and address ranges\nProcessing. Please wait...")
+            try:
+                for network in api_objects("show-networks", "network"):
+                    network_domains[network.get("uid")] = network.get("domain", {}).get("name")
+                    for version in ("4", "6"):
+                        if network.get("subnet" + version):
+                            address_space.add_network(network["name"], network["subnet" + version],
+                                                      network["mask-length" + version], network.get("uid"))
+                for address_range in api_objects("show-address-ranges", "address-range"):
+                    network_domains[address_range.get("uid")] = address_range.get("domain", {}).get("name")
+                    for version in ("4", "6"):
+                        if address_range.get("ipv" + version + "-address-first"):
+                            address_space.add_range(address_range["name"],
+                                                    address_range["ipv" + version + "-address-first"],
+                                                    address_range["ipv" + version + "-address-last"],
+                                                    address_range.get("uid"))
+            except APIException as err:
+                print("Failed to get the list of all network objects: {}".format(err))
+                raise
+
+    def add_network_address(address, status):
+        """
+        adds the networks and address ranges an address was yielded from to its objects (with index_lock held)
+        :return: list of (uid, name, domain) of the networks and address ranges
+        """
+        added = []
+        block = address_space.record(address, status == "active")
+        while block is not None:
+            objects.add(address, block.uid, block.name, network_domains.get(block.uid))
+            added.append((block.uid, block.name, network_domains.get(block.uid)))
+            block = address_space.record(address, status == "active")
+        return added
+
+    def network_addresses():
+        """
+        the addresses of the networks and address ranges that are not pinged yet. the networks of the addresses that
+        were already pinged are added to their objects now, and of the addresses that are being pinged when their
+        status arrives.
+        """
+        for address in address_space:
+            with index_lock:
+                address_id = objects.addresses.get(address)
+                if address_id is None:
+                    # in the index from now on, so overlapping networks don't ping it again
+                    objects.addresses.add(address)
+                elif address_id in probed:
+                    result = ping.stats.result(probed[address_id])
+                    for network_object in add_network_address(address, "active" if result.received else "inactive"):
+                        if address_id in written:
+                            late.append((address_id, network_object))
+            if address_id is None:
+                yield address
+
+    def probe(addresses):
+        """
+        pipeline stage: pings the addresses of the hosts as they arrive, followed by the addresses of the networks and
+        address ranges, so every address is pinged once.
+        """
+        ping.ip_list = itertools.chain(addresses, network_addresses())
+        for index, address, status, result in ping.iter_indexed():
+            with index_lock:
+                address_id = objects.addresses.get(address)
+                probed[address_id] = index
+                add_network_address(address, status)
+            yield address_id, address, result
+
+    def resolve(items):
+        """pipeline stage: looks up the DNS names of the pinged addresses"""
+        # address -> (address id, address, result) of the addresses being looked up
+        pending = {}
+
+        def addresses():
+            for item in items:
+                if item is not None:
+                    pending[item[1]] = item
+                    yield item[1]
+                else:
+                    yield None
+
+        # the cache is opened by the thread of the stage, which uses it
+        ptr_cache = PTRCache(dns_cache) if dns_cache else None
+        try:
+            lookups = ReverseLookups(thread_count, addresses(), name_servers, ptr_cache)
+            for lookup in lookups.iter_results(retry_timeout=dns_retry_timeout):
+                yield pending.pop(lookup.address) + (lookup.name,)
+        finally:
+            if ptr_cache is not None:
+                ptr_cache.close()
+
+    def write(items):
+        """
+        pipeline stage: writes a row for every object of an address, i.e. IP, status, name, uid, domain, stats and DNS
+        name. The objects found after the rows of their address were written are written at the end.
+        """
+        def write_rows(address, result, dns_name, address_objects):
+            for uid, name, domain in address_objects:
+                writer.write({"ip": address, "status": "active" if result.received else "inactive", "name": name,
+                              "uid": uid, "domain": domain, "method": result.method, "loss": result.loss,
+                              "rtt_min": result.min, "rtt_avg": result.avg, "rtt_max": result.max,
+                              "jitter": result.jitter, "dns_name": dns_name})
+
+        for item in items:
+            address_id, address, result = item[:3]
+            dns_name = item[3] if len(item) > 3 else None
+            if dns_name:
+                dns_names[address_id] = dns_name
+            with index_lock:
+                written.add(address_id)
+                address_objects = objects.objects(address_id)
+            write_rows(address, result, dns_name, address_objects)
+            yield address_id
+
+        for address_id, address_object in late:
+            write_rows(objects.addresses.address(address_id), ping.stats.result(probed[address_id]),
+                       dns_names.get(address_id), [address_object])
+
+    pipeline = Pipeline()
+    pipeline.add_stage("fetch", fetch)
+    pipeline.add_stage("ping", probe, poll=True)
+    if reverse_lookup:
+        pipeline.add_stage("dns", resolve, poll=True)
+    pipeline.add_stage("write", write)
+
+    try:
+        with APIClient(client_args) as client:
+
+            # The API client, would look for the server's certificate SHA1 fingerprint in a file.
+            # If the fingerprint is not found on the file, it will ask the user if he accepts the server's
+            # fingerprint. In case the user does not accept the fingerprint, exit the program.
+            if client.check_fingerprint() is False:
+                print("Could not get the server's fingerprint - Check connectivity with the server.")
+                exit(1)
 
-    # Orders dictionary for readability
-    od_obj_dictionary = collections.OrderedDict(sorted(obj_dictionary.items()))
+            # login to server:
+            login_res = client.login(username, password)
 
-    ips_dict = []
+            if login_res.success is False:
+                print("Login failed: {}".format(login_res.error_message))
+                exit(1)
 
-    # Creates list from dictionary, dictionary values i.e. {key: {key1: value1, key2: value2}} to [key, value1, value2]
-    for item in od_obj_dictionary:
-        sub_item = list()
-        sub_item.append(item)
-        for key, value in od_obj_dictionary[item].iteritems():
-            sub_item.append(value)
-        ips_dict.append(sub_item)
+            # runs the stages at the same time: the hosts are pinged as they arrive from the server, and the rows of
+            # each address are written as soon as its status (and DNS name) is known. When the output is sorted by IP,
+            # the rows are sorted in temporary files, and written at the end.
+            with open_result_writer(file_name, output_format, sort=sort_output) as writer:
+                for address_id in pipeline.run():
+                    pass
+    except APIException:
+        exit(1)
 
-    with open(file_name, "wb") as f:
-        writer = csv.writer(f)
-        writer.writerows(ips_dict)
+    for line in pipeline.report():
+        print(line)
 
 
 if __name__ == "__main__":